@@ -0,0 +1,90 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from logger import logger
+from metrics import metrics
+from cache import SORT_FIELDS
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Most entries one /cache page lists, whatever limit is asked for
+MAX_PAGE_SIZE = 1000
+
+
+def serve_metrics(query):
+    return 200, PROMETHEUS_CONTENT_TYPE, metrics.render()
+
+
+def cache_listing(cache):
+    """
+    /cache?prefix=&sort=last_access&order=desc&offset=0&limit=100: one page
+    of cache entry metadata as JSON, see LRUCache.describe().
+    """
+    def serve(query):
+        def param(name, default):
+            return query.get(name, [default])[-1]
+
+        sort = param("sort", "last_access")
+        order = param("order", "desc")
+        try:
+            offset = max(0, int(param("offset", 0)))
+            limit = min(MAX_PAGE_SIZE, max(1, int(param("limit", 100))))
+        except ValueError:
+            return 400, "text/plain", "offset and limit must be integers\n"
+        if sort not in SORT_FIELDS or order not in ("asc", "desc"):
+            return 400, "text/plain", f"sort is one of {', '.join(SORT_FIELDS)} and order is asc or desc\n"
+        total, entries = cache.describe(param("prefix", ""), sort, order == "desc", offset, limit)
+        page = {"total": total, "offset": offset, "limit": limit, "sort": sort, "order": order, "entries": entries}
+        return 200, "application/json", json.dumps(page)
+    return serve
+
+
+class AdminRequestHandler(BaseHTTPRequestHandler):
+    """ Answers GETs from the server's routes: path -> function(query) returning (status, content type, body). """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        route = self.server.routes.get(url.path)
+        if route is None:
+            status, content_type, body = 404, "text/plain", "Not found\n"
+        else:
+            try:
+                status, content_type, body = route(parse_qs(url.query))
+            except Exception as e:
+                logger.exception(f"[Admin] Error serving {self.path}: {e}")
+                status, content_type, body = 500, "text/plain", "Internal error\n"
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the proxy log
+        logger.debug("[Admin] %s %s", self.address_string(), format % args)
+
+
+class AdminServer:
+    """ Small HTTP server on its own thread for metrics and other introspection, kept off the proxy port. """
+
+    def __init__(self, host, port, cache=None):
+        self.host = host
+        self.port = port
+        self.routes = {"/metrics": serve_metrics}
+        if cache is not None:
+            self.routes["/cache"] = cache_listing(cache)
+        self.server = None
+
+    def start(self):
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), AdminRequestHandler)
+        except OSError as e:
+            # Metrics are not worth refusing to proxy over
+            logger.warning(f"[!] Admin server could not listen on {self.host}:{self.port}: {e}")
+            return
+        self.server.daemon_threads = True
+        self.server.routes = self.routes
+        threading.Thread(target=self.server.serve_forever, name="admin-server", daemon=True).start()
+        logger.info(f"[*] Admin server on http://{self.host}:{self.port} ({', '.join(self.routes)})")
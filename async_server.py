@@ -0,0 +1,410 @@
+import asyncio
+import os
+import time
+from config import PROXY_HOST, PROXY_PORT, CLIENT_IDLE_TIMEOUT, MAX_REQUESTS_PER_CONNECTION, \
+    TUNNEL_IDLE_TIMEOUT, TUNNEL_MAX_LIFETIME
+from http_parser import RequestParser, ResponseFramer, HttpParseError, RequestTooLarge, MAX_HEADER_SIZE
+from handler import cache, misses, is_blacklisted, for_client, CacheExchange, RELAY_BUFFER_SIZE
+from compression import accepts_gzip, gunzip_response, is_gzipped
+from upstream import upstream_pool, split_host_port, UPSTREAM_TIMEOUT
+from logger import logger
+from singleflight import COALESCE_TIMEOUT, STORED
+from reloader import settings_reloader
+from metrics import CONNECTIONS, REQUESTS, BLOCKED, HTTP_BYTES, TUNNELS, TUNNEL_BYTES, REQUEST_SECONDS, \
+    method_label, host_label
+
+
+def apply_settings(settings):
+    global CLIENT_IDLE_TIMEOUT, MAX_REQUESTS_PER_CONNECTION, TUNNEL_IDLE_TIMEOUT, TUNNEL_MAX_LIFETIME
+    CLIENT_IDLE_TIMEOUT = settings.CLIENT_IDLE_TIMEOUT
+    MAX_REQUESTS_PER_CONNECTION = settings.MAX_REQUESTS_PER_CONNECTION
+    TUNNEL_IDLE_TIMEOUT = settings.TUNNEL_IDLE_TIMEOUT
+    TUNNEL_MAX_LIFETIME = settings.TUNNEL_MAX_LIFETIME
+
+
+settings_reloader.subscribe(("client_idle_timeout", "max_requests_per_connection", "tunnel_idle_timeout",
+                             "tunnel_max_lifetime"), apply_settings)
+
+
+async def read_request(reader, parser):
+    while True:
+        request = parser.next_request()
+        if request is not None:
+            return request
+        data = await asyncio.wait_for(reader.read(65536), CLIENT_IDLE_TIMEOUT)
+        if not data:
+            return None
+        parser.feed(data)
+
+
+async def stream_request_body(reader, writer, parser, request, server_socket):
+    """ Forward the request body to the upstream as it arrives, without buffering it whole. """
+    if request.expects_continue:
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        await writer.drain()
+    while not parser.body_done:
+        chunk = parser.read_body()
+        if chunk:
+            await asyncio.wait_for(asyncio.get_running_loop().sock_sendall(server_socket, chunk), UPSTREAM_TIMEOUT)
+            continue
+        data = await asyncio.wait_for(reader.read(65536), CLIENT_IDLE_TIMEOUT)
+        if not data:
+            raise ConnectionError("client closed the connection while sending the request body")
+        parser.feed(data)
+
+
+async def handle_client(reader, writer):
+    client_addr = writer.get_extra_info("peername")
+    logger.info("[+] New connection from %s", client_addr)
+    CONNECTIONS.inc()
+    parser = RequestParser()
+    try:
+        for _ in range(MAX_REQUESTS_PER_CONNECTION):
+            request = await read_request(reader, parser)
+            if not request:
+                return
+            REQUESTS.inc(method_label(request.method))
+
+            if request.method == "CONNECT":
+                await handle_https_tunnel(reader, writer, request.request_line, client_addr, parser.take_pending())
+                return
+            if not await handle_http(reader, writer, request, parser, client_addr):
+                return
+
+    except asyncio.TimeoutError:
+        logger.debug("[-] Closing idle connection from %s", client_addr)
+    except RequestTooLarge as e:
+        logger.warning(f"[!] Rejecting request from {client_addr}: {e}")
+        writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\n\r\n")
+    except HttpParseError as e:
+        logger.warning(f"[!] Malformed request from {client_addr}: {e}")
+        writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+    except Exception as e:
+        logger.exception(f"[!] Error handling client {client_addr}: {e}")
+    finally:
+        writer.close()
+
+
+async def handle_http(reader, writer, request, parser, client_addr):
+    """ Serve one request, returns True if the client connection can carry another one. """
+    dest_host = dest_name = None
+    served = None  # Which latency histogram path the request took, once it is known
+    start = time.monotonic()
+    try:
+        dest_host = request.host
+
+        if not dest_host:
+            logger.warning(f"[!] No Host header in request from {client_addr}")
+            writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\nMissing Host Header")
+            await writer.drain()
+            return False
+
+        path = request.target
+        url_path = request.request_line
+        dest_name, dest_port = split_host_port(dest_host)
+        exchange = CacheExchange(request, dest_name, dest_port)
+        cache_key = exchange.cache_key
+        logger.debug("[Cache Key] Generated for %s -> %s", url_path, cache_key)
+
+        if is_blacklisted(dest_host, path):
+            logger.info("[Blocked] Attempted access to %s", dest_host)
+            BLOCKED.inc("http")
+            writer.write(b"HTTP/1.1 403 Forbidden\r\n\r\nBlocked by Proxy")
+            await writer.drain()
+            return False
+
+        logger.info("[>] HTTP Request from %s to %s:%s for %s", client_addr, dest_name, dest_port, url_path)
+
+        served = "miss" if exchange.cacheable else "pass"
+        # Whatever may touch the disk (opening disk entries, storing and revalidating responses) runs in the
+        # executor, the event loop only ever waits on sockets
+        loop = asyncio.get_running_loop()
+        try:
+            if not exchange.look_up(disk=False) and exchange.cacheable and cache.disk is not None:
+                await loop.run_in_executor(None, exchange.look_up_disk)
+            reply = exchange.stored_reply()
+            if reply is not None:
+                served = "hit"
+            elif exchange.cacheable and not exchange.join():
+                published, flight = await wait_for_flight(cache_key, exchange.flight)
+                if published is STORED:
+                    reply = await loop.run_in_executor(None, exchange.answer_published, published, flight)
+                else:
+                    reply = exchange.answer_published(published, flight)
+
+            if reply is None:
+                exchange.start_fetch()
+                relayed, framer = await fetch_from_upstream(
+                    reader, writer, parser, request, dest_name, dest_port, fill=exchange.fill,
+                    on_uncacheable=exchange.uncacheable, validators=exchange.validators,
+                    stale_if_error=exchange.stale_if_error)
+                if exchange.cacheable:
+                    reply = await loop.run_in_executor(None, exchange.after_fetch, relayed, framer)
+                else:
+                    reply = exchange.after_fetch(relayed, framer)
+            if reply is not None:
+                keep_alive = await send_reply(writer, request, reply)
+                return keep_alive and request.keep_alive and parser.body_done
+        finally:
+            exchange.finish()
+
+        if framer is None:
+            return False
+        logger.info("[Status Code] %s", framer.status_line)
+        duration = time.monotonic() - start
+        logger.info("[Response] %s | Method: %s | Duration: %.2fs", cache_key, request.method, duration)
+
+        # The client sees the origin's headers, so it can only reuse the connection if they allow it
+        return framer.done and framer.keep_alive and request.keep_alive and parser.body_done
+
+    except Exception as e:
+        logger.exception(f"[!] HTTP error from {client_addr} to {dest_host or 'UNKNOWN'}: {e}")
+        return False
+    finally:
+        if served:
+            REQUEST_SECONDS.observe(time.monotonic() - start, served, host_label(dest_name))
+
+
+async def wait_for_flight(cache_key, flight):
+    """ misses.wait() for the event loop, see SingleFlight.wait(). """
+    while True:
+        try:
+            # Shielded so a waiter timing out does not cancel the flight for the others
+            published = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(flight)), COALESCE_TIMEOUT)
+        except asyncio.TimeoutError:
+            flight, leader = misses.take_over(cache_key, flight)
+            if leader:
+                return None, flight
+            continue
+        misses.record(published)
+        return published, None
+
+
+async def send_reply(writer, request, reply):
+    """ Send what the cache answered with, returns whether it allows keep-alive. """
+    if reply.data is None:
+        return await send_stored(writer, request, reply.key, reply.entry, reply.file)
+    writer.write(reply.data)
+    HTTP_BYTES.inc("sent", amount=len(reply.data))
+    await writer.drain()
+    return reply.keep_alive
+
+
+async def send_stored(writer, request, cache_key, stored, f=None):
+    """ Send a cached response from memory, or from its disk file f. Returns whether its headers allow keep-alive. """
+    if f:
+        return await send_from_disk(writer, request, cache_key, f, stored)
+    response = for_client(request, stored.response, stored.gzipped)
+    writer.write(response)
+    HTTP_BYTES.inc("sent", amount=len(response))
+    await writer.drain()
+    framer = ResponseFramer(request.method)
+    framer.feed(stored.response)
+    return framer.done and framer.keep_alive
+
+
+async def send_from_disk(writer, request, cache_key, f, entry):
+    """ Send a disk tier hit with the loop's sendfile, returns whether its headers allow keep-alive. """
+    loop = asyncio.get_running_loop()
+    with f:
+        framer = ResponseFramer(request.method)
+        head = await loop.run_in_executor(None, os.pread, f.fileno(), min(entry.size, MAX_HEADER_SIZE), entry.offset)
+        framer.feed(head)
+        gzipped = is_gzipped(framer.headers)
+        if gzipped and not accepts_gzip(request.headers.get('accept-encoding', '')):
+            # Only clients that can't take gzip make the body pass through Python, off the loop
+            data = await loop.run_in_executor(None, cache.disk.read, f, entry)
+            response = await loop.run_in_executor(None, gunzip_response, data)
+            writer.write(response)
+            HTTP_BYTES.inc("sent", amount=len(response))
+        else:
+            await writer.drain()
+            HTTP_BYTES.inc("sent", amount=await loop.sendfile(writer.transport, f, entry.offset, entry.size))
+        await writer.drain()
+        # Promotion reads the file and may demote other entries to disk, keep it off the loop
+        await loop.run_in_executor(None, cache.promote, cache_key, f, entry, gzipped)
+    return framer.keep_alive
+
+
+async def fetch_from_upstream(reader, writer, parser, request, host, port, fill=None, on_uncacheable=None,
+                              validators=b'', stale_if_error=False):
+    """
+    handler.fetch_from_upstream() for the event loop: the same pooled
+    upstream connections, driven with the loop's socket calls. The client
+    gets a 504 if the origin fails before anything was relayed, unless
+    stale_if_error lets the caller answer.
+
+    Returns (bytes relayed, framer), with no framer if the origin could not
+    be reached.
+    """
+    loop = asyncio.get_running_loop()
+    head = request.upstream_head(validators)
+    while True:
+        server_socket = upstream_pool.checkout(host, port)
+        reused = server_socket is not None
+        if not reused:
+            try:
+                # Resolving and connecting block, the pool does both on the executor's threads
+                server_socket = await loop.run_in_executor(None, upstream_pool.connect, host, port)
+            except OSError as e:
+                logger.warning(f"[!] Could not connect to {host}:{port}: {e}")
+                if not stale_if_error:
+                    writer.write(b"HTTP/1.1 504 Gateway Timeout\r\n\r\nUpstream server timed out")
+                    await writer.drain()
+                return 0, None
+        server_socket.setblocking(False)
+
+        framer = ResponseFramer(request.method)
+        held = b''  # Response head bytes held back until it is clear whether the cache answers instead
+        received = relayed = 0
+        keeping = fill is not None
+        # A pooled connection that turns out to be dead can only be retried while the body is unread
+        retryable = reused and not request.has_body
+        try:
+            await asyncio.wait_for(loop.sock_sendall(server_socket, head), UPSTREAM_TIMEOUT)
+            if request.has_body:
+                await stream_request_body(reader, writer, parser, request, server_socket)
+
+            # Stop at the end of the framed response instead of waiting for the origin to close
+            while not framer.done:
+                data = await asyncio.wait_for(loop.sock_recv(server_socket, RELAY_BUFFER_SIZE), UPSTREAM_TIMEOUT)
+                if not data:
+                    framer.eof()
+                    break
+                received += len(data)
+                data = data[:framer.feed(data)]
+                if validators or stale_if_error:
+                    if (validators and framer.status == 304) or (stale_if_error and framer.status >= 500):
+                        continue  # Answered from the cache instead
+                    if held or not framer.status:
+                        held += data
+                        if not framer.status:
+                            continue
+                        data, held = held, b''
+                writer.write(data)
+                relayed += len(data)
+                await writer.drain()
+                if keeping:
+                    if fill.writes_disk(len(data), framer.content_length):
+                        # Spooling a big response to the disk tier, off the loop
+                        keeping = await loop.run_in_executor(None, fill.feed, data, framer.content_length)
+                    else:
+                        keeping = fill.feed(data, framer.content_length)
+                    if not keeping and on_uncacheable:
+                        # Too big or not allowed to cache, stop holding on to it
+                        on_uncacheable()
+        except asyncio.TimeoutError:
+            logger.warning(f"[!] Timeout while reading from {host}")
+        except OSError as e:
+            if retryable and not relayed:
+                # The origin dropped the pooled connection, retry on another one
+                server_socket.close()
+                continue
+            logger.warning(f"[!] Error forwarding data from {host} to client: {e}")
+        else:
+            if retryable and not relayed and not framer.done:
+                server_socket.close()
+                continue
+
+        HTTP_BYTES.inc("received", amount=received)
+        HTTP_BYTES.inc("sent", amount=relayed)
+        if framer.done and framer.keep_alive:
+            server_socket.settimeout(UPSTREAM_TIMEOUT)  # Pooled connections are blocking ones, as threads use them
+            upstream_pool.release(host, port, server_socket)
+        else:
+            server_socket.close()
+
+        if not relayed and not framer.done and not stale_if_error:
+            # Nothing reached the client, a held back head included, so it can still get an answer
+            writer.write(b"HTTP/1.1 504 Gateway Timeout\r\n\r\nUpstream server timed out")
+            await writer.drain()
+        return relayed, framer
+
+
+async def _pipe(reader, writer, activity, direction):
+    """ Copy bytes from reader to writer until EOF, noting when data last moved in activity[0]. """
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            return
+        activity[0] = time.monotonic()
+        writer.write(data)
+        await writer.drain()
+        TUNNEL_BYTES.inc(direction, amount=len(data))
+
+
+async def handle_https_tunnel(reader, writer, first_line, client_addr, pending=b''):
+    dest_host, dest_port = None, None
+    server_writer = None
+    established = False
+    start = time.monotonic()
+    try:
+        logger.info("[>] HTTPS CONNECT from %s: %s", client_addr, first_line.strip())
+        _, address, _ = first_line.split()
+        dest_host, dest_port = address.split(':')
+        dest_host = dest_host.lower()
+        dest_port = int(dest_port)
+
+        if is_blacklisted(dest_host):
+            logger.info("[Blocked HTTPS] Attempted access to %s", dest_host)
+            BLOCKED.inc("connect")
+            writer.write(b"HTTP/1.1 403 Forbidden\r\n\r\nBlocked by Proxy")
+            await writer.drain()
+            return
+
+        server_reader, server_writer = await asyncio.wait_for(
+            asyncio.open_connection(dest_host, dest_port), UPSTREAM_TIMEOUT)
+
+        writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+        await writer.drain()
+        REQUEST_SECONDS.observe(time.monotonic() - start, "tunnel_setup", host_label(dest_host))
+        established = True
+        TUNNELS.inc()
+        if pending:
+            server_writer.write(pending)
+            TUNNEL_BYTES.inc("upstream", amount=len(pending))
+
+        # An idle tunnel is just two parked coroutines; close both sides once either one ends,
+        # or once the tunnel sat idle or outlived its maximum lifetime
+        started = time.monotonic()
+        activity = [started]
+        relays = [
+            asyncio.ensure_future(_pipe(reader, server_writer, activity, "upstream")),
+            asyncio.ensure_future(_pipe(server_reader, writer, activity, "downstream")),
+        ]
+        while True:
+            done, pending = await asyncio.wait(relays, timeout=UPSTREAM_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+            if done:
+                break
+            now = time.monotonic()
+            if now - activity[0] >= TUNNEL_IDLE_TIMEOUT:
+                logger.info(f"[Tunnel] Closing idle tunnel {client_addr} <-> {dest_host}")
+                break
+            if 0 < TUNNEL_MAX_LIFETIME <= now - started:
+                logger.info(f"[Tunnel] Closing tunnel {client_addr} <-> {dest_host} after {TUNNEL_MAX_LIFETIME}s")
+                break
+        for task in pending:
+            task.cancel()
+        for task in done:
+            error = task.exception()
+            if isinstance(error, (ConnectionResetError, ConnectionAbortedError)):
+                logger.warning(f"[!] Connection error in HTTPS tunnel: {client_addr} <-> {dest_host} | {error}")
+
+    except Exception as e:
+        logger.exception(f"[!] HTTPS tunnel error from {client_addr} to {dest_host}:{dest_port} - {e}")
+    finally:
+        if established:
+            TUNNELS.dec()
+        if server_writer:
+            server_writer.close()
+
+
+async def serve(listener):
+    server = await asyncio.start_server(handle_client, sock=listener)
+    async with server:
+        await server.serve_forever()
+
+
+def start_async_proxy(listener):
+    logger.info(f"[*] Starting asyncio proxy on {PROXY_HOST}:{PROXY_PORT}...")
+    asyncio.run(serve(listener))
@@ -0,0 +1,64 @@
+"""
+Measures cache hit throughput under contention, from 1 to 64 threads,
+with a single lock (one shard) vs the sharded cache.
+
+Run from the repository root:
+    python -m benchmarks.bench_cache [seconds per run]
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from cache import LRUCache
+from config import CACHE_SHARDS
+from logger import logger
+
+KEYS = 4096
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 512\r\nCache-Control: max-age=3600\r\n\r\n" + b"x" * 512
+THREADS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def bench(shards, threads, seconds):
+    cache = LRUCache(max_bytes=64 * 1024 * 1024, shards=shards)
+    keys = [f"http://bench.example/{i}" for i in range(KEYS)]
+    for key in keys:
+        cache.set(key, RESPONSE)
+
+    counts = [0] * threads
+    stop = threading.Event()
+    start_line = threading.Barrier(threads + 1)
+
+    def worker(slot):
+        lookups = random.Random(slot).choices(keys, k=1024)
+        start_line.wait()
+        done = 0
+        while not stop.is_set():
+            for key in lookups:
+                cache.get(key)
+            done += len(lookups)
+        counts[slot] = done
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    start_line.wait()
+    time.sleep(seconds)
+    stop.set()
+    for thread in workers:
+        thread.join()
+    return sum(counts) / seconds
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    # Keep the journal, snapshot and disk tier of the runs out of the repository
+    os.chdir(tempfile.mkdtemp(prefix="bench_cache_"))
+    logger.setLevel(logging.WARNING)  # Filling the cache logs every set
+    print(f"{'threads':>8} {'1 shard':>14} {f'{CACHE_SHARDS} shards':>14}")
+    for threads in THREADS:
+        single = bench(1, threads, seconds)
+        sharded = bench(CACHE_SHARDS, threads, seconds)
+        print(f"{threads:>8} {single:>10,.0f} h/s {sharded:>10,.0f} h/s")
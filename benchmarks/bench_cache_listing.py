@@ -0,0 +1,53 @@
+"""
+Measures what listing the cache costs the dashboard with 100k entries:
+unpickling the whole snapshot, bodies included, as the dashboard did, vs
+one page of live metadata from LRUCache.describe(), sorted or filtered
+by key prefix.
+
+Run from the repository root:
+    python -m benchmarks.bench_cache_listing [entries]
+"""
+import logging
+import os
+import pickle
+import sys
+import tempfile
+import time
+from cache import LRUCache
+from config import CACHE_FILE
+from logger import logger
+
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 1024\r\nCache-Control: max-age=3600\r\n\r\n" + b"x" * 1024
+
+
+def timed(function, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def load_snapshot():
+    with open(CACHE_FILE, "rb") as f:
+        return pickle.load(f)
+
+
+if __name__ == "__main__":
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    # Keep the journal, snapshot and disk tier of the run out of the repository
+    os.chdir(tempfile.mkdtemp(prefix="bench_cache_listing_"))
+    logger.setLevel(logging.WARNING)
+    cache = LRUCache(max_bytes=entries * 2 * len(RESPONSE), compress_level=0)
+    for i in range(entries):
+        cache.set(f"http://site{i % 100}.example/page/{i}", RESPONSE)
+    cache.save()
+
+    runs = (
+        ("unpickle the snapshot", lambda: len(load_snapshot())),
+        ("page by last access", lambda: cache.describe(limit=50)[0]),
+        ("page by size, offset 10k", lambda: cache.describe(sort="size", offset=10_000, limit=50)[0]),
+        ("page of one site's keys", lambda: cache.describe(prefix="http://site7.example/", limit=50)[0]),
+    )
+    for name, run in runs:
+        seconds, listed = timed(run)
+        print(f"{name:>26}: {seconds * 1000:8.1f} ms ({listed} entries)")
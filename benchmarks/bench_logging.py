@@ -0,0 +1,85 @@
+"""
+Measures what the hot path logging of one request costs the calling thread:
+the queued pipeline vs writing and flushing every record (and rewriting the
+dashboard file on every matching one) on the calling thread, as before.
+
+Run from the repository root:
+    python -m benchmarks.bench_logging [requests]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from logger import DASH_PATTERN, DashLogHandler, LazyQueueHandler, LogWriter, BatchedFileHandler, formatter
+
+KEY = "http://bench.example/static/app.js"
+CLIENT = ("127.0.0.1", 50000)
+
+
+def log_request(log):
+    # The lines the proxy logs for a cache hit
+    log.info("[+] New connection from %s", CLIENT)
+    log.info("[>] HTTP Request from %s to %s:%s for %s", CLIENT, "bench.example", 80, f"GET {KEY} HTTP/1.1")
+    log.info("[Cache HIT] %s%s", KEY, "")
+    log.debug("[Cache Key] Generated for %s -> %s", KEY, KEY)
+
+
+class RewritingDashHandler(logging.Handler):
+    """ The dashboard handler as it was: the last 50 lines file is rewritten on every matching record. """
+
+    def __init__(self, filename, max_logs=50):
+        super().__init__()
+        self.filename = filename
+        self.log_queue = deque(maxlen=max_logs)
+
+    def emit(self, record):
+        log_entry = self.format(record)
+        if DASH_PATTERN.search(log_entry):
+            self.log_queue.append(log_entry)
+            with open(self.filename, "w") as f:
+                for entry in self.log_queue:
+                    f.write(entry + "\n")
+
+
+def synchronous_logger(directory):
+    log = logging.getLogger("bench.synchronous")
+    for handler in (logging.FileHandler(os.path.join(directory, "sync.log")),
+                    RewritingDashHandler(os.path.join(directory, "sync_dash.log"))):
+        handler.setFormatter(formatter)
+        log.addHandler(handler)
+    return log, None
+
+
+def queued_logger(directory):
+    log = logging.getLogger("bench.queued")
+    handlers = [BatchedFileHandler(os.path.join(directory, "queued.log")),
+                DashLogHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    writer = LogWriter(handlers)
+    writer.start()
+    log.addHandler(LazyQueueHandler(writer.queue))
+    return log, writer
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    directory = tempfile.mkdtemp(prefix="bench_logging_")
+    for name, make in (("synchronous", synchronous_logger), ("queued", queued_logger)):
+        log, writer = make(directory)
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        start = time.perf_counter()
+        for _ in range(requests):
+            log_request(log)
+        elapsed = time.perf_counter() - start
+        if writer:
+            start = time.perf_counter()
+            writer.stop()
+            drained = time.perf_counter() - start
+            print(f"{name:>12}: {elapsed / requests * 1e6:6.1f} us per request on the caller "
+                  f"(writer drained the backlog {drained:.2f}s later)")
+        else:
+            print(f"{name:>12}: {elapsed / requests * 1e6:6.1f} us per request on the caller")
@@ -0,0 +1,43 @@
+"""
+Measures the per-request cost of the request head parser.
+
+Run from the repository root:
+    python -m benchmarks.bench_parser
+"""
+import time
+from http_parser import RequestParser
+
+REQUEST = (
+    b"GET http://example.com/static/js/app.min.js?v=1234 HTTP/1.1\r\n"
+    b"Host: example.com\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0\r\n"
+    b"Accept: */*\r\n"
+    b"Accept-Language: en-US,en;q=0.5\r\n"
+    b"Accept-Encoding: gzip, deflate\r\n"
+    b"Referer: http://example.com/index.html\r\n"
+    b"Cookie: session_id=abcdef0123456789; theme=dark; consent=1\r\n"
+    b"Proxy-Connection: keep-alive\r\n"
+    b"\r\n"
+)
+
+
+def bench(label, requests, read_size, rounds=20000):
+    stream = REQUEST * requests
+    reads = [stream[i:i + read_size] for i in range(0, len(stream), read_size)]
+    start = time.perf_counter()
+    for _ in range(rounds // requests):
+        parser = RequestParser()
+        for data in reads:
+            parser.feed(data)
+            while parser.next_request() is not None:
+                pass
+    elapsed = time.perf_counter() - start
+    per_request = elapsed / (rounds // requests * requests)
+    print(f"{label:<40} {per_request * 1e6:8.2f} us/request")
+
+
+if __name__ == "__main__":
+    bench("one request per read", 1, len(REQUEST))
+    bench("10 pipelined requests per read", 10, len(REQUEST) * 10)
+    bench("partial reads of 64 bytes", 1, 64)
+    bench("partial reads of 7 bytes", 1, 7)
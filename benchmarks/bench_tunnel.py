@@ -0,0 +1,71 @@
+"""
+Compares CONNECT tunnel relay throughput: copying through Python vs os.splice.
+Reports wall-clock MB/s and MB per CPU-second of the relay thread (MB/s per core).
+
+Run from the repository root:
+    python -m benchmarks.bench_tunnel [megabytes]
+"""
+import socket
+import sys
+import threading
+import time
+from tunnel import relay_copy, relay_splice, SPLICE_AVAILABLE
+
+
+def tcp_pair(listener):
+    left = socket.create_connection(listener.getsockname())
+    right, _ = listener.accept()
+    return left, right
+
+
+def bench(label, relay, megabytes):
+    listener = socket.create_server(("127.0.0.1", 0))
+    client, proxy_client = tcp_pair(listener)
+    proxy_server, server = tcp_pair(listener)
+    listener.close()
+    for sock in (proxy_client, proxy_server):
+        sock.settimeout(5)
+
+    cpu = {}
+
+    def run_relay():
+        start = time.thread_time()
+        relay(proxy_client, proxy_server, ("bench", 0), "bench")
+        cpu["seconds"] = time.thread_time() - start
+
+    def send():
+        block = b"\0" * (1 << 20)
+        for _ in range(megabytes):
+            client.sendall(block)
+        client.shutdown(socket.SHUT_WR)
+
+    relay_thread = threading.Thread(target=run_relay)
+    sender = threading.Thread(target=send)
+    start = time.perf_counter()
+    relay_thread.start()
+    sender.start()
+
+    received = 0
+    while received < megabytes << 20:
+        data = server.recv(1 << 20)
+        if not data:
+            break
+        received += len(data)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    relay_thread.join()
+    for sock in (client, proxy_client, proxy_server, server):
+        sock.close()
+
+    mb = received / (1 << 20)
+    per_core = mb / cpu["seconds"] if cpu.get("seconds") else float("inf")
+    print(f"{label:<8} {mb / elapsed:10.1f} MB/s wall {per_core:12.1f} MB/s per core")
+
+
+if __name__ == "__main__":
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    bench("copy", relay_copy, megabytes)
+    if SPLICE_AVAILABLE:
+        bench("splice", relay_splice, megabytes)
+    else:
+        print("splice   not available on this platform")
@@ -0,0 +1,58 @@
+"""
+Replays a request trace with raw URLs as cache keys and with the keys the
+configured normalization rules produce, and reports the hit ratio of each.
+
+The trace is a proxy log (the "[>] HTTP Request ... for GET" lines). Without
+one a synthetic trace is used: popular pages requested with tracking
+parameters and query strings in varying order, and static assets with
+cache-busting versions.
+
+Run from the repository root:
+    python -m benchmarks.sim_cache_key [trace]
+"""
+import random
+import re
+import sys
+from benchmarks.sim_cache_policy import simulate
+from cache_key import KeyNormalizer
+from config import CACHE_KEY_DROP_PARAMS, CACHE_KEY_STATIC_EXTENSIONS, CACHE_KEY_LOWERCASE_PATH
+
+LOG_REQUEST = re.compile(r"\[>\] HTTP Request from .* to (\S+) for GET (\S+) HTTP/")
+CACHE_FRACTIONS = (0.05, 0.25, 1.0)
+
+
+def read_trace(path):
+    with open(path, errors="replace") as f:
+        return [match.groups() for match in map(LOG_REQUEST.search, f) if match]
+
+
+def synthetic_trace(requests=100_000, pages=5_000, seed=1):
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) ** 0.9 for rank in range(pages)]
+    trace = []
+    for page in rng.choices(range(pages), weights, k=requests):
+        if page % 5 == 0:
+            trace.append(("shop.example", f"/static/app{page}.js?v={rng.randrange(3)}"))
+            continue
+        params = [f"id={page}", f"lang={page % 3}"]
+        if rng.random() < 0.4:
+            params.append(f"utm_source={rng.choice(['mail', 'ads', 'social'])}")
+        rng.shuffle(params)
+        trace.append(("shop.example", f"/item?{'&'.join(params)}"))
+    return trace
+
+
+if __name__ == "__main__":
+    requests = read_trace(sys.argv[1]) if len(sys.argv) > 1 else synthetic_trace()
+    if not requests:
+        raise SystemExit("No GET requests found in the trace")
+    normalizer = KeyNormalizer(CACHE_KEY_DROP_PARAMS, CACHE_KEY_STATIC_EXTENSIONS, CACHE_KEY_LOWERCASE_PATH)
+    raw = [(f"http://{host}{target}", 1) for host, target in requests]
+    normalized = [(normalizer.key(host, target)[0], 1) for host, target in requests]
+    print(f"{len(requests)} requests, {len(set(raw))} distinct URLs, {len(set(normalized))} distinct keys")
+    print(f"{'cache size':>12} {'raw':>7} {'normalized':>11}")
+    for fraction in CACHE_FRACTIONS:
+        # Entries, as a fraction of the distinct raw URLs
+        budget = max(int(len(set(raw)) * fraction), 1)
+        print(f"{fraction:>11.0%} {simulate(raw, 'lru', budget, 1, False):>7.3f} "
+              f"{simulate(normalized, 'lru', budget, 1, False):>11.3f}")
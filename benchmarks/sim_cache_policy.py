@@ -0,0 +1,89 @@
+"""
+Replays a request trace against each cache policy and reports hit ratios.
+
+The trace is either a proxy log (the [Cache HIT]/[Cache MISS]/... lines
+name the requested keys) or a file of "key [size]" lines. Without a trace a
+synthetic one is used: Zipf-distributed popular URLs with a crawler walking
+one-off URLs through the middle of it.
+
+Run from the repository root:
+    python -m benchmarks.sim_cache_policy [trace] [shards]
+"""
+import random
+import re
+import sys
+from cache import CacheShard
+from cache_policy import POLICIES
+
+# One line per request; REVALIDATED lines follow the STALE line of the same request
+LOG_REQUEST = re.compile(r"\[Cache (?:HIT|MISS|STALE|COALESCED)\] (\S+)")
+CACHE_FRACTIONS = (0.01, 0.05, 0.1, 0.25)
+
+
+class SimEntry:
+    """ Stands in for a response of the given size. """
+
+    __slots__ = ('size',)
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+def read_trace(path):
+    trace = []
+    with open(path, errors="replace") as f:
+        for line in f:
+            match = LOG_REQUEST.search(line)
+            if match:
+                trace.append((match.group(1), 1))
+            elif "[" not in line and line.strip():
+                key, _, size = line.strip().partition(" ")
+                trace.append((key, int(size) if size.strip().isdigit() else 1))
+    return trace
+
+
+def synthetic_trace(requests=200_000, popular=5_000, crawled=60_000, seed=1):
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) ** 0.9 for rank in range(popular)]
+    trace = []
+    crawl = iter(range(crawled))
+    for i, key in enumerate(rng.choices(range(popular), weights, k=requests)):
+        trace.append((f"http://site.example/page/{key}", 1))
+        # The crawler requests each of its URLs once, spread over the middle half of the trace
+        while requests // 4 <= i < requests * 3 // 4 and len(trace) - i < (i - requests // 4) * crawled // (requests // 2):
+            trace.append((f"http://site.example/crawl/{next(crawl)}", 1))
+    return trace
+
+
+def simulate(trace, policy, budget, shard_count, sized):
+    # Without sizes every entry counts as one byte, so the entry cap sizes the policy's sketch too
+    capacity = 0 if sized else budget // shard_count
+    shards = [CacheShard(capacity, budget // shard_count, POLICIES[policy]) for _ in range(shard_count)]
+    hits = 0
+    for key, size in trace:
+        shard = shards[hash(key) % shard_count]
+        if shard.lookup(key) is not None:
+            hits += 1
+        elif size <= shard.max_bytes:
+            shard.put(key, SimEntry(size))
+    return hits / len(trace)
+
+
+if __name__ == "__main__":
+    trace = read_trace(sys.argv[1]) if len(sys.argv) > 1 else synthetic_trace()
+    shard_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    if not trace:
+        raise SystemExit("No requests found in the trace")
+    # Budgets are a fraction of the bytes of all distinct keys, entries when the trace has no sizes
+    sizes = dict(trace)
+    total = sum(sizes.values())
+    sized = total > len(sizes)
+    print(f"{len(trace)} requests, {len(sizes)} distinct keys, {shard_count} shard(s)")
+    print(f"{'cache size':>12} " + " ".join(f"{name:>9}" for name in POLICIES))
+    for fraction in CACHE_FRACTIONS:
+        budget = max(int(total * fraction), shard_count)
+        ratios = [simulate(trace, name, budget, shard_count, sized) for name in POLICIES]
+        print(f"{fraction:>11.0%} " + " ".join(f"{ratio:>9.3f}" for ratio in ratios))
@@ -0,0 +1,96 @@
+import re
+from logger import logger
+from upstream import split_host_port
+
+# Rules that are just a domain, optionally with a path prefix ("example.com", "*.example.com", "example.com/ads").
+# A dotless word ("facebook") stays a regex: it has always blocked every host and URL containing it.
+PLAIN_RULE = re.compile(r"^(?:\*\.|\.)?((?:[a-z0-9-]+\.)+[a-z0-9-]+)(/[^\s*?+()\[\]{}|^$\\]*)?$", re.IGNORECASE)
+BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+class Blacklist:
+    """
+    Compiled blacklist. Plain domain rules go into a hash set and block the
+    domain and all its subdomains, found by looking up each suffix of the
+    host (a handful of set lookups however many rules there are). Domain
+    rules with a path also need the URL path to start with it. Everything
+    else is a regex, and all of them are combined into one alternation that
+    is searched, like before, in host + request target.
+    """
+
+    def __init__(self, rules):
+        self.domains = set()
+        self.paths = {}  # domain -> path prefixes blocked on it
+        patterns = []
+        for rule in rules:
+            match = PLAIN_RULE.match(rule.strip())
+            if match:
+                domain, path = match.group(1).lower(), match.group(2)
+                if path and path != '/':
+                    self.paths.setdefault(domain, []).append(path)
+                else:
+                    self.domains.add(domain)
+            else:
+                patterns.append(rule)
+        self.patterns = self._compile(patterns)
+        logger.debug(f"[Blacklist] {len(self.domains)} domains, {len(self.paths)} domains with paths, "
+                     f"{len(patterns)} regexes")
+
+    @staticmethod
+    def _compile(patterns):
+        """ One combined regex where possible; patterns that can't be combined are kept apart. """
+        combinable, separate = [], []
+        for pattern in patterns:
+            try:
+                compiled = re.compile(pattern)
+            except re.error as e:
+                logger.error(f"[Blacklist] Ignoring invalid pattern {pattern!r}: {e}")
+                continue
+            # Inline global flags can't be wrapped, numbered backreferences would point at other groups
+            # and a group name may be used by another pattern too
+            if BACKREFERENCE.search(pattern) or compiled.groupindex or not wrappable(pattern):
+                separate.append(compiled)
+            else:
+                combinable.append((pattern, compiled))
+        if combinable:
+            try:
+                separate.insert(0, re.compile("|".join(f"(?:{pattern})" for pattern, _ in combinable)))
+            except (re.error, OverflowError) as e:
+                logger.warning(f"[Blacklist] Could not combine the regexes, searching them one by one: {e}")
+                separate[:0] = [compiled for _, compiled in combinable]
+        return separate
+
+    def _suffixes(self, host):
+        """ host, then each parent domain: a.b.com, b.com, com. """
+        labels = host.split('.')
+        return ('.'.join(labels[i:]) for i in range(len(labels)))
+
+    def blocks(self, host, target=''):
+        """ Whether a request for target on host (a Host header or CONNECT address) is blocked. """
+        name = split_host_port(host)[0].lower().rstrip('.')
+        if self.domains and any(suffix in self.domains for suffix in self._suffixes(name)):
+            return True
+        if self.paths and target:
+            path = url_path(target)
+            for suffix in self._suffixes(name):
+                if any(path.startswith(prefix) for prefix in self.paths.get(suffix, ())):
+                    return True
+        text = f"{host}{target}"
+        return any(pattern.search(text) for pattern in self.patterns)
+
+
+def wrappable(pattern):
+    """ Whether a pattern still compiles when wrapped in a group of an alternation. """
+    try:
+        re.compile(f"(?:{pattern})|(?:)")
+        return True
+    except re.error:
+        return False
+
+
+def url_path(target):
+    """ The path (and query) of a request target, absolute ("http://host/x") or not ("/x"). """
+    if '://' in target:
+        start = target.find('/', target.find('://') + 3)
+        return target[start:] if start != -1 else '/'
+    return target
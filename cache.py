@@ -1,91 +1,718 @@
+import heapq
 import pickle
 import os
 import threading
+import time
 from collections import OrderedDict
-from config import CACHE_FILE, CACHE_LIMIT
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from config import (CACHE_FILE, CACHE_JOURNAL, CACHE_LIMIT, CACHE_MAX_BYTES, CACHE_MIN_OBJECT_SIZE,
+                    CACHE_MAX_OBJECT_SIZE, CACHE_FSYNC_INTERVAL, CACHE_SNAPSHOT_INTERVAL,
+                    DISK_CACHE_DIR, DISK_CACHE_MAX_BYTES, DISK_CACHE_MAX_OBJECT_SIZE, CACHE_DEFAULT_TTL,
+                    CACHE_STALE_WHILE_REVALIDATE, CACHE_STALE_IF_ERROR, CACHE_SHARDS, CACHE_POLICY,
+                    CACHE_COMPRESS_LEVEL, CACHE_VARY_IGNORE)
+from cache_key import VARIANT_SEPARATOR, split_variant, variant_key, vary_names
+from cache_policy import POLICIES, LRUPolicy, TYPICAL_ENTRY_SIZE
+from compression import gzip_response, is_compressible, is_gzipped
+from disk_cache import DiskCache
+from http_parser import parse_head, HttpParseError
+from journal import CacheJournal
 from logger import logger
-import re
-from urllib.parse import urlparse, parse_qs
+from reloader import settings_reloader
 
-class LRUCache:
-    def __init__(self, capacity=CACHE_LIMIT):
-        self.cache = OrderedDict()
+# URLs whose Vary headers are remembered; beyond this the oldest are forgotten and relearned on their next miss
+MAX_VARYING_URLS = 100_000
+
+# What cache entry listings can be sorted by, see LRUCache.describe(): (key, memory or disk entry) -> value
+SORT_VALUES = {
+    "key": lambda key, entry: key,
+    "size": lambda key, entry: entry.size,
+    "age": lambda key, entry: -entry.freshness.stored_at,  # Stored earlier is older
+    "hits": lambda key, entry: entry.hits,
+    "last_access": lambda key, entry: entry.last_access,
+    "expires_in": lambda key, entry: entry.freshness.stored_at + entry.freshness.ttl,
+}
+SORT_FIELDS = tuple(SORT_VALUES)
+
+# Statuses stored without explicit permission (RFC 9111 heuristically cacheable ones, minus error responses)
+CACHEABLE_STATUSES = {200, 203, 300, 301, 308}
+
+# A response spooled to the disk tier is written in batches of this many bytes
+SPOOL_WRITE_SIZE = 256 * 1024
+
+
+def parse_cache_control(value):
+    """ 'max-age=60, no-cache' -> {'max-age': '60', 'no-cache': True} """
+    directives = {}
+    for part in value.split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip().strip('"') if argument else True
+    return directives
+
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def parse_seconds(value):
+    return int(value) if isinstance(value, str) and value.isdigit() else 0
+
+
+def lifetime(cache_control, headers, now):
+    """ Freshness lifetime in seconds, from s-maxage, max-age, Expires or a Last-Modified heuristic. """
+    if 'no-cache' in cache_control:
+        return 0  # Stored, but revalidated before every use
+    date = parse_http_date(headers.get('date')) or now
+    if 's-maxage' in cache_control:
+        ttl = parse_seconds(cache_control['s-maxage'])
+    elif 'max-age' in cache_control:
+        ttl = parse_seconds(cache_control['max-age'])
+    elif 'expires' in headers:
+        expires = parse_http_date(headers['expires'])
+        ttl = expires - date if expires else 0
+    else:
+        # No explicit lifetime: 10% of the time since the last change, capped by the default TTL
+        last_modified = parse_http_date(headers.get('last-modified'))
+        ttl = min((date - last_modified) / 10, CACHE_DEFAULT_TTL) if last_modified else CACHE_DEFAULT_TTL
+    return max(ttl - parse_seconds(headers.get('age')), 0)
+
+
+def stale_windows(cache_control):
+    """ Seconds past expiry the response may be served while refreshing, and while the origin fails. """
+    if 'no-cache' in cache_control or 'must-revalidate' in cache_control or 'proxy-revalidate' in cache_control:
+        return 0, 0  # Never served stale
+    while_revalidate = cache_control.get('stale-while-revalidate', CACHE_STALE_WHILE_REVALIDATE)
+    if_error = cache_control.get('stale-if-error', CACHE_STALE_IF_ERROR)
+    return parse_seconds(str(while_revalidate)), parse_seconds(str(if_error))
+
+
+def apply_settings(settings):
+    """ Reloaded freshness defaults only apply to responses stored from now on. """
+    global CACHE_DEFAULT_TTL, CACHE_STALE_WHILE_REVALIDATE, CACHE_STALE_IF_ERROR
+    CACHE_DEFAULT_TTL = settings.CACHE_DEFAULT_TTL
+    CACHE_STALE_WHILE_REVALIDATE = settings.CACHE_STALE_WHILE_REVALIDATE
+    CACHE_STALE_IF_ERROR = settings.CACHE_STALE_IF_ERROR
+
+
+settings_reloader.subscribe(("cache_default_ttl", "cache_stale_while_revalidate", "cache_stale_if_error"),
+                            apply_settings)
+
+
+class Freshness:
+    """ How long a stored response may be served without asking the origin, and how to ask. """
+
+    __slots__ = ('stored_at', 'ttl', 'etag', 'last_modified', 'stale_while_revalidate', 'stale_if_error')
+
+    def __init__(self, stored_at, ttl, etag=None, last_modified=None, stale_while_revalidate=0, stale_if_error=0):
+        self.stored_at = stored_at
+        self.ttl = ttl
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+
+    @classmethod
+    def from_headers(cls, status, headers, now=None):
+        """ Returns None for responses a shared cache must not store (no-store, private, errors, Vary: *). """
+        now = time.time() if now is None else now
+        cache_control = parse_cache_control(headers.get('cache-control', ''))
+        if ('no-store' in cache_control or 'private' in cache_control or status not in CACHEABLE_STATUSES
+                or headers.get('vary', '').strip() == '*'):
+            return None
+        return cls(now, lifetime(cache_control, headers, now), headers.get('etag'), headers.get('last-modified'),
+                   *stale_windows(cache_control))
+
+    def is_fresh(self, now=None):
+        return self.usable(0, now)
+
+    def usable(self, stale_window, now=None):
+        """ Whether the response may still be served, up to stale_window seconds past its expiry. """
+        return (time.time() if now is None else now) < self.stored_at + self.ttl + stale_window
+
+    def conditional_headers(self):
+        """ Request header lines that let the origin answer 304 if the stored copy is still current. """
+        lines = []
+        if self.etag:
+            lines.append(f"If-None-Match: {self.etag}")
+        if self.last_modified:
+            lines.append(f"If-Modified-Since: {self.last_modified}")
+        return ''.join(f"{line}\r\n" for line in lines).encode('latin-1')
+
+    def state(self, now=None):
+        """ "fresh", "stale" (still served while it is refreshed or the origin fails) or "expired". """
+        if self.is_fresh(now):
+            return "fresh"
+        if self.usable(max(self.stale_while_revalidate, self.stale_if_error), now):
+            return "stale"
+        return "expired"
+
+    def refresh(self, headers, now=None):
+        """ Apply a 304 Not Modified: the stored copy is current again, for the lifetime the 304 gives. """
+        now = time.time() if now is None else now
+        if 'cache-control' in headers or 'expires' in headers:
+            cache_control = parse_cache_control(headers.get('cache-control', ''))
+            self.ttl = lifetime(cache_control, headers, now)
+            self.stale_while_revalidate, self.stale_if_error = stale_windows(cache_control)
+        self.stored_at = now
+        self.etag = headers.get('etag', self.etag)
+        self.last_modified = headers.get('last-modified', self.last_modified)
+
+
+class CacheEntry:
+    """
+    A raw response as stored in memory, with its freshness, whether its body
+    is gzipped, and how often and when it was last served from memory.
+    """
+
+    __slots__ = ('response', 'freshness', 'gzipped', 'hits', 'last_access')
+
+    def __init__(self, response, freshness, gzipped=False):
+        self.response = response
+        self.freshness = freshness
+        self.gzipped = gzipped
+        self.hits = 0
+        self.last_access = freshness.stored_at
+
+    def __len__(self):
+        return len(self.response)
+
+    @property
+    def size(self):
+        return len(self.response)
+
+    @classmethod
+    def from_response(cls, response, now=None, compress_level=0):
+        """
+        Parse the response head, returns None if the response may not be
+        stored. With a compress_level, text-like bodies are stored gzipped.
+        """
+        end = response.find(b'\r\n\r\n')
+        if end == -1:
+            return None
+        try:
+            lines, headers = parse_head(response[:end])
+        except HttpParseError:
+            return None
+        parts = lines[0].split(None, 2)
+        status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        freshness = Freshness.from_headers(status, headers, now)
+        if freshness is None:
+            return None
+        if compress_level and status == 200 and is_compressible(headers):
+            compressed = gzip_response(response, end, lines, headers, compress_level)
+            if compressed:
+                return cls(compressed, freshness, True)
+        return cls(response, freshness, is_gzipped(headers))
+
+
+class KeyLocks:
+    """
+    Per-key locks that only exist while some thread holds or waits for
+    them, so the table never grows past the number of keys in use.
+    """
+
+    def __init__(self):
+        self.locks = {}  # key -> [lock, threads holding or waiting for it]
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        with self.lock:
+            slot = self.locks.get(key)
+            if slot is None:
+                slot = self.locks[key] = [threading.Lock(), 0]
+            slot[1] += 1
+        try:
+            with slot[0]:
+                yield
+        finally:
+            with self.lock:
+                slot[1] -= 1
+                if not slot[1]:
+                    del self.locks[key]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.locks)
+
+
+class CacheShard:
+    """
+    One independently locked segment of the cache, with its own LRU order,
+    share of the budget and admission policy. The caller holds self.lock
+    around lookup(), put() and evict().
+    """
+
+    def __init__(self, capacity, max_bytes, policy=LRUPolicy):
+        self.entries = OrderedDict()
         self.capacity = capacity
-        self.lock = threading.Lock()  # Global lock for cache operations
-        self.key_locks = {}           # Dictionary of per-key locks
-        self.key_locks_lock = threading.Lock()  # Lock for managing key_locks dict
+        self.max_bytes = max_bytes
+        self.policy = policy(capacity or max_bytes // TYPICAL_ENTRY_SIZE)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+        self.not_admitted = 0
+        self.lock = threading.Lock()
+        self.key_locks = KeyLocks()
+
+    def lookup(self, key):
+        """ Return the entry for key and mark it recently used, or None. """
+        self.policy.record(key)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """ Insert or replace an entry, returning the evicted (key, value) pairs, or None if the policy turned it away. """
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old)
+        elif not self.policy.admit(self, key, len(entry)):
+            self.not_admitted += 1
+            return None
+        self.entries[key] = entry
+        self.bytes += len(entry)
+        return self.evict()
+
+    def remove(self, key):
+        """ Drop the entry for key, returning it, or None if there was none. """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry)
+        return entry
+
+    def victims(self, size):
+        """ Keys that evict() would drop to make room for a new entry of size bytes, oldest first. """
+        excess_bytes = self.bytes + size - self.max_bytes
+        excess_entries = len(self.entries) + 1 - self.capacity if self.capacity else 0
+        victims = []
+        for key, value in self.entries.items():
+            if excess_bytes <= 0 and excess_entries <= 0:
+                break
+            victims.append(key)
+            excess_bytes -= len(value)
+            excess_entries -= 1
+        return victims
+
+    def evict(self):
+        """
+        Drop least recently used entries until the byte budget and entry cap
+        hold, returning them as (key, value) pairs.
+        """
+        evicted = []
+        while self.entries and (self.bytes > self.max_bytes or 0 < self.capacity < len(self.entries)):
+            key, value = self.entries.popitem(last=False)
+            self.bytes -= len(value)
+            self.evictions += 1
+            evicted.append((key, value))
+        return evicted
+
+
+class CacheFill:
+    """
+    Collects a response for the cache while it is relayed. Up to the memory
+    tier's per-entry limit it is held in RAM; a bigger one is spooled into a
+    disk tier blob as it arrives, so no response held for the cache is ever
+    bigger than what memory would store. Call finish() once the response is
+    over, or abort() to throw it away.
+    """
+
+    def __init__(self, cache, key, request_headers):
+        self.cache = cache
+        self.key = key
+        self.request_headers = request_headers
+        self.chunks = []
+        self.held = 0  # Bytes in chunks
+        self.blob = None  # BlobWriter, once the response is spooled to disk
+        self.keeping = True
+        self.stored = False  # Whether finish() stored it
+        self.response = None  # The complete response, once finished, if it was held in memory
+
+    def writes_disk(self, size, content_length=None):
+        """ Whether feeding size more bytes writes to disk, so the event loop can hand the call to a thread. """
+        limit = SPOOL_WRITE_SIZE if self.blob else self.cache.max_object_size
+        return self.keeping and (self.held + size > limit or (not self.blob and (content_length or 0) > limit))
+
+    def feed(self, data, content_length=None):
+        """ Take the next relayed bytes, returns False once the response can't be cached. """
+        if not self.keeping:
+            return False
+        self.chunks.append(bytes(data))
+        self.held += len(data)
+        if self.blob:
+            if self.held >= SPOOL_WRITE_SIZE:
+                self._write()
+        elif self.held > self.cache.max_object_size or (content_length or 0) > self.cache.max_object_size:
+            disk = self.cache.disk
+            if disk is None or (content_length or 0) > disk.max_object_size:
+                self.abort()
+                return False
+            self.chunks = [b''.join(self.chunks)]
+            self.blob = self.cache.spool(self.key, self.chunks[0], self.request_headers)
+            if self.blob is None:
+                self.abort()
+                return False
+            self._write()
+        return self.keeping
+
+    def _write(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.held = 0
+        if not self.blob.write(data):
+            self.abort()
+
+    def finish(self, complete):
+        """
+        Store the response if it arrived complete. Returns it if it was
+        stored under the key itself and can be shared from memory with
+        requests waiting on the key, else None (see stored).
+        """
+        if not self.keeping or not complete:
+            self.abort()
+            return None
+        self.keeping = False
+        if self.blob:
+            self._write()
+            self.stored = self.blob.file is not None and self.cache.store_spooled(self.blob)
+            return None
+        self.response = b''.join(self.chunks)
+        self.chunks = []
+        stored_key = self.cache.set(self.key, self.response, self.request_headers)
+        self.stored = stored_key is not None
+        return self.response if stored_key == self.key else None
+
+    def abort(self):
+        """ Stop keeping the response. Safe to call at any point, and more than once. """
+        self.keeping = False
+        self.chunks = []
+        if self.blob:
+            self.blob.abort()
+
+
+class LRUCache:
+    """
+    LRU cache of raw responses bounded by total bytes (and optionally by entry
+    count). Inserting a large response evicts as many old ones as it takes.
+    Each entry carries the freshness its headers allow; serving or
+    revalidating stale entries is up to the caller.
+
+    Keys are spread over shards that each have their own lock, LRU order and
+    an equal share of the budgets, so lookups of different keys rarely wait
+    for each other. Eviction is least recently used within a shard; the
+    policy (see cache_policy.py) decides which new responses are admitted.
+
+    With a disk tier, entries evicted from memory are demoted to disk,
+    responses too big for memory go straight there, and disk entries that
+    keep getting hits are promoted back into memory.
+    """
+
+    def __init__(self, capacity=CACHE_LIMIT, max_bytes=CACHE_MAX_BYTES,
+                 min_object_size=CACHE_MIN_OBJECT_SIZE, max_object_size=CACHE_MAX_OBJECT_SIZE, shards=CACHE_SHARDS,
+                 policy=CACHE_POLICY, compress_level=CACHE_COMPRESS_LEVEL, vary_ignore=CACHE_VARY_IGNORE):
+        self.capacity = capacity      # Entry cap, 0 means only the byte budget applies
+        self.max_bytes = max_bytes
+        self.min_object_size = min_object_size
+        self.compress_level = compress_level  # 0 stores responses as they came
+        self.vary_ignore = {name.lower() for name in vary_ignore}
+        self.variants = {}  # URL key -> names of the request headers its response varies on
+        self.variants_lock = threading.Lock()
+        max_object_size = min(max_object_size, max_bytes)
+        # Never so many shards that the largest response no longer fits in one
+        count = max(1, min(shards, max_bytes // max(max_object_size, 1)))
+        if policy not in POLICIES:
+            logger.error(f"Unknown cache policy {policy!r}, using lru")
+            policy = "lru"
+        self.policy = policy
+        self.shards = [CacheShard(-(-capacity // count), max_bytes // count, POLICIES[policy]) for _ in range(count)]
+        self.max_object_size = min(max_object_size, max_bytes // count)
+        self.disk = DiskCache(DISK_CACHE_DIR, DISK_CACHE_MAX_BYTES, DISK_CACHE_MAX_OBJECT_SIZE) \
+            if DISK_CACHE_MAX_BYTES > 0 else None
+        # Largest response either tier stores
+        self.max_cacheable_size = max(self.max_object_size, self.disk.max_object_size if self.disk else 0)
+        self.journal = CacheJournal(CACHE_FILE, CACHE_JOURNAL, self._snapshot, CACHE_FSYNC_INTERVAL,
+                                    CACHE_SNAPSHOT_INTERVAL, compact_bytes=max_bytes)
         self.load()
 
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def variant_key(self, key, request_headers):
+        """ The key a request for the URL key is looked up under: its own, or its variant's if the URL varies. """
+        names = self.variants.get(key)
+        return variant_key(key, names, request_headers) if names else key
+
+    def _learn_variants(self, key, names):
+        with self.variants_lock:
+            if not names:
+                self.variants.pop(key, None)
+                return
+            if key not in self.variants and len(self.variants) >= MAX_VARYING_URLS:
+                del self.variants[next(iter(self.variants))]
+            self.variants[key] = names
+
     def get(self, key):
-        clean_key = self.clean_cache_key(key)
-        with self.lock:
-            if clean_key in self.cache:
-                self.cache.move_to_end(clean_key)
-                logger.info(f"Cache hit for key: {key}")
-                return self.cache[clean_key]
-            logger.info(f"Cache miss for key: {key}")
+        """ Return the CacheEntry held in memory, fresh or not, or None. """
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.lookup(key)
+            if entry is not None:
+                entry.hits += 1
+                entry.last_access = time.time()
+            return entry
+
+    def open_disk(self, key):
+        """ Look a memory miss up on disk, returning (file, entry) to send from, or None. """
+        if self.disk is None:
             return None
+        return self.disk.open(key)
 
-    def set(self, key, value):
-        clean_key = self.clean_cache_key(key)
+    def promote(self, key, f, entry, gzipped):
+        """ Copy a disk entry that keeps getting hits into memory; the disk copy stays. """
+        if not self.disk.should_promote(entry, self.max_object_size):
+            return
+        self._insert(key, CacheEntry(self.disk.read(f, entry), entry.freshness, gzipped))
+        self.disk.record_promotion()
+
+    def revalidate(self, key, stale, headers):
+        """ The origin answered 304 for a stale memory or disk entry, so it is fresh again. """
+        stale.freshness.refresh(headers)
+        if isinstance(stale, CacheEntry):
+            shard = self._shard(key)
+            with shard.lock:
+                if shard.entries.get(key) is stale:
+                    self.journal.record_set(key, stale)
+
+    def set(self, key, value, request_headers=None):
+        """
+        Store a complete response if its status and headers allow it. A
+        response with a Vary header is stored as the variant for the
+        request_headers it was fetched with. Returns the key it was stored
+        under, or None.
+        """
+        shard = self._shard(key)
+        size = len(value)
+        entry = None
+        if self.min_object_size <= size <= self.max_cacheable_size:
+            entry = CacheEntry.from_response(value, compress_level=self.compress_level)
+        if entry is None:
+            logger.debug("Not caching %s: %d bytes, or its headers forbid storing it", key, size)
+            with shard.lock:
+                shard.rejected += 1
+            return None
+
+        stored_key = self._stored_key(key, entry.response, request_headers)
 
         # Ensure only one thread sets this particular key
-        lock = self._get_key_lock(clean_key)
+        shard = self._shard(stored_key)
+        with shard.key_locks.hold(stored_key):
+            if len(entry) > self.max_object_size:
+                # Too big for memory but not for the disk tier
+                self._drop_from_memory(stored_key)
+                self.disk.put(stored_key, entry.response, entry.freshness)
+            else:
+                logger.debug("Setting cache for key: %s (%d bytes)", stored_key, len(entry))
+                if self.disk:
+                    # A new response replaces whatever older copy was demoted
+                    self.disk.discard(stored_key)
+                self._insert(stored_key, entry)
+        return stored_key
 
-        with lock:
-            # Re-check inside the per-key lock to prevent duplication
-            with self.lock:
-                if clean_key in self.cache:
-                    logger.info(f"Another thread already set the cache for key: {clean_key}")
-                    self.cache.move_to_end(clean_key)
-                    return
+    def _stored_key(self, key, response, request_headers):
+        """ The key a response fetched for key is stored under: its variant for request_headers if it has a Vary. """
+        url_key = split_variant(key)[0]
+        names = vary_names(parse_head(response[:response.find(b'\r\n\r\n')])[1], self.vary_ignore)
+        self._learn_variants(url_key, names)
+        return variant_key(url_key, names, request_headers or {}) if names else url_key
 
-            logger.info(f"Setting cache for key: {clean_key} with value: {value}")
-            
-            with self.lock:
-                self.cache[clean_key] = value
-                self.cache.move_to_end(clean_key)
+    def _drop_from_memory(self, key):
+        """ An older copy left in memory would be found before the disk one and hide it. Caller holds the key lock. """
+        shard = self._shard(key)
+        with shard.lock:
+            if shard.remove(key) is not None:
+                self.journal.record_delete(key)
 
-                if len(self.cache) > self.capacity:
-                    self.cache.popitem(last=False)
+    def fill(self, key, request_headers=None):
+        """ A CacheFill that stores the response fetched for key as it is relayed. """
+        return CacheFill(self, key, request_headers)
 
-                self.save()
+    def spool(self, key, response, request_headers=None):
+        """
+        A BlobWriter for a response too big for memory, given its first bytes
+        (at least the whole head). None if its status and headers don't allow
+        storing it or the disk tier can't take it.
+        """
+        entry = CacheEntry.from_response(response)
+        if entry is None:
+            logger.debug("Not caching %s: its headers forbid storing it", key)
+            shard = self._shard(key)
+            with shard.lock:
+                shard.rejected += 1
+            return None
+        return self.disk.writer(self._stored_key(key, response, request_headers), entry.freshness)
+
+    def store_spooled(self, blob):
+        """ Put a completely spooled response in place, replacing whatever copy its key had. """
+        shard = self._shard(blob.key)
+        with shard.key_locks.hold(blob.key):
+            self._drop_from_memory(blob.key)
+            return blob.commit()
+
+    def _insert(self, key, entry):
+        shard = self._shard(key)
+        with shard.lock:
+            evicted = shard.put(key, entry)
+            if evicted is None:
+                return  # Not popular enough to displace what the shard holds
+
+            # Persisted in the background, readers never wait for the disk. Queued under the
+            # lock so the journal sees changes to a key in the same order as the cache.
+            self.journal.record_set(key, entry)
+            for evicted_key, _ in evicted:
+                self.journal.record_delete(evicted_key)
+        self._demote(evicted)
+
+    def _demote(self, evicted):
+        if self.disk is None:
+            return
+        for key, entry in evicted:
+            if key not in self.disk:  # Promoted entries still have their disk copy
+                self.disk.put(key, entry.response, entry.freshness, demoted=True)
+
+    def _snapshot(self):
+        entries = OrderedDict()
+        for shard in self.shards:
+            with shard.lock:
+                entries.update(shard.entries)
+        return entries
 
-    def _get_key_lock(self, key):
-        """ Get or create a lock specific to this cache key. """
-        with self.key_locks_lock:
-            if key not in self.key_locks:
-                self.key_locks[key] = threading.Lock()
-            return self.key_locks[key]
+    def describe(self, prefix='', sort="last_access", descending=True, offset=0, limit=100, now=None):
+        """
+        One page of the entries whose keys start with prefix, from both tiers,
+        as (total matching, list of metadata dicts). Only metadata is read,
+        never a body. Each shard is locked just while its own candidates for
+        the page are picked, and only those are merged and ordered.
+        """
+        now = time.time() if now is None else now
+        value = SORT_VALUES[sort]
+        select = heapq.nlargest if descending else heapq.nsmallest
+        end = offset + limit
+        total = 0
+        candidates = []
+
+        def pick(items, tier):
+            return [(key, entry, tier) for key, entry in select(end, items, key=lambda item: value(*item))]
+
+        for shard in self.shards:
+            with shard.lock:
+                items = shard.entries.items()
+                if prefix:
+                    items = [(key, entry) for key, entry in items if key.startswith(prefix)]
+                total += len(items)
+                candidates += pick(items, "memory")
+        if self.disk:
+            # A promoted entry keeps its disk copy, list it once, as the memory entry that is served
+            items = [(key, entry) for key, entry in self.disk.items(prefix) if key not in self._shard(key).entries]
+            total += len(items)
+            candidates += pick(items, "disk")
+
+        page = select(end, candidates, key=lambda candidate: value(candidate[0], candidate[1]))[offset:]
+        return total, [{
+            "key": key,
+            "tier": tier,
+            "size": entry.size,
+            "age": round(now - entry.freshness.stored_at, 1),
+            "hits": entry.hits,
+            "last_access": round(entry.last_access, 1),
+            "freshness": entry.freshness.state(now),
+            "expires_in": round(entry.freshness.stored_at + entry.freshness.ttl - now, 1),
+        } for key, entry, tier in page]
+
+    def stats(self):
+        totals = dict.fromkeys(("entries", "bytes", "hits", "misses", "evictions", "rejected", "not_admitted"), 0)
+        key_locks = 0
+        for shard in self.shards:
+            with shard.lock:
+                totals["entries"] += len(shard.entries)
+                totals["bytes"] += shard.bytes
+                totals["hits"] += shard.hits
+                totals["misses"] += shard.misses
+                totals["evictions"] += shard.evictions
+                totals["rejected"] += shard.rejected
+                totals["not_admitted"] += shard.not_admitted
+            key_locks += len(shard.key_locks)
+        totals.update(max_bytes=self.max_bytes, shards=len(self.shards), policy=self.policy, key_locks=key_locks,
+                      varying_urls=len(self.variants), disk=self.disk.stats() if self.disk else None)
+        return totals
 
     def save(self):
+        """ Write a full snapshot now; normally the journal does this in the background. """
         try:
-            with open(CACHE_FILE, 'wb') as f:
-                pickle.dump(self.cache, f)
+            self.journal.write_snapshot(self._snapshot())
         except Exception as e:
             logger.error(f"Failed to save cache: {e}")
 
     def load(self):
-        if os.path.exists(CACHE_FILE):
+        # The shared snapshot and those of prefork workers, merged with the newest copy of each entry winning
+        entries = OrderedDict()
+        snapshots = self.journal.snapshot_paths()
+        for path in snapshots:
             try:
-                with open(CACHE_FILE, 'rb') as f:
-                    self.cache = pickle.load(f)
-                    if not isinstance(self.cache, OrderedDict):
-                        logger.error("Loaded cache is not an OrderedDict, initializing a new one.")
-                        self.cache = OrderedDict()
+                with open(path, 'rb') as f:
+                    loaded = pickle.load(f)
+                if not isinstance(loaded, OrderedDict):
+                    logger.error(f"Cache snapshot {path} is not an OrderedDict, ignoring it.")
+                    continue
             except Exception as e:
-                logger.error(f"Failed to load cache: {e}")
-                self.cache = OrderedDict()
-        else:
+                logger.error(f"Failed to load cache snapshot {path}: {e}")
+                continue
+            for key, value in loaded.items():
+                entries[key] = value
+                entries.move_to_end(key)
+        if not snapshots:
             logger.info("Cache file does not exist, starting with an empty cache.")
 
-    def clean_cache_key(self, path):
-        parsed_url = urlparse(path)
-        query_params = parse_qs(parsed_url.query)
-        pattern = re.compile(r'([&?])(?:utm_source|session_id|ref)=[^&]*(&|$)')
-        normalized_path = pattern.sub(r'\1', parsed_url.path)
-        sorted_query = sorted(query_params.items())
-        normalized_query = '&'.join([f"{key}={value[0]}" for key, value in sorted_query])
-        if normalized_query:
-            normalized_path += '?' + normalized_query
-        return f"{parsed_url.scheme}://{parsed_url.netloc}{normalized_path}"
+        # Changes made after the last snapshot are still in the journals
+        replayed, journals = self.journal.recover(entries)
+        for key, value in entries.items():
+            if isinstance(value, bytes) or not hasattr(value, 'gzipped'):
+                # Written by an older version, judge the response by its headers now
+                value = CacheEntry.from_response(getattr(value, 'response', value))
+                if value is None:
+                    continue
+            elif not hasattr(value, 'hits'):
+                value.hits = 0
+                value.last_access = value.freshness.stored_at
+            shard = self._shard(key)
+            shard.entries[key] = value
+            shard.bytes += len(value)
+
+        # Which URLs vary is not stored as such, the variant keys tell
+        stored_keys = list(entries) + (self.disk.keys() if self.disk else [])
+        for key in stored_keys:
+            if VARIANT_SEPARATOR in key:
+                self._learn_variants(*split_variant(key))
+
+        # The file may have been written under a bigger budget or with fewer shards
+        trimmed = []
+        for shard in self.shards:
+            trimmed += shard.evict()
+        self._demote(trimmed)
+        worker_snapshots = [path for path in snapshots if path != CACHE_FILE]
+        if journals or trimmed or worker_snapshots:
+            loaded = sum(len(shard.entries) for shard in self.shards)
+            logger.info(f"Recovered {replayed} journaled cache changes from {len(journals)} journals and "
+                        f"{len(snapshots)} snapshots, {loaded} entries loaded")
+            self.save()
+            for path in journals + worker_snapshots:
+                os.remove(path)
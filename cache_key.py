@@ -0,0 +1,103 @@
+import fnmatch
+import re
+import threading
+from urllib.parse import quote, urlsplit
+from upstream import split_host_port
+
+# Separates a URL's key from the request header values of one of its Vary variants
+VARIANT_SEPARATOR = '#'
+
+# Content codings a stored response can be served in to any client (see handler.for_client)
+SERVABLE_ENCODINGS = ('', 'identity', 'gzip')
+
+
+class KeyNormalizer:
+    """
+    Turns a request into its cache key in one pass, so URLs that only differ
+    in ways the origin ignores share an entry: the host is lowercased and
+    loses its default port, query parameters are sorted and the ones that
+    match drop_params (fnmatch patterns such as "utm_*") are removed, the
+    query is dropped entirely for static assets, and the path is optionally
+    case folded. Everything is compiled once, when the rules are loaded.
+    """
+
+    def __init__(self, drop_params=(), static_extensions=(), lowercase_path=False):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rewritten = 0
+        self.rewritten_hits = 0
+        self.configure(drop_params, static_extensions, lowercase_path)
+
+    def configure(self, drop_params, static_extensions, lowercase_path):
+        """ Compile the rules; also how reloaded rules are applied, keeping the counters. """
+        patterns = [fnmatch.translate(pattern.lower()) for pattern in drop_params]
+        self.drop_param = re.compile('|'.join(patterns)).match if patterns else None
+        self.static_extensions = frozenset(extension.lower().lstrip('.') for extension in static_extensions)
+        self.lowercase_path = lowercase_path
+
+    def key(self, host, target):
+        """ Returns (key, rewritten): whether the key differs from the URL as requested. """
+        name, port = split_host_port(host.lower())
+        authority = f"[{name}]" if ':' in name else name
+        if port != 80:
+            authority += f":{port}"
+        url = urlsplit(target)
+        path = url.path or '/'
+        if self.lowercase_path:
+            path = path.lower()
+        key = f"http://{authority}{path}"
+
+        query = url.query
+        if query and path.rpartition('.')[2].lower() not in self.static_extensions:
+            params = [param for param in query.split('&') if param]
+            if self.drop_param:
+                params = [param for param in params if not self.drop_param(param.partition('=')[0].lower())]
+            if params:
+                # By name only, repeated parameters keep their order
+                key += '?' + '&'.join(sorted(params, key=lambda param: param.partition('=')[0]))
+
+        requested = f"http://{host.lower()}{url.path or '/'}{'?' + query if query else ''}"
+        rewritten = key != requested
+        with self.lock:
+            self.requests += 1
+            self.rewritten += rewritten
+        return key, rewritten
+
+    def record_hit(self, rewritten):
+        """ Count a lookup that found a stored response; the ones for rewritten keys are what normalization won. """
+        if rewritten:
+            with self.lock:
+                self.rewritten_hits += 1
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "rewritten": self.rewritten, "rewritten_hits": self.rewritten_hits}
+
+
+def vary_names(headers, ignore=()):
+    """
+    The request headers a response varies on, as the cache keeps them apart.
+    Accept-Encoding is left out when the body is stored in a coding every
+    client can be served (gzip is decompressed for the ones that don't take
+    it), and so are the ignore headers, whose Vary the operator chose to
+    overlook.
+    """
+    names = {name.strip().lower() for name in headers.get('vary', '').split(',')} - {''} - set(ignore)
+    if headers.get('content-encoding', '').strip().lower() in SERVABLE_ENCODINGS:
+        names.discard('accept-encoding')
+    return tuple(sorted(names))
+
+
+def variant_key(key, names, request_headers):
+    """ The key of the variant of key that a request with these headers gets, e.g. key#accept-language=en. """
+    values = []
+    for name in names:
+        value = ','.join(part.strip() for part in request_headers.get(name, '').split(','))
+        values.append(f"{name}={quote(value, safe=',;=/*')}")
+    return f"{key}{VARIANT_SEPARATOR}{'&'.join(values)}"
+
+
+def split_variant(key):
+    """ (key of the URL, names of the headers its variant is for), the inverse of variant_key(). """
+    key, _, values = key.partition(VARIANT_SEPARATOR)
+    return key, tuple(value.partition('=')[0] for value in values.split('&')) if values else ()
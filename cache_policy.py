@@ -0,0 +1,95 @@
+# Count-min sketch rows, and counters per key expected in a shard
+SKETCH_DEPTH = 4
+SKETCH_COUNTERS_PER_ENTRY = 8
+SKETCH_MIN_WIDTH = 1024
+MAX_COUNT = 15  # 4-bit counters, like TinyLFU
+
+# Response size assumed when sizing a sketch for a shard that only has a byte budget
+TYPICAL_ENTRY_SIZE = 16 * 1024
+
+
+class CountMinSketch:
+    """
+    Approximate access counts in a fixed amount of memory. Counters saturate
+    at MAX_COUNT and are all halved once sample_size accesses were recorded,
+    so the counts follow recent popularity instead of growing forever.
+    """
+
+    def __init__(self, width):
+        self.width = 1 << max(width - 1, 1).bit_length()  # Power of two, so an index is a mask away
+        self.mask = self.width - 1
+        self.rows = [bytearray(self.width) for _ in range(SKETCH_DEPTH)]
+        self.sample_size = self.width * 10
+        self.additions = 0
+
+    def _indexes(self, key):
+        # Double hashing: the row indexes come from two halves of one hash
+        h = hash(key)
+        low, high = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(low + i * high) & self.mask for i in range(SKETCH_DEPTH)]
+
+    def add(self, key):
+        indexes = self._indexes(key)
+        smallest = min(row[index] for row, index in zip(self.rows, indexes))
+        if smallest < MAX_COUNT:
+            # Conservative update: only the counters that hold the estimate grow
+            for row, index in zip(self.rows, indexes):
+                if row[index] == smallest:
+                    row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self._age()
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+    def _age(self):
+        self.rows = [bytearray(count >> 1 for count in row) for row in self.rows]
+        self.additions //= 2
+
+
+class LRUPolicy:
+    """
+    Shards keep their entries in LRU order whatever the policy; a policy
+    decides whether a new key is worth the entries evicted to make room for
+    it. This one admits everything.
+    """
+
+    name = "lru"
+
+    def __init__(self, expected_entries=0):
+        pass
+
+    def record(self, key):
+        """ Called on every lookup of key, hit or miss. """
+
+    def admit(self, shard, key, size):
+        """ Whether a new entry of size bytes may evict what the shard would evict for it. """
+        return True
+
+
+class TinyLFUPolicy(LRUPolicy):
+    """
+    TinyLFU admission in front of LRU eviction: a new key only gets in if
+    it was looked up more often, recently, than every entry it would evict.
+    A crawler walking one-off URLs can no longer flush popular responses,
+    since a URL seen once never beats an entry that keeps getting hits.
+    """
+
+    name = "tinylfu"
+
+    def __init__(self, expected_entries=0):
+        self.sketch = CountMinSketch(max(expected_entries * SKETCH_COUNTERS_PER_ENTRY, SKETCH_MIN_WIDTH))
+
+    def record(self, key):
+        self.sketch.add(key)
+
+    def admit(self, shard, key, size):
+        victims = shard.victims(size)
+        if not victims:
+            return True
+        frequency = self.sketch.estimate(key)
+        return all(frequency > self.sketch.estimate(victim) for victim in victims)
+
+
+POLICIES = {policy.name: policy for policy in (LRUPolicy, TinyLFUPolicy)}
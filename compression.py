@@ -0,0 +1,90 @@
+import gzip
+from http_parser import parse_head, parse_content_length
+
+# Content types worth compressing; images, video and archives are compressed already
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/x-javascript', 'application/json',
+                      'application/xml', 'application/xhtml+xml', 'image/svg+xml')
+COMPRESSIBLE_SUFFIXES = ('+json', '+xml')
+
+# Bodies smaller than this barely shrink, and the gzip header eats most of the gain
+MIN_COMPRESS_SIZE = 256
+
+# Framing headers rewritten when a body is compressed or decompressed
+FRAMING_HEADERS = {b'content-length', b'content-encoding', b'transfer-encoding'}
+
+
+def accepts_gzip(accept_encoding):
+    """ Whether an Accept-Encoding value allows gzip (explicitly or through *) with a non-zero q. """
+    accepted = {}
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.partition(';')
+        q = 1.0
+        name, _, value = params.strip().partition('=')
+        if name.strip() == 'q':
+            try:
+                q = float(value)
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip()] = q
+    return accepted.get('gzip', accepted.get('*', 0)) > 0
+
+
+def is_gzipped(headers):
+    """ Whether a response body is gzip-encoded in a form gunzip_response() can undo. """
+    return (headers.get('content-encoding', '').strip().lower() == 'gzip'
+            and 'chunked' not in headers.get('transfer-encoding', '').lower())
+
+
+def is_compressible(headers):
+    """ Whether an unencoded response has a text-like content type. """
+    if headers.get('content-encoding', 'identity').strip().lower() != 'identity':
+        return False
+    content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) or content_type.endswith(COMPRESSIBLE_SUFFIXES)
+
+
+def _with_body(lines, body, extra):
+    """ Rebuild a response around a new body, with fresh framing headers. """
+    kept = [lines[0]] + [line for line in lines[1:]
+                         if line.split(b':', 1)[0].strip().lower() not in FRAMING_HEADERS]
+    kept += extra + [b'Content-Length: %d' % len(body)]
+    return b'\r\n'.join(kept) + b'\r\n\r\n' + body
+
+
+def gzip_response(response, head_end, lines, headers, level):
+    """
+    Return the response with its body gzipped, or None if it is chunked or
+    would not shrink. head_end is where the blank line after the head starts.
+    """
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        return None
+    body = response[head_end + 4:]
+    if 'content-length' in headers:
+        body = body[:parse_content_length(headers['content-length'])]
+    if len(body) < MIN_COMPRESS_SIZE:
+        return None
+    compressed = gzip.compress(body, level, mtime=0)
+    if len(compressed) >= len(body):
+        return None
+
+    extra = [b'Content-Encoding: gzip']
+    vary = headers.get('vary', '')
+    if 'accept-encoding' not in vary.lower():
+        lines = [line for line in lines if not line.lower().startswith(b'vary:')]
+        extra.append(f"Vary: {vary + ', ' if vary else ''}Accept-Encoding".encode('latin-1'))
+    etag = headers.get('etag', '')
+    if etag.startswith('"'):
+        # The bytes differ from the origin's, so the validator can only be weak
+        lines = [line for line in lines if not line.lower().startswith(b'etag:')]
+        extra.append(f"ETag: W/{etag}".encode('latin-1'))
+    return _with_body(lines, compressed, extra)
+
+
+def gunzip_response(response):
+    """ Return a gzip-encoded response with its body decompressed, for clients that don't accept gzip. """
+    end = response.find(b'\r\n\r\n')
+    lines, headers = parse_head(response[:end])
+    body = response[end + 4:]
+    if 'content-length' in headers:
+        body = body[:parse_content_length(headers['content-length'])]
+    return _with_body(lines, gzip.decompress(body), [])
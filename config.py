@@ -1,13 +1,107 @@
 import json
-import re
 
-with open("settings.json") as f:
+SETTINGS_FILE = "settings.json"
+
+with open(SETTINGS_FILE) as f:
     config = json.load(f)
 
 PROXY_HOST = config.get("host", "127.0.0.1")
 PROXY_PORT = config.get("port", 8888)
 CACHE_FILE = "cache.pkl"
-CACHE_LIMIT = config.get("cache_limit", 50)
+CACHE_JOURNAL = "cache.journal"
+
+# Cache persistence: changes are journaled in the background and fsynced at most this many seconds apart
+# (0 = after every batch), then compacted into CACHE_FILE every snapshot interval
+CACHE_FSYNC_INTERVAL = config.get("cache_fsync_interval", 1)
+CACHE_SNAPSHOT_INTERVAL = config.get("cache_snapshot_interval", 300)
+
+# In-memory cache budget: total response bytes, optional entry cap (0 = none) and per-response size bounds
+CACHE_MAX_BYTES = config.get("cache_max_bytes", 64 * 1024 * 1024)
+CACHE_LIMIT = config.get("cache_limit", 0)
+CACHE_MIN_OBJECT_SIZE = config.get("cache_min_object_size", 0)
+CACHE_MAX_OBJECT_SIZE = config.get("cache_max_object_size", 1_000_000)
+
+# Independently locked segments of the in-memory cache, each with an equal share of the budget
+CACHE_SHARDS = config.get("cache_shards", 16)
+
+# Which new responses the cache admits: "lru" takes everything, "tinylfu" only what is looked up more than it evicts
+CACHE_POLICY = config.get("cache_policy", "lru")
+
+# gzip level for text-like responses stored in the cache (0 stores them uncompressed)
+CACHE_COMPRESS_LEVEL = config.get("cache_compress_level", 6)
+
+# Cache key normalization: query parameters dropped from keys (fnmatch patterns), file extensions whose query is
+# ignored altogether, and whether paths are case folded
+CACHE_KEY_DROP_PARAMS = config.get("cache_key_drop_params", ["utm_*", "gclid", "fbclid", "session_id", "ref"])
+CACHE_KEY_STATIC_EXTENSIONS = config.get("cache_key_static_extensions", [
+    "js", "css", "png", "jpg", "jpeg", "gif", "svg", "webp", "ico", "woff", "woff2", "ttf", "eot"])
+CACHE_KEY_LOWERCASE_PATH = config.get("cache_key_lowercase_path", False)
+
+# Request headers whose Vary is overlooked, so every client shares one copy (responses vary on all others)
+CACHE_VARY_IGNORE = config.get("cache_vary_ignore", [])
+
+# Seconds a response without Cache-Control or Expires stays fresh, and the cap on the Last-Modified heuristic
+CACHE_DEFAULT_TTL = config.get("cache_default_ttl", 300)
+
+# Seconds past expiry a response is still served while it is refreshed in the background, and while the
+# origin is failing; the response's own stale-while-revalidate / stale-if-error directives take precedence
+CACHE_STALE_WHILE_REVALIDATE = config.get("cache_stale_while_revalidate", 30)
+CACHE_STALE_IF_ERROR = config.get("cache_stale_if_error", 3600)
+
+# Threads refreshing stale entries in the background (0 revalidates in the foreground) and refreshes that may queue
+CACHE_REFRESH_WORKERS = config.get("cache_refresh_workers", 4)
+CACHE_REFRESH_QUEUE_SIZE = config.get("cache_refresh_queue_size", 256)
+
+# Disk tier below the in-memory cache: directory, total bytes (0 disables it) and largest response stored
+DISK_CACHE_DIR = config.get("disk_cache_dir", "cache_disk")
+DISK_CACHE_MAX_BYTES = config.get("disk_cache_max_bytes", 1024 * 1024 * 1024)
+DISK_CACHE_MAX_OBJECT_SIZE = config.get("disk_cache_max_object_size", 64 * 1024 * 1024)
+
+# "threaded" runs a thread per connection, "asyncio" runs every connection on one event loop
+SERVER_MODE = config.get("server_mode", "threaded")
+
+# Number of processes sharing the listening port through SO_REUSEPORT, 1 runs in-process
+WORKER_PROCESSES = config.get("worker_processes", 1)
+
+# Threaded mode worker pool, 0 workers keeps the unbounded thread-per-connection behaviour
+WORKER_POOL_SIZE = config.get("worker_pool_size", 100)
+WORKER_QUEUE_SIZE = config.get("worker_queue_size", 200)
+RETRY_AFTER = config.get("retry_after", 2)
+POOL_STATS_INTERVAL = config.get("pool_stats_interval", 30)
+
+# Client keep-alive: seconds to wait for the next request and requests served per connection
+CLIENT_IDLE_TIMEOUT = config.get("client_idle_timeout", 15)
+MAX_REQUESTS_PER_CONNECTION = config.get("max_requests_per_connection", 100)
+
+# Persistent upstream connections kept idle per (host, port), 0 disables reuse
+UPSTREAM_POOL_SIZE = config.get("upstream_pool_size", 8)
+UPSTREAM_IDLE_TIMEOUT = config.get("upstream_idle_timeout", 30)
+
+# CONNECT tunnel relay: "auto" moves bytes with os.splice where available, "copy" always copies through Python
+TUNNEL_RELAY = config.get("tunnel_relay", "auto")
+
+# Established tunnels are relayed by this many epoll threads per process (0 keeps one blocked worker per tunnel),
+# and closed after sitting idle or reaching their maximum lifetime (0 = unlimited), in seconds
+TUNNEL_RELAY_THREADS = config.get("tunnel_relay_threads", 1)
+TUNNEL_IDLE_TIMEOUT = config.get("tunnel_idle_timeout", 300)
+TUNNEL_MAX_LIFETIME = config.get("tunnel_max_lifetime", 86400)
+
+# Blocked domains, domain/path prefixes and regexes (see blacklist.py)
+BLACKLIST_RULES = config.get("blacklist", [])
+
+# Lowest level logged ("DEBUG" also logs every cache store and key); records are written by a background thread
+LOG_LEVEL = config.get("log_level", "INFO")
+
+# Seconds between checks of the settings file for changes to apply while running (0 = only on SIGHUP)
+SETTINGS_RELOAD_INTERVAL = config.get("settings_reload_interval", 2)
+
+# Admin HTTP server serving /metrics (Prometheus text format); 0 disables it. Prefork worker N listens on port + N
+ADMIN_HOST = config.get("admin_host", "127.0.0.1")
+ADMIN_PORT = config.get("admin_port", 8889)
+
+# Label request latencies with the upstream host, one series per host visited, so only for a known set of origins
+METRICS_HOST_LABELS = config.get("metrics_host_labels", False)
 
-# Compile regex patterns
-BLACKLIST_PATTERNS = [re.compile(pat) for pat in config.get("blacklist", [])]
+# Unix datagram socket the dashboard listens on for counters and log lines pushed every interval seconds ("" = off)
+TELEMETRY_SOCKET = config.get("telemetry_socket", "dash.sock")
+TELEMETRY_INTERVAL = config.get("telemetry_interval", 1)
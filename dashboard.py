@@ -1,14 +1,20 @@
+import glob
 import json
 import os
-import re
+import shutil
+import socket
 import time
 import pickle
+import signal
 import subprocess
 import threading
+import urllib.parse
+import urllib.request
+from collections import deque
 from datetime import datetime
 from flask import Flask, render_template_string, redirect, request
 from flask_socketio import SocketIO
-from config import CACHE_FILE
+from config import CACHE_FILE, CACHE_JOURNAL, DISK_CACHE_DIR, SETTINGS_FILE, TELEMETRY_SOCKET, ADMIN_HOST, ADMIN_PORT
 
 app = Flask(__name__)
 socketio = SocketIO(app, cors_allowed_origins="*")
@@ -19,106 +25,74 @@ monitor_thread = None
 monitor_thread_started = False
 monitor_lock = threading.Lock()
 
-# Log file path for proxy logs
-LOG_FILE = "proxy_dash.log"
+# Seconds between Socket.IO updates, and how many of them the charts show
+UPDATE_INTERVAL = 2
+HISTORY_LENGTH = 30
 
-# Lists to store the latest logs and connection/block counts over time
-latest_logs = []
-connections_over_time = []
-blocked_over_time = []
+# Series charted from the proxy's telemetry, see telemetry.py
+SERIES = ("connections", "blocked", "cache_hits", "cache_misses")
 
-def monitor_logs():
-    """
-    Re-reads the entire proxy log file every 2 seconds.
-    Emits total connection and blocked counts over time, and latest 10 logs.
-    """
-    pattern_conn = re.compile(r'New connection from')
-    pattern_block = re.compile(r'\[Blocked\] Attempted access to (\S+)')
-    pattern_block_https = re.compile(r'\[Blocked HTTPS\]')
-    pattern_error = re.compile(r'\[(ERROR|WARNING)\] \[!\]')
-    pattern_cache_hit = re.compile(r'\[Cache HIT\]')
-    pattern_cache_miss = re.compile(r'\[Cache MISS\]')
-
-    connection_count_over_time = []
-    blocked_count_over_time = []
-    cache_hit_over_time = []
-    cache_miss_over_time = []
-
-    print(f"[DEBUG] Monitoring entire log file: {LOG_FILE}")
-
-    while True:
-        if not os.path.exists(LOG_FILE):
-            print("[DEBUG] Log file not found. Retrying...")
-            time.sleep(1)
-            continue
-
-        try:
-            with open(LOG_FILE, "r") as f:
-                lines = f.readlines()
-
-            new_conn, new_block, new_hit, new_miss, latest_logs = parse_log_lines(
-                lines, pattern_conn, pattern_block, pattern_block_https, pattern_error,
-                pattern_cache_hit, pattern_cache_miss
-            )
-
-            update_time_series(connection_count_over_time, new_conn)
-            update_time_series(blocked_count_over_time, new_block)
-            update_time_series(cache_hit_over_time, new_hit)
-            update_time_series(cache_miss_over_time, new_miss)
 
-            data={
-                "connections": connection_count_over_time,
-                "blocked": blocked_count_over_time,
-                "cache_hits": cache_hit_over_time,
-                "cache_misses": cache_miss_over_time,
-                "latest_logs": latest_logs
-            }
-
-            socketio.emit("update",data , namespace="/")
-
-        except Exception as e:
-            print(f"[ERROR] Failed to read log: {e}")
-
-        # Sleep for 2 seconds before re-reading the log
-
-# === parser ===
-def count_pattern(lines, pattern):
-    return sum(1 for line in lines if pattern.search(line.strip()))
-
-def has_error(lines, pattern_error):
-    return any(pattern_error.search(line.strip()) for line in lines)
-
-def parse_log_lines(lines, pattern_conn, pattern_block, pattern_block_https, pattern_error, pattern_hit, pattern_miss):
+class TelemetryCollector:
     """
-    Parse log lines and return:
-    - new connection count (or -1 if error)
-    - blocked count
-    - cache hit count
-    - cache miss count
-    - latest logs
+    Receives the counter increments and log lines the proxy processes push
+    to TELEMETRY_SOCKET, and sums them per update interval into fixed
+    length ring buffers, one per series.
     """
-    stripped_lines = [line.strip() for line in lines if line.strip()]
-    new_conn = count_pattern(stripped_lines, pattern_conn)
-    new_block = count_pattern(stripped_lines, pattern_block) + count_pattern(stripped_lines, pattern_block_https)
-    new_hit = count_pattern(stripped_lines, pattern_hit)
-    new_miss = count_pattern(stripped_lines, pattern_miss)
-    found_error = has_error(stripped_lines, pattern_error)
-
-    if found_error:
-        new_conn = -1
-
-    if new_conn == -1:
-        new_conn = 0
-    latest_logs = [line.strip() for line in lines[-10:]]
-    return new_conn, new_block, new_hit, new_miss, latest_logs
-
-def update_time_series(series, value, max_length=30):
+
+    def __init__(self, path, history=HISTORY_LENGTH):
+        self.path = path
+        self.series = {name: deque([0] * history, maxlen=history) for name in SERIES}
+        self.pending = dict.fromkeys(SERIES, 0)
+        self.latest_logs = deque(maxlen=10)
+        self.lock = threading.Lock()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)  # Left behind by an earlier dashboard
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        threading.Thread(target=self._receive, args=(sock,), daemon=True).start()
+
+    def _receive(self, sock):
+        while True:
+            data = sock.recv(1 << 16)
+            try:
+                message = json.loads(data)
+            except ValueError:
+                continue
+            with self.lock:
+                for name, count in message.get("counts", {}).items():
+                    if name in self.pending:
+                        self.pending[name] += count
+                self.latest_logs.extend(message.get("logs", []))
+
+    def tick(self):
+        """ Close the current interval: its sums go into the ring buffers, which are returned for the charts. """
+        with self.lock:
+            for name in SERIES:
+                self.series[name].append(self.pending[name])
+                self.pending[name] = 0
+            data = {name: list(values) for name, values in self.series.items()}
+            data["latest_logs"] = list(self.latest_logs)
+        return data
+
+
+def monitor_telemetry():
     """
-    Append value to series and keep only the last max_length items.
+    Emits the per interval connection, blocked and cache counts, and the
+    latest 10 logs, every UPDATE_INTERVAL seconds.
     """
-    series.append(value)
-    if len(series) > max_length:
-        series.pop(0)
+    if not TELEMETRY_SOCKET or not hasattr(socket, "AF_UNIX"):
+        print("[DEBUG] Telemetry is disabled, live stats stay empty")
+        return
+    collector = TelemetryCollector(TELEMETRY_SOCKET)
+    collector.start()
+    print(f"[DEBUG] Receiving proxy telemetry on {TELEMETRY_SOCKET}")
+
+    while True:
+        time.sleep(UPDATE_INTERVAL)
+        socketio.emit("update", collector.tick(), namespace="/")
 
 @app.route("/live")
 def live_dashboard():
@@ -130,10 +104,10 @@ def live_dashboard():
     """
     global monitor_thread, monitor_thread_started
 
-    # Start monitor_logs thread only if not already started
+    # Start monitor_telemetry thread only if not already started
     with monitor_lock:
         if not monitor_thread_started:
-            monitor_thread = threading.Thread(target=monitor_logs, daemon=True)
+            monitor_thread = threading.Thread(target=monitor_telemetry, daemon=True)
             monitor_thread.start()
             monitor_thread_started = True
 
@@ -225,7 +199,7 @@ def live_dashboard():
 
             <div class="card">
                 <h2>Connection Statistics</h2>
-                <p>Total connections and blocked requests over time</p>
+                <p>New connections, blocked requests and cache hits/misses per update</p>
                 <canvas id="connChart"></canvas>
             </div>
 
@@ -335,8 +309,6 @@ def live_dashboard():
         </html>
         """)
 
-SETTINGS_FILE = "settings.json"
-
 def load_settings():
     """
     Load blacklist and other settings from the JSON settings file.
@@ -347,9 +319,33 @@ def load_settings():
 def save_settings(data):
     """
     Save updated settings (like blacklist) back to the JSON file.
+    Written to a temporary file and renamed over it, so the running proxy
+    never reloads a half-written file.
     """
-    with open(SETTINGS_FILE, "w") as f:
+    temp_file = SETTINGS_FILE + ".tmp"
+    with open(temp_file, "w") as f:
         json.dump(data, f, indent=2)
+    os.replace(temp_file, SETTINGS_FILE)
+
+# Cache entries shown per dashboard page
+CACHE_PAGE_SIZE = 50
+
+
+def fetch_cache_page(prefix, sort, order, page):
+    """
+    One page of live cache metadata from the proxy's admin API (see
+    admin.py), or None while it can't be reached. With several worker
+    processes this is the first worker's cache.
+    """
+    if not ADMIN_PORT:
+        return None
+    query = urllib.parse.urlencode({"prefix": prefix, "sort": sort, "order": order,
+                                    "offset": page * CACHE_PAGE_SIZE, "limit": CACHE_PAGE_SIZE})
+    try:
+        with urllib.request.urlopen(f"http://{ADMIN_HOST}:{ADMIN_PORT}/cache?{query}", timeout=2) as response:
+            return json.load(response)
+    except (OSError, ValueError):
+        return None
 
 @app.route("/", methods=["GET", "POST"])
 def dashboard():
@@ -359,8 +355,6 @@ def dashboard():
     - View proxy cache
     - Proxy server controls and links
     """
-    global proxy_process
-
     # Load settings and blacklist
     settings = load_settings()
     blacklist = settings.get("blacklist", [])
@@ -378,23 +372,20 @@ def dashboard():
         settings["blacklist"] = blacklist
         save_settings(settings)
 
-        # Restart proxy to apply blacklist changes if running
-        if proxy_process and proxy_process.poll() is None:
-            proxy_process.terminate()
-            proxy_process.wait()
-            proxy_process = subprocess.Popen(["python", "main.py"])
+        # The proxy picks up the change by itself, SIGHUP just makes it immediate (open connections and the cache stay)
+        if proxy_process and proxy_process.poll() is None and hasattr(signal, "SIGHUP"):
+            proxy_process.send_signal(signal.SIGHUP)
 
         return redirect("/")  # Redirect to GET after POST
 
-    # Load cache data
-    if not os.path.exists(CACHE_FILE):
-        cache = {}
-    else:
-        try:
-            with open(CACHE_FILE, "rb") as f:
-                cache = pickle.load(f)
-        except Exception:
-            cache = {}
+    # One page of the live cache's metadata, bodies stay in the proxy
+    prefix = request.args.get("prefix", "").strip()
+    sort = request.args.get("sort", "last_access")
+    order = "asc" if request.args.get("order") == "asc" else "desc"
+    page = max(0, request.args.get("page", 0, type=int))
+    cache = fetch_cache_page(prefix, sort, order, page)
+    pages = -(-cache["total"] // CACHE_PAGE_SIZE) if cache else 0
+    now = time.time()
 
     proxy_running = proxy_process is not None and proxy_process.poll() is None
 
@@ -616,41 +607,72 @@ def dashboard():
         <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 1rem;">
             <div>
             <h2>Cache</h2>
-            <p style="color: #6b7280; font-size: 0.9rem; margin: 0;">Cached resources and their sizes</p>
+            <p style="color: #6b7280; font-size: 0.9rem; margin: 0;">
+                Cached resources in the running proxy{% if cache %}, {{ cache.total }} matching{% endif %}
+            </p>
             </div>
         </div>
 
+        <form method="GET" class="flex">
+        <input type="text" name="prefix" value="{{ prefix }}" placeholder="Key prefix (e.g., http://example.com/static/)" />
+        <input type="hidden" name="sort" value="{{ sort }}" />
+        <input type="hidden" name="order" value="{{ order }}" />
+        <button type="submit">Filter</button>
+        </form>
+
+        {% macro sort_link(field, title) -%}
+        <a href="?prefix={{ prefix|urlencode }}&sort={{ field }}&order={{ 'asc' if sort == field and order == 'desc' else 'desc' }}">{{ title }}</a>
+        {%- if sort == field %} {{ '&#9660;'|safe if order == 'desc' else '&#9650;'|safe }}{% endif %}
+        {%- endmacro %}
+
         <table>
             <thead>
             <tr>
-                <th>Cache Key (URL)</th>
-                <th style="width: 120px;">Size (Bytes)</th>
+                <th>{{ sort_link('key', 'Cache Key (URL)') }}</th>
+                <th style="width: 90px;">{{ sort_link('size', 'Size (Bytes)') }}</th>
+                <th style="width: 70px;">{{ sort_link('age', 'Age (s)') }}</th>
+                <th style="width: 50px;">{{ sort_link('hits', 'Hits') }}</th>
+                <th style="width: 90px;">{{ sort_link('last_access', 'Last Access') }}</th>
+                <th style="width: 90px;">{{ sort_link('expires_in', 'Freshness') }}</th>
             </tr>
             </thead>
             <tbody>
-            {% if cache %}
-                {% for key, value in cache.items() %}
+            {% if cache and cache.entries %}
+                {% for entry in cache.entries %}
                 <tr>
-                    <td style="font-family: monospace;">{{ key }}</td>
-                    <td>{{ value|length }}</td>
+                    <td style="font-family: monospace;">{{ entry.key }}{% if entry.tier == 'disk' %} <small>(disk)</small>{% endif %}</td>
+                    <td>{{ entry.size }}</td>
+                    <td>{{ entry.age|round|int }}</td>
+                    <td>{{ entry.hits }}</td>
+                    <td>{{ (now - entry.last_access)|round|int }}s ago</td>
+                    <td>{{ entry.freshness }}</td>
                 </tr>
                 {% endfor %}
             {% else %}
                 <tr>
-                <td colspan="2" style="text-align:center; color:#9ca3af;">
-                    Cache is empty.
+                <td colspan="6" style="text-align:center; color:#9ca3af;">
+                    {% if cache %}Cache is empty.{% else %}Cache is unavailable while the proxy is stopped.{% endif %}
                 </td>
                 </tr>
             {% endif %}
             </tbody>
         </table>
+
+        {% if pages > 1 %}
+        <div style="text-align:center; margin-top: 1rem;">
+            {% if page > 0 %}<a href="?prefix={{ prefix|urlencode }}&sort={{ sort }}&order={{ order }}&page={{ page - 1 }}">&laquo; Previous</a>{% endif %}
+            Page {{ page + 1 }} of {{ pages }}
+            {% if page + 1 < pages %}<a href="?prefix={{ prefix|urlencode }}&sort={{ sort }}&order={{ order }}&page={{ page + 1 }}">Next &raquo;</a>{% endif %}
+        </div>
+        {% endif %}
         </div>
     </body>
     </html>
 
     """
 
-    return render_template_string(html_template, cache=cache, proxy_running=proxy_running, blacklist=blacklist)
+    return render_template_string(html_template, cache=cache, proxy_running=proxy_running, blacklist=blacklist,
+                                  prefix=prefix, sort=sort, order=order, page=page, pages=pages, now=now)
 
 @app.route("/start")
 def start_proxy():
@@ -669,8 +691,7 @@ def start_proxy():
 @app.route("/stop")
 def stop_proxy():
     """
-    Stops the running proxy server subprocess if running,
-    and empties the proxy_dash.log file.
+    Stops the running proxy server subprocess if running.
     """
     global proxy_process
 
@@ -679,19 +700,20 @@ def stop_proxy():
         proxy_process.wait()
         proxy_process = None
 
-    # Empty the log file
-    with open("proxy_dash.log", "w") as log_file:
-        pass  # Opening in "w" mode truncates the file
-
     return redirect("/")
 
 @app.route("/clearcache")
 def clear_cache():
     """
-    Clears the cache pickle file by overwriting it with an empty dictionary.
+    Clears the cache pickle file by overwriting it with an empty dictionary,
+    and drops the journals and worker snapshots so their entries are not
+    loaded on top of it, along with the disk tier.
     """
     with open(CACHE_FILE, "wb") as f:
         pickle.dump({}, f)
+    for path in glob.glob(f"{CACHE_JOURNAL}.*") + glob.glob(f"{CACHE_FILE}.*"):
+        os.remove(path)
+    shutil.rmtree(DISK_CACHE_DIR, ignore_errors=True)
 
     return redirect("/")
 
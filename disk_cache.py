@@ -0,0 +1,308 @@
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from logger import logger
+
+# Blob files start with <key length, metadata length>, the key and the pickled freshness,
+# so the index can be rebuilt by scanning the directory
+BLOB_HEADER = struct.Struct("<II")
+
+# A disk entry hit this many times is copied back into memory
+PROMOTE_AFTER_HITS = 2
+
+
+class DiskEntry:
+    __slots__ = ('path', 'offset', 'size', 'freshness', 'hits', 'last_access', 'stamp')
+
+    def __init__(self, path, offset, size, freshness, last_access, stamp):
+        self.path = path
+        self.offset = offset  # Where the response starts, after the blob header
+        self.size = size
+        self.freshness = freshness  # Refreshed in memory by a 304, the file keeps the original
+        self.hits = 0
+        self.last_access = last_access
+        self.stamp = stamp  # (inode, mtime) of the blob file this entry describes
+
+
+def file_stamp(stat):
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def read_blob_header(f):
+    """ (key, offset of the response, freshness) from the start of a blob file. """
+    key_length, meta_length = BLOB_HEADER.unpack(f.read(BLOB_HEADER.size))
+    key = f.read(key_length).decode()
+    freshness = pickle.loads(f.read(meta_length))
+    return key, BLOB_HEADER.size + key_length + meta_length, freshness
+
+
+class DiskCache:
+    """
+    Second cache tier: one blob file per response under directory, with an
+    in-memory LRU index of key -> (path, offset, size, freshness). Hits are meant to be
+    sent straight from the file with sendfile, so the bytes never pass
+    through Python.
+
+    Prefork workers share the directory but each keeps its own index, so a
+    blob may have been replaced by another worker since it was indexed;
+    open() checks the file it got against the index before trusting it.
+    """
+
+    def __init__(self, directory, max_bytes, max_object_size):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_size = min(max_object_size, max_bytes)
+        self.index = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.demotions = 0
+        self.promotions = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _scan(self):
+        """ Rebuild the index from the blob files, oldest first so LRU order survives restarts. """
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    os.remove(path)  # Left behind by a write that never finished
+                    continue
+                try:
+                    with open(path, "rb") as f:
+                        key, offset, freshness = read_blob_header(f)
+                        stat = os.fstat(f.fileno())
+                except Exception as e:
+                    logger.warning(f"[Disk Cache] Removing unreadable blob {path}: {e}")
+                    os.remove(path)
+                    continue
+                found.append((stat.st_mtime, key, DiskEntry(path, offset, stat.st_size - offset, freshness,
+                                                            stat.st_mtime, file_stamp(stat))))
+        for _, key, entry in sorted(found, key=lambda item: item[0]):
+            self.index[key] = entry
+            self.bytes += entry.size
+        self._remove(self._evict())
+        if self.index:
+            logger.info(f"[Disk Cache] Indexed {len(self.index)} entries ({self.bytes} bytes) in {self.directory}")
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.index
+
+    def keys(self):
+        with self.lock:
+            return list(self.index)
+
+    def items(self, prefix=''):
+        """ (key, entry) pairs whose keys start with prefix; entries are only meant to be read. """
+        with self.lock:
+            return [(key, entry) for key, entry in self.index.items() if not prefix or key.startswith(prefix)]
+
+    def put(self, key, value, freshness, demoted=False):
+        """ Store a response, returns False if it doesn't fit the size limits. """
+        if len(value) > self.max_object_size:
+            return False
+        blob = self.writer(key, freshness)
+        return blob is not None and blob.write(value) and blob.commit(demoted)
+
+    def writer(self, key, freshness):
+        """ A BlobWriter to store a response as it arrives, or None if the file can't be created. """
+        try:
+            return BlobWriter(self, key, freshness)
+        except OSError as e:
+            logger.error(f"[Disk Cache] Failed to write {key}: {e}")
+            return None
+
+    def _add(self, key, entry, demoted):
+        with self.lock:
+            old = self.index.pop(key, None)
+            if old:
+                self.bytes -= old.size
+            self.index[key] = entry
+            self.bytes += entry.size
+            if demoted:
+                self.demotions += 1
+            victims = self._evict()
+        self._remove(victims)
+
+    def open(self, key):
+        """ Return (file, entry) for a hit, or None. The caller closes the file. """
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.index.move_to_end(key)
+            entry.hits += 1
+            entry.last_access = time.time()
+            self.hits += 1
+        try:
+            f = open(entry.path, "rb")
+        except FileNotFoundError:
+            self._forget(key, entry)  # Evicted by another worker
+            return None
+        stat = os.fstat(f.fileno())
+        if file_stamp(stat) != entry.stamp:
+            # Another worker replaced the blob: its offset, size and freshness are the file's, not the index's
+            try:
+                blob_key, offset, freshness = read_blob_header(f)
+            except Exception:
+                blob_key = None
+            if blob_key != key:
+                f.close()
+                self._forget(key, entry)
+                return None
+            entry = self._reindex(key, entry, DiskEntry(entry.path, offset, stat.st_size - offset, freshness,
+                                                        time.time(), file_stamp(stat)))
+        return f, entry
+
+    def read(self, f, entry):
+        return os.pread(f.fileno(), entry.size, entry.offset)
+
+    def should_promote(self, entry, max_size):
+        return entry.hits >= PROMOTE_AFTER_HITS and entry.size <= max_size
+
+    def record_promotion(self):
+        with self.lock:
+            self.promotions += 1
+
+    def _forget(self, key, entry):
+        """ Drop entry from the index but leave the file, which may be another worker's by now. """
+        with self.lock:
+            if self.index.get(key) is entry:
+                del self.index[key]
+                self.bytes -= entry.size
+
+    def _reindex(self, key, old, entry):
+        with self.lock:
+            if self.index.get(key) is old:
+                entry.hits = old.hits
+                self.index[key] = entry
+                self.bytes += entry.size - old.size
+        return entry
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.index.pop(key, None)
+            if entry is None:
+                return
+            self.bytes -= entry.size
+        self._remove([entry])
+
+    def _evict(self):
+        """ Drop least recently used entries until the budget holds. Caller holds self.lock. """
+        victims = []
+        while self.index and self.bytes > self.max_bytes:
+            _, entry = self.index.popitem(last=False)
+            self.bytes -= entry.size
+            self.evictions += 1
+            victims.append(entry)
+        return victims
+
+    @staticmethod
+    def _remove(entries):
+        for entry in entries:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.index),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "demotions": self.demotions,
+                "promotions": self.promotions,
+                "evictions": self.evictions,
+            }
+
+
+class BlobWriter:
+    """
+    A blob file written under a temporary name, so a response can be stored
+    while it is still arriving. commit() moves it in place and indexes it,
+    abort() throws it away; after either the writer is done.
+    """
+
+    def __init__(self, disk, key, freshness):
+        self.disk = disk
+        self.key = key
+        self.freshness = freshness
+        self.path = disk._path(key)
+        self.size = 0
+        encoded_key = key.encode()
+        meta = pickle.dumps(freshness, protocol=pickle.HIGHEST_PROTOCOL)
+        self.offset = BLOB_HEADER.size + len(encoded_key) + len(meta)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Unique among the threads and prefork workers writing into the same directory
+        fd, self.tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(self.path))
+        self.file = os.fdopen(fd, "wb")
+        try:
+            self.file.write(BLOB_HEADER.pack(len(encoded_key), len(meta)))
+            self.file.write(encoded_key)
+            self.file.write(meta)
+        except OSError:
+            self.abort()
+            raise
+
+    def write(self, data):
+        """ Append response bytes, returns False (and aborts) once they exceed the size limit or the disk fails. """
+        if self.file is None:
+            return False
+        self.size += len(data)
+        if self.size > self.disk.max_object_size:
+            self.abort()
+            return False
+        try:
+            self.file.write(data)
+        except OSError as e:
+            logger.error(f"[Disk Cache] Failed to write {self.key}: {e}")
+            self.abort()
+            return False
+        return True
+
+    def commit(self, demoted=False):
+        """ Replace the key's blob with this one, returns False if the file could not be put in place. """
+        if self.file is None:
+            return False
+        try:
+            self.file.flush()
+            stamp = file_stamp(os.fstat(self.file.fileno()))
+            self.file.close()
+            # Readers that already opened the old file keep reading it
+            os.replace(self.tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"[Disk Cache] Failed to write {self.key}: {e}")
+            self.abort()
+            return False
+        self.file = None
+        self.disk._add(self.key, DiskEntry(self.path, self.offset, self.size, self.freshness, time.time(), stamp),
+                       demoted)
+        return True
+
+    def abort(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
@@ -1,139 +1,590 @@
+import os
 import socket
-import select
+import threading
 import time
 from logger import logger
-from cache import LRUCache
-from urllib.parse import urlparse
-from config import BLACKLIST_PATTERNS
+from cache import LRUCache, CacheEntry
+from config import BLACKLIST_RULES, CLIENT_IDLE_TIMEOUT, MAX_REQUESTS_PER_CONNECTION, \
+    CACHE_REFRESH_WORKERS, CACHE_REFRESH_QUEUE_SIZE, CACHE_KEY_DROP_PARAMS, CACHE_KEY_STATIC_EXTENSIONS, \
+    CACHE_KEY_LOWERCASE_PATH
+from http_parser import RequestParser, ResponseFramer, HttpParseError, RequestTooLarge, MAX_HEADER_SIZE
+from upstream import upstream_pool, split_host_port
+from tunnel import relay_tunnel, tunnel_relays
+from singleflight import SingleFlight, STORED, FAILED
+from compression import accepts_gzip, gunzip_response, is_gzipped
+from refresh import Refresher
+from blacklist import Blacklist
+from cache_key import KeyNormalizer
+from reloader import settings_reloader
+from metrics import REQUESTS, CACHE_RESULTS, BLOCKED, HTTP_BYTES, TUNNEL_BYTES, REQUEST_SECONDS, method_label, \
+    host_label
+
+blacklist = Blacklist(BLACKLIST_RULES)
+key_normalizer = KeyNormalizer(CACHE_KEY_DROP_PARAMS, CACHE_KEY_STATIC_EXTENSIONS, CACHE_KEY_LOWERCASE_PATH)
+
+
+def is_blacklisted(host, target=''):
+    return blacklist.blocks(host, target)
+
+
+def apply_settings(settings):
+    """ Swap in the reloaded blacklist and key rules, and keep-alive limits for connections accepted from now on. """
+    global blacklist, CLIENT_IDLE_TIMEOUT, MAX_REQUESTS_PER_CONNECTION
+    blacklist = Blacklist(settings.BLACKLIST_RULES)
+    key_normalizer.configure(settings.CACHE_KEY_DROP_PARAMS, settings.CACHE_KEY_STATIC_EXTENSIONS,
+                             settings.CACHE_KEY_LOWERCASE_PATH)
+    cache.vary_ignore = {name.lower() for name in settings.CACHE_VARY_IGNORE}
+    CLIENT_IDLE_TIMEOUT = settings.CLIENT_IDLE_TIMEOUT
+    MAX_REQUESTS_PER_CONNECTION = settings.MAX_REQUESTS_PER_CONNECTION
+
+
+settings_reloader.subscribe(("blacklist", "cache_key_drop_params", "cache_key_static_extensions",
+                             "cache_key_lowercase_path", "cache_vary_ignore", "client_idle_timeout",
+                             "max_requests_per_connection"), apply_settings)
 
-def is_blacklisted(domain):
-    for pattern in BLACKLIST_PATTERNS:
-        if pattern.search(domain):
-            return True
-    return False
 
 cache = LRUCache()
+misses = SingleFlight()
+refresher = Refresher(CACHE_REFRESH_WORKERS, CACHE_REFRESH_QUEUE_SIZE)
 
+RELAY_BUFFER_SIZE = 65536
+relay_buffers = threading.local()
 
 
 def generate_cache_key(dest_host, path):
-    parsed = urlparse(path)
-    clean_host = dest_host.split(":")[0].lower()
-    ext = parsed.path.split('.')[-1].lower()
-
-    # Ignore query parameters for static assets
-    if ext in ['js', 'css', 'png', 'jpg', 'jpeg', 'gif', 'svg', 'webp', 'ico', 'woff', 'woff2', 'ttf', 'eot']:
-        cache_key = f"http://{clean_host}{parsed.path}"
-    else:
-        cache_key = f"http://{clean_host}{parsed.path}"
-        if parsed.query:
-            cache_key += f"?{parsed.query}"
-    return cache_key
-
-
-
-
-def handle_client(client_socket, client_addr):
+    """ Returns (key, rewritten), see KeyNormalizer.key(). """
+    return key_normalizer.key(dest_host, path)
+
+
+def read_request(client_socket, parser):
+    """ Block until the parser has a complete request head, or return None when the client hangs up. """
+    while True:
+        request = parser.next_request()
+        if request is not None:
+            return request
+        data = client_socket.recv(65536)
+        if not data:
+            return None
+        parser.feed(data)
+
+
+def stream_request_body(client_socket, parser, request, server_socket):
+    """ Forward the request body to the upstream as it arrives, without buffering it whole. """
+    if request.expects_continue:
+        client_socket.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+    while not parser.body_done:
+        chunk = parser.read_body()
+        if chunk:
+            server_socket.sendall(chunk)
+            continue
+        data = client_socket.recv(65536)
+        if not data:
+            raise ConnectionError("client closed the connection while sending the request body")
+        parser.feed(data)
+
+
+def handle_client(client_socket, client_addr, parser=None, served=0, park=None):
+    """
+    Serve the requests of a client connection. With park, a keep-alive
+    connection that waits for its next request is handed to
+    park(client_socket, client_addr, parser, served) instead of holding this
+    thread, and comes back here with that state once the client sends more.
+    """
+    # Requests on a keep-alive connection, pipelined or not, are served one after another,
+    # so responses always go out in request order
+    resumed = parser is not None
+    parser = parser or RequestParser()
     try:
-        request = client_socket.recv(8192)
-        if not request:
-            return
+        client_socket.settimeout(CLIENT_IDLE_TIMEOUT)
+        while served < MAX_REQUESTS_PER_CONNECTION:
+            if park is not None and served and not resumed and parser.idle:
+                park(client_socket, client_addr, parser, served)
+                client_socket = None
+                return
+            resumed = False
+            request = read_request(client_socket, parser)
+            if not request:
+                return
+            served += 1
+            REQUESTS.inc(method_label(request.method))
 
-        first_line = request.split(b'\n')[0].decode(errors='ignore')
-        if first_line.startswith("CONNECT"):
-            handle_https_tunnel(client_socket, first_line, client_addr)
-        else:
-            handle_http(client_socket, request, client_addr)
+            if request.method == "CONNECT":
+                handle_https_tunnel(client_socket, request.request_line, client_addr, parser.take_pending())
+                return
+            if not handle_http(client_socket, request, parser, client_addr):
+                return
 
+    except socket.timeout:
+        logger.debug("[-] Closing idle connection from %s", client_addr)
+    except RequestTooLarge as e:
+        logger.warning(f"[!] Rejecting request from {client_addr}: {e}")
+        client_socket.sendall(b"HTTP/1.1 431 Request Header Fields Too Large\r\n\r\n")
+    except HttpParseError as e:
+        logger.warning(f"[!] Malformed request from {client_addr}: {e}")
+        client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\n")
     except Exception as e:
         logger.exception(f"[!] Error handling client {client_addr}: {e}")
     finally:
-        client_socket.close()
-
-def handle_http(client_socket, request, client_addr):
-    dest_host = None
+        if client_socket is not None:
+            client_socket.close()
+
+def handle_http(client_socket, request, parser, client_addr):
+    """ Serve one request, returns True if the client connection can carry another one. """
+    dest_host = dest_name = None
+    served = None  # Which latency histogram path the request took, once it is known
+    start = time.monotonic()
     try:
-        start = time.time()
-        request_str = request.decode('utf-8', errors='ignore')
-        host_line = next((line for line in request_str.split('\r\n') if line.lower().startswith('host:')), None)
+        dest_host = request.host
 
-        if not host_line:
+        if not dest_host:
             logger.warning(f"[!] No Host header in request from {client_addr}")
             client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\nMissing Host Header")
-            return
-
-        dest_host = host_line.split()[1].lower()
-        dest_port = 80
-        path = request_str.split()[1]
-        url_path = request_str.splitlines()[0]
-        cache_key = generate_cache_key(dest_host, path)
-        logger.debug(f"[Cache Key] Generated for {url_path} -> {cache_key}")
-
-        if is_blacklisted(f"{dest_host}{path}"):
-            logger.info(f"[Blocked] Attempted access to {dest_host}")
+            return False
+
+        path = request.target
+        url_path = request.request_line
+        dest_name, dest_port = split_host_port(dest_host)
+        exchange = CacheExchange(request, dest_name, dest_port)
+        cache_key = exchange.cache_key
+        logger.debug("[Cache Key] Generated for %s -> %s", url_path, cache_key)
+
+        if is_blacklisted(dest_host, path):
+            logger.info("[Blocked] Attempted access to %s", dest_host)
+            BLOCKED.inc("http")
             client_socket.sendall(b"HTTP/1.1 403 Forbidden\r\n\r\nBlocked by Proxy")
-            return
-
-        logger.info(f"[>] HTTP Request from {client_addr} to {dest_host}:{dest_port} for {url_path}")
-
-        cached_response = cache.get(cache_key)
-        if cached_response:
-            logger.info(f"[Cache HIT] {cache_key}")
-            client_socket.sendall(cached_response)
-        else:
-            logger.info(f"[Cache MISS] {cache_key}")
-            with socket.create_connection((dest_host, dest_port), timeout=5) as server_socket:
-                server_socket.settimeout(5)  # Set timeout for send/recv
-                try:
-                    server_socket.sendall(request)
-                except socket.timeout:
-                    logger.warning(f"[!] Timeout while sending request to {dest_host}")
-                    client_socket.sendall(b"HTTP/1.1 504 Gateway Timeout\r\n\r\nUpstream server timed out")
-                    return
-
-                full_response = b''
-                while True:
-                    try:
-                        data = server_socket.recv(4096)
-                        if not data:
-                            break
-                        client_socket.sendall(data)
-                        full_response += data
-                    except socket.timeout:
-                        logger.warning(f"[!] Timeout while reading from {dest_host}")
-                        break
-                    except Exception as e:
-                        logger.warning(f"[!] Error forwarding data from {dest_host} to client: {e}")
-                        break
-
-                if len(full_response) < 1e6:  # Avoid caching huge responses
-                    cache.set(cache_key, full_response)
-
-                response_line = full_response.split(b'\r\n')[0].decode(errors='ignore')
-                logger.info(f"[Status Code] {response_line}")
-                duration = time.time() - start
-                logger.info(f"[Response] {cache_key} | Method: GET | Duration: {duration:.2f}s")
+            return False
+
+        logger.info("[>] HTTP Request from %s to %s:%s for %s", client_addr, dest_name, dest_port, url_path)
+
+        served = "miss" if exchange.cacheable else "pass"
+        try:
+            exchange.look_up()
+            reply = exchange.stored_reply()
+            if reply is not None:
+                served = "hit"
+            elif exchange.cacheable and not exchange.join():
+                published, flight = misses.wait(cache_key, exchange.flight)
+                reply = exchange.answer_published(published, flight)
+
+            if reply is None:
+                exchange.start_fetch()
+                relayed, framer = fetch_from_upstream(
+                    client_socket, parser, request, dest_name, dest_port, fill=exchange.fill,
+                    on_uncacheable=exchange.uncacheable, validators=exchange.validators,
+                    stale_if_error=exchange.stale_if_error)
+                reply = exchange.after_fetch(relayed, framer)
+            if reply is not None:
+                keep_alive = send_reply(client_socket, request, reply)
+                return keep_alive and request.keep_alive and parser.body_done
+        finally:
+            exchange.finish()
+
+        if not relayed and not framer.done:
+            logger.warning(f"[!] Timeout while sending request to {dest_host}")
+            client_socket.sendall(b"HTTP/1.1 504 Gateway Timeout\r\n\r\nUpstream server timed out")
+            return False
+
+        logger.info("[Status Code] %s", framer.status_line)
+        duration = time.monotonic() - start
+        logger.info("[Response] %s | Method: %s | Duration: %.2fs", cache_key, request.method, duration)
+
+        # The client sees the origin's headers, so it can only reuse the connection if they allow it.
+        # A body that was never read (e.g. on a cache hit) would corrupt the next request, so close then too.
+        return framer.done and framer.keep_alive and request.keep_alive and parser.body_done
 
     except Exception as e:
         logger.exception(f"[!] HTTP error from {client_addr} to {dest_host or 'UNKNOWN'}: {e}")
+        return False
     finally:
-        client_socket.close()
-
-
-
+        if served:
+            REQUEST_SECONDS.observe(time.monotonic() - start, served, host_label(dest_name))
+
+
+class Reply:
+    """ What the cache answers a request with: a stored entry (with its file for a disk entry), or raw bytes. """
+
+    __slots__ = ('key', 'entry', 'file', 'data', 'keep_alive')
+
+    def __init__(self, key, entry=None, file=None, data=None, keep_alive=False):
+        self.key = key
+        self.entry = entry
+        self.file = file
+        self.data = data  # Sent as they are, keep_alive says whether the connection survives them
+        self.keep_alive = keep_alive
+
+
+class CacheExchange:
+    """
+    The cache's part in one proxied request, shared by the threaded and the
+    asyncio server: whether a stored copy answers it, whether it waits on
+    another request's fetch of the same key, what the fetch asks the origin
+    and keeps, and what the cache answers when the origin says not modified
+    or fails. It never touches a socket; answers come back as Reply objects
+    for the server to send. look_up_disk(), answer_published() with STORED
+    and after_fetch() may touch the disk, the asyncio server runs them in
+    its executor.
+    """
+
+    def __init__(self, request, host, port):
+        self.request = request
+        self.host = host
+        self.port = port
+        self.url_key, self.rewritten = generate_cache_key(request.host, request.target)
+        self.cache_key = cache.variant_key(self.url_key, request.headers)
+        # Only GET responses are cached, other methods always go to the origin. Responses to
+        # authorized requests are meant for one user and never enter the shared cache.
+        self.cacheable = request.method == "GET" and 'authorization' not in request.headers
+        self.stale = self.stale_file = None  # The stored copy, fresh or not, and its file if it is on disk
+        self.flight = None
+        self.leader = False
+        self.fill = None
+        self.validators = b''
+        self.stale_if_error = False
+        self.shared = None  # What a leader publishes to the requests waiting on its fetch
+
+    def look_up(self, disk=True):
+        """ Find the stored copy in memory, then (with disk) on disk. Returns whether there is one. """
+        if self.cacheable:
+            self.stale = cache.get(self.cache_key)
+            if self.stale is None and disk:
+                self.look_up_disk()
+        return self.stale is not None
+
+    def look_up_disk(self):
+        self.stale, self.stale_file = lookup(self.cache_key, memory=False)
+        return self.stale is not None
+
+    def stored_reply(self):
+        """ The stored copy if it can answer without asking the origin, else None. """
+        stale = self.stale
+        if stale is None:
+            return None
+        key_normalizer.record_hit(self.rewritten)
+        tier = ' | disk' if self.stale_file else ''
+        if stale.freshness.is_fresh():
+            logger.info("[Cache HIT] %s%s", self.cache_key, tier)
+            CACHE_RESULTS.inc("hit")
+            return Reply(self.cache_key, stale, self.stale_file)
+        if serve_while_revalidating(self.request, stale):
+            # Answer with the stale copy now and refresh it off the request path, on the refresher's threads
+            refresher.submit(self.cache_key, refresh_entry, self.cache_key, self.request, self.host, self.port, stale)
+            logger.info("[Cache HIT] %s | stale%s", self.cache_key, tier)
+            CACHE_RESULTS.inc("stale")
+            return Reply(self.cache_key, stale, self.stale_file)
+        return None
+
+    def join(self):
+        """ Concurrent misses (and revalidations) of the same key share one upstream fetch. Returns whether to fetch. """
+        self.flight, self.leader = misses.join(self.cache_key)
+        return self.leader
+
+    def answer_published(self, published, flight):
+        """
+        Take what the wait on the key's fetch returned (see SingleFlight.wait).
+        Returns the Reply that answers the request, or None if it has to be
+        fetched after all.
+        """
+        if flight is not None:
+            self.flight, self.leader = flight, True  # Took over from a leader that was too slow
+            return None
+        if published is None:
+            return None
+        framer = None
+        if isinstance(published, bytes):
+            framer = ResponseFramer(self.request.method)
+            framer.feed(published)
+        failed = published is FAILED or framer is not None and framer.status >= 500
+        if failed and self.stale is not None and self.stale.freshness.usable(self.stale.freshness.stale_if_error):
+            logger.info("[Cache HIT] %s | stale, origin failed", self.cache_key)
+            CACHE_RESULTS.inc("stale_if_error")
+            return Reply(self.cache_key, self.stale, self.stale_file)
+        if published is FAILED:
+            logger.warning(f"[!] Upstream failed for {self.cache_key}, answered for every request waiting on it")
+            return Reply(self.cache_key, data=b"HTTP/1.1 504 Gateway Timeout\r\n\r\nUpstream server timed out")
+        if published is STORED:
+            # Stored where it can't be handed over, or as another variant than the one this request wants
+            key = cache.variant_key(self.url_key, self.request.headers)
+            stored, f = lookup(key)
+            if stored is None or not stored.freshness.is_fresh():
+                if f:
+                    f.close()
+                return None
+            logger.info("[Cache COALESCED] %s%s", key, ' | disk' if f else '')
+            CACHE_RESULTS.inc("coalesced")
+            return Reply(key, stored, f)
+        logger.info("[Cache COALESCED] %s", self.cache_key)
+        CACHE_RESULTS.inc("coalesced")
+        return Reply(self.cache_key, data=for_client(self.request, published, is_gzipped(framer.headers)),
+                     keep_alive=framer.done and framer.keep_alive)
+
+    def start_fetch(self):
+        """ Work out what the fetch asks the origin for and keeps for the cache. """
+        stale = self.stale
+        # A stale copy is revalidated, unless the client sent validators of its own
+        if stale is not None and not is_conditional(self.request):
+            self.validators = stale.freshness.conditional_headers()
+        # And still served if the origin fails, for as long as its stale-if-error allows
+        self.stale_if_error = stale is not None and stale.freshness.usable(stale.freshness.stale_if_error)
+        if self.cacheable:
+            logger.info("[Cache %s] %s", 'STALE' if stale is not None else 'MISS', self.cache_key)
+            self.fill = cache.fill(self.cache_key, self.request.headers)
+
+    def uncacheable(self):
+        """ The response turned out not to be cacheable: release the requests waiting on it now. """
+        if self.leader:
+            misses.finish(self.cache_key, self.flight, None)
+
+    def after_fetch(self, relayed, framer):
+        """
+        Settle the fetch (framer is None if the origin could not be reached).
+        Returns the Reply that answers from the cache instead, when the origin
+        said not modified or failed, or None if the response was relayed.
+        """
+        stale = self.stale
+        if framer is not None and self.validators and framer.status == 304:
+            # Not modified: the stored copy is current, refresh it and serve it
+            cache.revalidate(self.cache_key, stale, framer.headers)
+            logger.info("[Cache REVALIDATED] %s", self.cache_key)
+            CACHE_RESULTS.inc("revalidated")
+            self.shared = STORED if self.stale_file else stale.response
+            return Reply(self.cache_key, stale, self.stale_file)
+        if self.stale_if_error and not relayed and (framer is None or not framer.done or framer.status >= 500):
+            failure = framer.status_line if framer is not None and framer.status else 'no response'
+            logger.info("[Cache HIT] %s | stale, origin failed: %s", self.cache_key, failure)
+            CACHE_RESULTS.inc("stale_if_error")
+            self.shared = FAILED  # Requests waiting on the fetch fall back to their stale copy too
+            return Reply(self.cache_key, stale, self.stale_file)
+        if self.cacheable:
+            CACHE_RESULTS.inc("miss")
+        self.shared = finish_fill(self.fill, framer, relayed)
+        return None
+
+    def finish(self):
+        """ Called last, whatever happened: publish to the requests waiting on the key and let go of files. """
+        if self.fill:
+            self.fill.abort()  # Answered from the cache, or failed
+        if self.leader:
+            # Cached first, so a miss arriving after this finds the entry instead of fetching again
+            misses.finish(self.cache_key, self.flight, self.shared)
+        if self.stale_file:
+            self.stale_file.close()
+
+
+def is_conditional(request):
+    return 'if-none-match' in request.headers or 'if-modified-since' in request.headers
+
+
+def serve_while_revalidating(request, stale):
+    """ Whether a stale entry can answer this request while a background refresh fetches a new copy. """
+    return (refresher.enabled and not is_conditional(request) and not request.has_body
+            and stale.freshness.usable(stale.freshness.stale_while_revalidate))
+
+
+def refresh_entry(cache_key, request, host, port, stale):
+    """ Revalidate or refetch a stale entry that was just served, on the refresher's threads. """
+    flight, leader = misses.join(cache_key)
+    if not leader:
+        return  # A client request is already fetching it
+    shared = None
+    fill = cache.fill(cache_key, request.headers)
+    try:
+        validators = stale.freshness.conditional_headers()
+        relayed, framer = fetch_from_upstream(None, None, request, host, port, fill=fill, validators=validators)
+        if validators and framer.status == 304:
+            cache.revalidate(cache_key, stale, framer.headers)
+            shared = stale.response if isinstance(stale, CacheEntry) else STORED
+            logger.info(f"[Refresh] Revalidated {cache_key}")
+        else:
+            shared = finish_fill(fill, framer, relayed)
+            if fill.stored:
+                logger.info(f"[Refresh] Refetched {cache_key}")
+            else:
+                logger.warning(f"[Refresh] Kept the stale copy of {cache_key}: {framer.status_line or 'no response'}")
+    finally:
+        fill.abort()
+        misses.finish(cache_key, flight, shared)
+
+
+def lookup(cache_key, memory=True):
+    """ (entry, None) for a memory hit, (entry, file) for a disk hit, (None, None) for a miss. """
+    entry = cache.get(cache_key) if memory else None
+    if entry is not None:
+        return entry, None
+    disk_hit = cache.open_disk(cache_key)
+    if disk_hit:
+        f, entry = disk_hit
+        return entry, f
+    return None, None
+
+
+def finish_fill(fill, framer, relayed):
+    """
+    Store what a leader fetched, and return what it publishes to the
+    requests waiting on the same key (see SingleFlight.finish).
+    """
+    if framer is None or not relayed and not framer.done:
+        if fill:
+            fill.abort()
+        return FAILED  # They answer with the same error rather than each retrying the origin
+    if fill is None:
+        return None
+    shared = fill.finish(framer.done)
+    if shared is None and fill.stored:
+        return STORED
+    if shared is None and fill.response and framer.status >= 500:
+        return fill.response  # An origin error is shared too, rather than retried by every waiting request
+    return shared
+
+
+def for_client(request, response, gzipped):
+    """ A stored response as this client can take it: gzipped bodies are decompressed unless it accepts gzip. """
+    if gzipped and not accepts_gzip(request.headers.get('accept-encoding', '')):
+        return gunzip_response(response)
+    return response
+
+
+def send_reply(client_socket, request, reply):
+    """ Send what the cache answered with, returns whether it allows keep-alive. """
+    if reply.data is None:
+        return send_stored(client_socket, request, reply.key, reply.entry, reply.file)
+    client_socket.sendall(reply.data)
+    HTTP_BYTES.inc("sent", amount=len(reply.data))
+    return reply.keep_alive
+
+
+def send_stored(client_socket, request, cache_key, stored, f=None):
+    """ Send a cached response from memory, or from its disk file f. Returns whether its headers allow keep-alive. """
+    if f:
+        return send_from_disk(client_socket, request, cache_key, f, stored)
+    response = for_client(request, stored.response, stored.gzipped)
+    client_socket.sendall(response)
+    HTTP_BYTES.inc("sent", amount=len(response))
+    framer = ResponseFramer(request.method)
+    framer.feed(stored.response)
+    return framer.done and framer.keep_alive
+
+
+def send_from_disk(client_socket, request, cache_key, f, entry):
+    """ Send a disk tier hit straight from its file, returns whether its headers allow keep-alive. """
+    with f:
+        framer = ResponseFramer(request.method)
+        framer.feed(os.pread(f.fileno(), min(entry.size, MAX_HEADER_SIZE), entry.offset))
+        gzipped = is_gzipped(framer.headers)
+        if gzipped and not accepts_gzip(request.headers.get('accept-encoding', '')):
+            # Only clients that can't take gzip make the body pass through Python
+            response = gunzip_response(cache.disk.read(f, entry))
+            client_socket.sendall(response)
+            HTTP_BYTES.inc("sent", amount=len(response))
+        else:
+            HTTP_BYTES.inc("sent", amount=client_socket.sendfile(f, entry.offset, entry.size))
+        cache.promote(cache_key, f, entry, gzipped)
+    return framer.keep_alive
+
+
+def get_relay_buffer():
+    """ Per-thread receive buffer, so relaying a response allocates nothing per read. """
+    buffer = getattr(relay_buffers, "buffer", None)
+    if buffer is None:
+        buffer = relay_buffers.buffer = memoryview(bytearray(RELAY_BUFFER_SIZE))
+    return buffer
+
+
+def fetch_from_upstream(client_socket, parser, request, host, port, fill=None, on_uncacheable=None,
+                        validators=b'', stale_if_error=False):
+    """
+    Send the request over a pooled upstream connection, streaming its body
+    from the client, and relay the response until its framing says it is
+    complete. The relayed response is fed to fill (a CacheFill) for the cache;
+    on_uncacheable is called as soon as fill can't take it.
+    With validators (conditional header lines for a stale cached copy) a 304
+    is read but not relayed, and so is a 5xx with stale_if_error; the caller
+    answers from the cache instead. Without a client_socket nothing is
+    relayed at all (background refreshes).
+
+    Returns (bytes relayed, framer). The connection
+    goes back to the pool if it can be reused.
+    """
+    head = request.upstream_head(validators)
+    buffer = get_relay_buffer()
+    while True:
+        framer = ResponseFramer(request.method)
+        try:
+            server_socket, reused = upstream_pool.acquire(host, port)
+        except OSError as e:
+            logger.warning(f"[!] Could not connect to {host}:{port}: {e}")
+            return 0, framer
+        held = bytearray()  # Response head bytes held back until it is clear whether the cache answers instead
+        relayed = received_total = 0
+        keeping = fill is not None
+        # A pooled connection that turns out to be dead can only be retried while the body is unread
+        retryable = reused and not request.has_body
+        try:
+            server_socket.sendall(head)
+            if request.has_body:
+                stream_request_body(client_socket, parser, request, server_socket)
+            while not framer.done:
+                received = server_socket.recv_into(buffer)
+                if not received:
+                    framer.eof()
+                    break
+                received_total += received
+                used = framer.feed(buffer[:received])
+                data = buffer[:used]
+                if validators or stale_if_error:
+                    if (validators and framer.status == 304) or (stale_if_error and framer.status >= 500):
+                        continue  # Answered from the cache instead
+                    if held or not framer.status:
+                        held += data
+                        if not framer.status:
+                            continue
+                        data = held
+                        held = bytearray()
+                if client_socket:
+                    client_socket.sendall(data)
+                relayed += len(data)
+
+                if keeping and not fill.feed(data, framer.content_length):
+                    # Too big or not allowed to cache, stop holding on to it
+                    keeping = False
+                    if on_uncacheable:
+                        on_uncacheable()
+        except socket.timeout:
+            logger.warning(f"[!] Timeout while reading from {host}")
+        except OSError as e:
+            if retryable and not relayed:
+                # The origin dropped the pooled connection, retry on another one
+                server_socket.close()
+                continue
+            logger.warning(f"[!] Error forwarding data from {host} to client: {e}")
+        else:
+            if retryable and not relayed and not framer.done:
+                server_socket.close()
+                continue
+
+        # Counted once per response rather than per read, the counter takes a lock
+        HTTP_BYTES.inc("received", amount=received_total)
+        if client_socket:
+            HTTP_BYTES.inc("sent", amount=relayed)
+        if framer.done and framer.keep_alive:
+            upstream_pool.release(host, port, server_socket)
+        else:
+            server_socket.close()
+        return relayed, framer
 
 
-def handle_https_tunnel(client_socket, first_line, client_addr):
+def handle_https_tunnel(client_socket, first_line, client_addr, pending=b''):
     server_socket = None
+    start = time.monotonic()
     try:
-        logger.info(f"[>] HTTPS CONNECT from {client_addr}: {first_line.strip()}")
+        logger.info("[>] HTTPS CONNECT from %s: %s", client_addr, first_line.strip())
         _, address, _ = first_line.split()
         dest_host, dest_port = address.split(':')
         dest_host = dest_host.lower()
         dest_port = int(dest_port)
 
         if is_blacklisted(dest_host):
-            logger.info(f"[Blocked HTTPS] Attempted access to {dest_host}")
+            logger.info("[Blocked HTTPS] Attempted access to %s", dest_host)
+            BLOCKED.inc("connect")
             client_socket.sendall(b"HTTP/1.1 403 Forbidden\r\n\r\nBlocked by Proxy")
             return
 
@@ -141,29 +592,16 @@ def handle_https_tunnel(client_socket, first_line, client_addr):
         server_socket.settimeout(5)  # Optional: apply timeout
 
         client_socket.sendall(b"HTTP/1.1 200 Connection Established\r\n\r\n")
-
-        sockets = [client_socket, server_socket]
-        while True:
-            try:
-                readable, _, _ = select.select(sockets, [], [], 5)
-                if not readable:
-                    continue
-                for sock in readable:
-                    other_sock = server_socket if sock is client_socket else client_socket
-                    try:
-                        data = sock.recv(4096)
-                        if not data:
-                            return
-                        other_sock.sendall(data)
-                    except socket.timeout:
-                        logger.warning(f"[!] Timeout relaying data between client and {dest_host}")
-                        return
-                    except (ConnectionResetError, ConnectionAbortedError) as e:
-                        logger.warning(f"[!] Connection error in HTTPS tunnel: {client_addr} <-> {dest_host} | {e}")
-                        return
-            except Exception as e:
-                logger.exception(f"[!] Unexpected error in HTTPS relay loop: {e}")
-                return
+        REQUEST_SECONDS.observe(time.monotonic() - start, "tunnel_setup", host_label(dest_host))
+        if pending:
+            server_socket.sendall(pending)
+            TUNNEL_BYTES.inc("upstream", amount=len(pending))
+
+        if tunnel_relays.enabled:
+            # The relay threads own both sockets from here on and this worker is free again
+            tunnel_relays.add(client_socket, server_socket, client_addr, dest_host)
+            return
+        relay_tunnel(client_socket, server_socket, client_addr, dest_host)
 
     except Exception as e:
         logger.exception(f"[!] HTTPS tunnel error from {client_addr} to {dest_host}:{dest_port} - {e}")
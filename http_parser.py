@@ -0,0 +1,309 @@
+MAX_HEADER_SIZE = 65536
+
+# Headers that only describe one connection (client <-> proxy or proxy <-> origin) and are not forwarded
+HOP_BY_HOP_HEADERS = {b'connection', b'proxy-connection', b'keep-alive'}
+
+
+class HttpParseError(Exception):
+    pass
+
+
+class RequestTooLarge(HttpParseError):
+    pass
+
+
+def parse_head(head):
+    """ Split a message head (without the blank line) into its lines and a lowercase header dict. """
+    lines = head.split(b'\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if not sep:
+            raise HttpParseError(f"malformed header line: {line[:80]!r}")
+        name = name.strip().lower().decode('latin-1')
+        value = value.strip().decode('latin-1')
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    return lines, headers
+
+
+def parse_content_length(value):
+    """ A Content-Length value; a list (from repeated headers) is only valid if every member is the same number. """
+    values = {member.strip() for member in value.split(',')}
+    if len(values) != 1 or not next(iter(values)).isdigit():
+        raise HttpParseError(f"invalid Content-Length: {value!r}")
+    return int(values.pop())
+
+
+class BodyFramer:
+    """
+    Finds the end of a message body delimited by a length, chunked encoding
+    or the connection close. The body bytes themselves are never copied.
+    """
+
+    LENGTH, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILERS, UNTIL_CLOSE, DONE = range(7)
+
+    def __init__(self, length=None, chunked=False):
+        self.line = bytearray()  # Partial chunk-size/trailer line carried between reads
+        self.remaining = 0
+        if chunked:
+            self.state = self.CHUNK_SIZE
+        elif length is None:
+            self.state = self.UNTIL_CLOSE
+        elif length:
+            self.state = self.LENGTH
+            self.remaining = length
+        else:
+            self.state = self.DONE
+
+    @property
+    def done(self):
+        return self.state == self.DONE
+
+    def feed(self, data):
+        """ Consume data (bytes or a memoryview), returning how many of its bytes belong to this body. """
+        pos, end = 0, len(data)
+        searchable = None
+        while pos < end and self.state != self.DONE:
+            if self.state == self.UNTIL_CLOSE:
+                return end
+            if self.state in (self.LENGTH, self.CHUNK_DATA):
+                take = min(self.remaining, end - pos)
+                pos += take
+                self.remaining -= take
+                if self.remaining == 0:
+                    self.state = self.DONE if self.state == self.LENGTH else self.CHUNK_END
+                continue
+
+            if searchable is None:
+                # Memoryviews can't be searched, copy once and only for chunked bodies
+                searchable = data if hasattr(data, 'find') else bytes(data)
+            newline = searchable.find(b'\n', pos)
+            if newline == -1:
+                self.line += searchable[pos:]
+                if len(self.line) > MAX_HEADER_SIZE:
+                    raise HttpParseError("chunk line too long")
+                return end
+            self.line += searchable[pos:newline + 1]
+            pos = newline + 1
+            line = bytes(self.line).rstrip(b'\r\n')
+            self.line.clear()
+            self._on_line(line)
+        return pos
+
+    def eof(self):
+        """ The peer closed the connection, which ends a close-delimited body. """
+        if self.state == self.UNTIL_CLOSE:
+            self.state = self.DONE
+
+    def _on_line(self, line):
+        if self.state == self.CHUNK_SIZE:
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise HttpParseError(f"invalid chunk size: {line[:20]!r}")
+            if size == 0:
+                self.state = self.TRAILERS
+            else:
+                self.remaining = size
+                self.state = self.CHUNK_DATA
+        elif self.state == self.CHUNK_END:
+            self.state = self.CHUNK_SIZE
+        elif self.state == self.TRAILERS and not line:
+            self.state = self.DONE
+
+
+class Request:
+    """ A parsed request head. The body is streamed separately through RequestParser.read_body(). """
+
+    __slots__ = ('method', 'target', 'version', 'headers', 'lines', 'body')
+
+    def __init__(self, head):
+        self.lines, self.headers = parse_head(head)
+        parts = self.lines[0].split()
+        if len(parts) != 3:
+            raise HttpParseError(f"malformed request line: {self.lines[0][:80]!r}")
+        self.method, self.target, self.version = (part.decode('latin-1') for part in parts)
+
+        transfer_encoding = self.headers.get('transfer-encoding')
+        if transfer_encoding is not None:
+            # Only a final chunked coding frames a request body. It overrides any Content-Length, which is
+            # dropped from the head sent upstream so the origin can't frame the body differently.
+            if transfer_encoding.rsplit(',', 1)[-1].strip().lower() != 'chunked':
+                raise HttpParseError(f"unsupported Transfer-Encoding: {transfer_encoding!r}")
+            self.body = BodyFramer(chunked=True)
+        elif 'content-length' in self.headers:
+            self.body = BodyFramer(length=parse_content_length(self.headers['content-length']))
+        else:
+            self.body = BodyFramer(length=0)
+
+    @property
+    def request_line(self):
+        return f"{self.method} {self.target} {self.version}"
+
+    @property
+    def host(self):
+        return self.headers.get('host', '').lower()
+
+    @property
+    def has_body(self):
+        return not self.body.done
+
+    @property
+    def expects_continue(self):
+        return self.headers.get('expect', '').lower() == '100-continue'
+
+    @property
+    def keep_alive(self):
+        """ Whether the client asked to keep its connection open after this request. """
+        if 'transfer-encoding' in self.headers and 'content-length' in self.headers:
+            return False  # Framed two ways, whatever follows on the connection can't be trusted
+        connection = f"{self.headers.get('connection', '')},{self.headers.get('proxy-connection', '')}".lower()
+        if self.version == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
+
+    def upstream_head(self, extra=b''):
+        """ The request head to send upstream, without hop-by-hop headers, plus extra CRLF-terminated lines. """
+        dropped = HOP_BY_HOP_HEADERS | {b'expect'} if self.expects_continue else HOP_BY_HOP_HEADERS
+        if 'transfer-encoding' in self.headers:
+            dropped = dropped | {b'content-length'}
+        kept = [self.lines[0]] + [line for line in self.lines[1:]
+                                  if line.split(b':', 1)[0].strip().lower() not in dropped]
+        return b'\r\n'.join(kept) + b'\r\n' + extra + b'\r\n'
+
+
+class RequestParser:
+    """
+    Incremental HTTP/1.x request parser for one client connection. Bytes are
+    fed as they arrive; heads come out of next_request() and bodies out of
+    read_body(), so pipelined requests are handled one at a time, in order.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.scanned = 0  # Where the search for the end of the head resumes
+        self.current = None
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_request(self):
+        """ Return the next request head, or None if more bytes are needed. """
+        if self.current is not None and not self.current.body.done:
+            raise HttpParseError("previous request body was not consumed")
+
+        # Tolerate stray CRLFs between pipelined requests
+        while self.buffer[:2] == b'\r\n':
+            del self.buffer[:2]
+
+        end = self.buffer.find(b'\r\n\r\n', max(self.scanned - 3, 0))
+        if end == -1:
+            self.scanned = len(self.buffer)
+            if self.scanned > MAX_HEADER_SIZE:
+                raise RequestTooLarge(f"request head exceeds {MAX_HEADER_SIZE} bytes")
+            return None
+
+        self.current = Request(bytes(self.buffer[:end]))
+        del self.buffer[:end + 4]
+        self.scanned = 0
+        return self.current
+
+    @property
+    def body_done(self):
+        return self.current is None or self.current.body.done
+
+    @property
+    def idle(self):
+        """ Between requests with nothing buffered, so only waiting for the client. """
+        return not self.buffer and self.body_done
+
+    def read_body(self):
+        """ Take the buffered part of the current request body, still in its wire framing. """
+        if not self.buffer or self.body_done:
+            return b''
+        used = self.current.body.feed(self.buffer)
+        chunk = bytes(self.buffer[:used])
+        del self.buffer[:used]
+        return chunk
+
+    def take_pending(self):
+        """ Hand over whatever was read past the last request, e.g. early tunnel bytes. """
+        pending = bytes(self.buffer)
+        self.buffer.clear()
+        return pending
+
+
+class ResponseFramer:
+    """
+    Tracks where an HTTP/1.x response ends as its bytes arrive, and keeps the
+    parsed status line and headers. Interim 1xx responses are skipped over.
+    """
+
+    def __init__(self, method="GET"):
+        self.method = method.upper()
+        self.head = bytearray()
+        self.body = None
+        self.version = ''
+        self.status = 0
+        self.status_line = ''
+        self.headers = {}
+        self.content_length = None
+        self.keep_alive = False
+
+    @property
+    def done(self):
+        return self.body is not None and self.body.done
+
+    def feed(self, data):
+        """ Consume data, returning how many of its bytes belong to this response. """
+        pos = 0
+        while self.body is None:
+            search_from = max(len(self.head) - 3, 0)
+            self.head += data[pos:]
+            end = self.head.find(b'\r\n\r\n', search_from)
+            if end == -1:
+                if len(self.head) > MAX_HEADER_SIZE:
+                    raise HttpParseError(f"response head exceeds {MAX_HEADER_SIZE} bytes")
+                return len(data)
+            pos = len(data) - (len(self.head) - end - 4)
+            head = bytes(self.head[:end])
+            self.head.clear()
+            self._on_head(head)
+        if pos == len(data):
+            return pos
+        return pos + self.body.feed(data[pos:] if pos else data)
+
+    def eof(self):
+        """ The upstream closed the connection, which ends a close-delimited body. """
+        if self.body is not None:
+            self.body.eof()
+        self.keep_alive = False
+
+    def _on_head(self, head):
+        lines, headers = parse_head(head)
+        parts = lines[0].split(None, 2)
+        status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        if 100 <= status < 200:
+            return  # Interim response (e.g. 100 Continue), the real one follows
+
+        self.status = status
+        self.status_line = lines[0].decode('latin-1')
+        self.version = parts[0].decode('latin-1') if parts else ''
+        self.headers = headers
+
+        connection = headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            self.keep_alive = 'close' not in connection
+        else:
+            self.keep_alive = 'keep-alive' in connection
+
+        if self.method == 'HEAD' or status in (204, 304):
+            self.body = BodyFramer(length=0)
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            self.body = BodyFramer(chunked=True)
+        elif 'content-length' in headers:
+            self.content_length = parse_content_length(headers['content-length'])
+            self.body = BodyFramer(length=self.content_length)
+        else:
+            self.body = BodyFramer()
+            self.keep_alive = False
@@ -0,0 +1,160 @@
+import glob
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+import zlib
+from logger import logger
+
+# Each record is <payload length, crc32 of payload> followed by a pickled (op, key, value) tuple
+RECORD_HEADER = struct.Struct("<II")
+SET, DELETE = "set", "del"
+
+
+def read_journal(path):
+    """ Yield the (op, key, value) records of a journal, stopping at a torn or corrupt tail. """
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, pos)
+        payload = data[pos + RECORD_HEADER.size:pos + RECORD_HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            logger.warning(f"[Journal] Ignoring {len(data) - pos} bytes of incomplete records in {path}")
+            return
+        yield pickle.loads(payload)
+        pos += RECORD_HEADER.size + length
+
+
+class CacheJournal:
+    """
+    Write-behind persistence for the cache. Sets and deletes are queued and
+    appended to a journal by a background thread in batches; every
+    snapshot_interval (or once the journal outgrows compact_bytes) the
+    thread writes a full snapshot and truncates the journal. The request
+    path only ever pays for a queue put.
+
+    Replaying a journal on top of a snapshot that already contains some of
+    its records is harmless, because every record sets or deletes a whole
+    entry. Each process appends to its own journal (prefork workers share the
+    directory), and startup replays all of them. Prefork workers also compact
+    into snapshots of their own, which startup merges.
+    """
+
+    def __init__(self, snapshot_path, journal_path, snapshot_source, fsync_interval, snapshot_interval, compact_bytes):
+        self.base_snapshot_path = snapshot_path
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.snapshot_source = snapshot_source  # Returns a consistent copy of the entries to snapshot
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.compact_bytes = compact_bytes  # Compact early once the journal grows past this
+        self.queue = queue.SimpleQueue()
+        self.writer_pid = None
+        self.lock = threading.Lock()
+
+    def use_worker_snapshot(self, slot):
+        """ Compact into this prefork worker's own snapshot, so workers don't overwrite each other's. """
+        self.snapshot_path = f"{self.base_snapshot_path}.{slot}"
+
+    def snapshot_paths(self):
+        """ The shared snapshot and the workers' own ones that exist, oldest first. """
+        prefix = f"{self.base_snapshot_path}."
+        workers = [path for path in glob.glob(f"{prefix}*") if path[len(prefix):].isdigit()]
+        paths = [path for path in [self.base_snapshot_path] + workers if os.path.exists(path)]
+        return sorted(paths, key=os.path.getmtime)
+
+    def recover(self, entries):
+        """
+        Apply every journal left behind to the snapshot's entries, oldest
+        first. Returns (records replayed, journal paths).
+        """
+        journals = sorted(glob.glob(f"{self.journal_path}.*"), key=os.path.getmtime)
+        replayed = 0
+        for path in journals:
+            try:
+                for op, key, value in read_journal(path):
+                    if op == SET:
+                        entries[key] = value
+                        entries.move_to_end(key)
+                    else:
+                        entries.pop(key, None)
+                    replayed += 1
+            except Exception as e:
+                logger.error(f"[Journal] Failed to replay {path}: {e}")
+        return replayed, journals
+
+    def write_snapshot(self, entries):
+        """ Atomically replace the snapshot file. """
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+    def record_set(self, key, value):
+        self._put((SET, key, value))
+
+    def record_delete(self, key):
+        self._put((DELETE, key, None))
+
+    def _put(self, record):
+        self.queue.put(record)
+        if self.writer_pid != os.getpid():
+            self._start_writer()
+
+    def _start_writer(self):
+        with self.lock:
+            if self.writer_pid == os.getpid():
+                return
+            # Started lazily so forked worker processes each get their own writer and journal
+            self.writer_pid = os.getpid()
+            threading.Thread(target=self._run, name="cache-journal", daemon=True).start()
+
+    def _run(self):
+        path = f"{self.journal_path}.{os.getpid()}"
+        f = open(path, "ab")
+        last_fsync = last_snapshot = time.monotonic()
+        dirty = False
+        while True:
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=1))
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            try:
+                if batch and not os.path.exists(path):
+                    # Deleted behind our back (the dashboard clears the cache), records would go nowhere
+                    f.close()
+                    f = open(path, "ab")
+                if batch:
+                    chunks = []
+                    for record in batch:
+                        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                        chunks.append(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+                        chunks.append(payload)
+                    f.write(b"".join(chunks))
+                    f.flush()
+                    dirty = True
+
+                now = time.monotonic()
+                if dirty and now - last_fsync >= self.fsync_interval:
+                    os.fsync(f.fileno())
+                    last_fsync = now
+                    dirty = False
+
+                if f.tell() and (now - last_snapshot >= self.snapshot_interval or f.tell() > self.compact_bytes):
+                    # Records still queued land in the fresh journal whether or not the copy already has them
+                    self.write_snapshot(self.snapshot_source())
+                    f.truncate(0)
+                    f.seek(0)
+                    last_snapshot = now
+                    logger.debug(f"[Journal] Compacted {path} into {self.snapshot_path}")
+            except Exception as e:
+                logger.error(f"[Journal] Failed to persist cache: {e}")
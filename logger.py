@@ -1,55 +1,161 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import threading
 from collections import deque
 import re
+from config import LOG_LEVEL
+
+# Log lines the dashboard shows, combined into one regex so a record costs a single search
+DASH_PATTERN = re.compile("|".join([
+    r"New connection from",
+    r"\[Blocked\] Attempted access to (\S+)",
+    r"\[Cache (HIT|COALESCED|REVALIDATED)\]",
+    r"\[Cache MISS\]",
+    r"\[Blocked HTTPS\]",
+    r"\[WARNING\] \[\!\] Connection error in HTTPS tunnel",
+    r"\[ERROR\] \[\!\] HTTP error from",
+]))
+
+# Records the writer thread takes off the queue at once, writing and flushing them together
+LOG_BATCH_SIZE = 256
 
-# Regex patterns to filter logs for dashboard
-patterns = [
-    re.compile(r"New connection from"),
-    re.compile(r"\[Blocked\] Attempted access to (\S+)"),
-    re.compile(r"\[Cache HIT\]"),
-    re.compile(r"\[Cache MISS\]"),
-    re.compile(r"\[Blocked HTTPS\]"),
-    re.compile(r"\[WARNING\] \[\!\] Connection error in HTTPS tunnel"),
-    re.compile(r"\[ERROR\] \[\!\] HTTP error from")
-]
 
 class DashLogHandler(logging.Handler):
-    def __init__(self, filename, max_logs=50):
+    """ Keeps the last max_logs dashboard lines until the telemetry publisher takes them (see telemetry.py). """
+
+    def __init__(self, max_logs=10):
         super().__init__()
-        self.filename = filename
-        self.max_logs = max_logs
         self.log_queue = deque(maxlen=max_logs)
 
     def emit(self, record):
         log_entry = self.format(record)
 
         # Filter: keep only matching lines
-        if any(p.search(log_entry) for p in patterns):
+        if DASH_PATTERN.search(log_entry):
             self.log_queue.append(log_entry)
 
-            # Overwrite the file with updated queue
-            with open(self.filename, "w") as f:
-                for entry in self.log_queue:
-                    f.write(entry + "\n")
+    def take(self):
+        """ The lines logged since the last call. """
+        self.acquire()
+        try:
+            lines = list(self.log_queue)
+            self.log_queue.clear()
+        finally:
+            self.release()
+        return lines
+
+    def put_back(self, lines):
+        """ Return lines that could not be delivered, ahead of any logged since; the oldest go past max_logs. """
+        self.acquire()
+        try:
+            newer = list(self.log_queue)
+            self.log_queue.clear()
+            self.log_queue.extend(lines + newer)
+        finally:
+            self.release()
+
+
+class BatchedStreamHandler(logging.StreamHandler):
+    """ Writes records without flushing each one, the writer thread flushes once per batch. """
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchedFileHandler(logging.FileHandler):
+    emit = BatchedStreamHandler.emit
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Only enqueues the record: the message is formatted from its arguments
+    on the writer thread, so logging costs the request path an enqueue.
+    Hot path calls pass arguments (logger.info("... %s", key)) rather than
+    f-strings for the same reason.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class LogWriter:
+    """ Drains the log queue on one thread and hands records to the real handlers in batches. """
+
+    def __init__(self, handlers, batch_size=LOG_BATCH_SIZE):
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def restart_in_child(self):
+        # A forked worker process gets a queue and writer thread of its own, the parent's thread isn't there
+        self.queue = queue.SimpleQueue()
+        queue_handler.queue = self.queue
+        self.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    self._flush()
+                    return
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            self._flush()
+
+    def _flush(self):
+        for handler in self.handlers:
+            handler.acquire()
+            try:
+                handler.flush()
+            finally:
+                handler.release()
+
+    def stop(self):
+        """ Write what is still queued; called at exit. """
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
 
 # Standard log formatting
 log_format = "%(asctime)s [%(levelname)s] %(message)s"
+formatter = logging.Formatter(log_format)
 
-# Configure root logger
-logging.basicConfig(
-    level=logging.INFO,
-    format=log_format,
-    handlers=[
-        logging.FileHandler("proxy.log"),
-        logging.StreamHandler()
-    ]
-)
-
-# Create a separate handler for dashboard logs (filtered)
-dash_handler = DashLogHandler("proxy_dash.log", max_logs=50)
+# Create a separate handler for dashboard logs (filtered), pushed to the dashboard with the telemetry
+dash_handler = DashLogHandler(max_logs=10)
 dash_handler.setLevel(logging.INFO)
-dash_handler.setFormatter(logging.Formatter(log_format))
 
-# Attach custom handler to the root logger
+log_handlers = [BatchedFileHandler("proxy.log"), BatchedStreamHandler(), dash_handler]
+for handler in log_handlers:
+    handler.setFormatter(formatter)
+
+log_writer = LogWriter(log_handlers)
+queue_handler = LazyQueueHandler(log_writer.queue)
+log_writer.start()
+atexit.register(log_writer.stop)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=log_writer.restart_in_child)
+
+# Configure root logger: every record goes through the queue to the writer thread
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+
 logger = logging.getLogger(__name__)
-logger.addHandler(dash_handler)
+logger.setLevel(LOG_LEVEL)
@@ -0,0 +1,227 @@
+import bisect
+import threading
+from config import METRICS_HOST_LABELS
+from reloader import settings_reloader
+
+# Latency histogram bucket bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Methods counted under their own name, anything else is "other" so clients can't grow the label set
+KNOWN_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "CONNECT"))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """ A named metric with a fixed set of label names; label values are passed positionally. """
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        # Label values -> value; a metric without labels is exported as 0 before anything happened
+        self.values = {} if self.label_names else {(): 0}
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """ (suffix, label values, extra label pairs, value) for each exported line. """
+        with self.lock:
+            return [('', labels, (), value) for labels, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_labels(self.label_names, labels, extra)} {_number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self.lock:
+            return self.values.get(labels, 0)
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Gauge(Metric):
+    """ Set by the code it measures, or read from function when scraped. """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        value = self.function()
+        # A labelled function gauge returns {label values: value}
+        values = value if isinstance(value, dict) else {(): value}
+        return [('', labels, (), value) for labels, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """
+    Fixed-bucket histogram: observing is a bisect and a few additions, and
+    quantiles are estimated from the buckets (as Prometheus' own
+    histogram_quantile does), so no samples are kept.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.values = {}
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                # Counts per bucket (the last one is +Inf), then the sum of all observations
+                series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def quantile(self, q, *labels):
+        """
+        Estimated q-quantile of the series whose first label values are
+        labels, merged (e.g. every host of one path), or None if it is empty.
+        """
+        with self.lock:
+            series = [values for key, values in self.values.items() if key[:len(labels)] == labels]
+            counts = [sum(column) for column in zip(*(s[:-1] for s in series))]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]  # Beyond the last bound, all that is known is the bound
+                lower = self.buckets[index - 1] if index else 0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self):
+        with self.lock:
+            items = sorted((labels, list(series)) for labels, series in self.values.items())
+        samples = []
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _number(bound)
+                samples.append(('_bucket', labels, (f'le="{le}"',), cumulative))
+            samples.append(('_sum', labels, (), series[-1]))
+            samples.append(('_count', labels, (), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """ The process' metrics, rendered in the Prometheus text format. """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self._register(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+def method_label(method):
+    return method if method in KNOWN_METHODS else "other"
+
+
+def host_label(host):
+    """ The upstream host as a label value, or "" unless per-host labels are enabled. """
+    return host if METRICS_HOST_LABELS else ""
+
+
+def apply_settings(settings):
+    global METRICS_HOST_LABELS
+    METRICS_HOST_LABELS = settings.METRICS_HOST_LABELS
+
+
+settings_reloader.subscribe(("metrics_host_labels",), apply_settings)
+
+
+metrics = MetricsRegistry()
+
+CONNECTIONS = metrics.counter("proxy_connections_total", "Client connections accepted")
+REQUESTS = metrics.counter("proxy_requests_total", "Requests received, by method", ("method",))
+CACHE_RESULTS = metrics.counter(
+    "proxy_cache_results_total",
+    "Cacheable requests by how they were answered (hit, stale, coalesced, revalidated, stale_if_error, miss)",
+    ("result",))
+BLOCKED = metrics.counter("proxy_blocked_total", "Requests refused by the blacklist", ("kind",))
+HTTP_BYTES = metrics.counter("proxy_http_bytes_total",
+                             "HTTP bytes received from origins and sent to clients (tunnels are counted apart)",
+                             ("direction",))
+TUNNEL_BYTES = metrics.counter(
+    "proxy_tunnel_bytes_total",
+    "Bytes relayed through CONNECT tunnels, upstream (client to origin) and downstream (origin to client)",
+    ("direction",))
+TUNNELS = metrics.gauge("proxy_tunnels_active", "Open CONNECT tunnels")
+REQUEST_SECONDS = metrics.histogram(
+    "proxy_request_duration_seconds",
+    "Time to answer a request: hit (from the cache), miss (cacheable, from the origin), pass (not cacheable) "
+    "and tunnel_setup (CONNECT until the tunnel is established)",
+    ("path", "host"))
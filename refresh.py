@@ -0,0 +1,69 @@
+import os
+import queue
+import threading
+from logger import logger
+
+
+class Refresher:
+    """
+    Refreshes stale cache entries in the background on a fixed number of
+    threads, so the request that finds an entry stale is answered with the
+    stale copy straight away. A key already queued is not queued again, and
+    refreshes are dropped while the queue is full; the next stale hit on the
+    key tries again.
+    """
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.worker_pid = None
+        self.queued = 0
+        self.dropped = 0
+        self.failed = 0
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def submit(self, key, refresh, *args):
+        """ Queue refresh(*args) for key, returns False if it is already queued or the queue is full. """
+        with self.lock:
+            if self.worker_pid != os.getpid():
+                # Started lazily so forked worker processes each get their own threads
+                self.worker_pid = os.getpid()
+                for i in range(self.workers):
+                    threading.Thread(target=self._run, name=f"cache-refresh-{i}", daemon=True).start()
+            if key in self.pending:
+                return False
+            try:
+                self.queue.put_nowait((key, refresh, args))
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self.pending.add(key)
+            self.queued += 1
+        return True
+
+    def _run(self):
+        while True:
+            key, refresh, args = self.queue.get()
+            try:
+                refresh(*args)
+            except Exception as e:
+                logger.warning(f"[Refresh] Failed to refresh {key}: {e}")
+                with self.lock:
+                    self.failed += 1
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "queued": self.queued,
+                "dropped": self.dropped,
+                "failed": self.failed,
+            }
@@ -0,0 +1,90 @@
+import importlib
+import os
+import signal
+import threading
+import config
+from logger import logger
+
+
+class SettingsReloader:
+    """
+    Re-reads settings.json while the proxy runs, when the file changes or on
+    SIGHUP. Modules subscribe the settings they can apply in place, like the
+    blacklist or timeouts, and get the reloaded config module to pick their
+    new values from; connections already open and the cache are untouched.
+    Changed settings nobody subscribed to only take effect after a restart.
+    """
+
+    def __init__(self):
+        self.subscribers = []  # (keys, callback)
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.watcher_pid = None
+
+    def subscribe(self, keys, callback):
+        """ Call callback(config) after a reload that changed any of the settings keys. """
+        self.subscribers.append((frozenset(keys), callback))
+
+    def reload(self):
+        """ Re-read the settings file and apply what changed, returns the changed keys. """
+        with self.lock:
+            previous = dict(config.config)
+            try:
+                importlib.reload(config)
+            except (OSError, ValueError) as e:
+                # A half-written or invalid file keeps the running settings until it is fixed
+                logger.error(f"[Settings] Could not reload {config.SETTINGS_FILE}: {e}")
+                return set()
+            current = config.config
+            changed = {key for key in previous.keys() | current.keys() if previous.get(key) != current.get(key)}
+            if not changed:
+                return changed
+
+            applied = set()
+            for keys, callback in self.subscribers:
+                if keys & changed:
+                    try:
+                        callback(config)
+                    except Exception as e:
+                        logger.error(f"[Settings] Failed to apply {', '.join(sorted(keys & changed))}: {e}")
+                        continue
+                    applied |= keys & changed
+            logger.info(f"[Settings] Reloaded {config.SETTINGS_FILE}, applied: {', '.join(sorted(applied)) or 'nothing'}")
+            if changed - applied:
+                logger.warning(f"[Settings] Changes to {', '.join(sorted(changed - applied))} need a restart")
+            return changed
+
+    def start(self, interval):
+        """
+        Watch the settings file from a thread every interval seconds (0 only
+        reloads on SIGHUP). Must be called from the main thread, which is the
+        only one allowed to install the signal handler.
+        """
+        if self.watcher_pid == os.getpid():
+            return
+        self.watcher_pid = os.getpid()
+        if hasattr(signal, "SIGHUP"):
+            # The handler only wakes the watcher, reloading inside it could deadlock on a lock the main thread holds
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.wake.set())
+        threading.Thread(target=self._watch, args=(interval,), name="settings-reloader", daemon=True).start()
+
+    def _watch(self, interval):
+        last = self._stamp()
+        while True:
+            signalled = self.wake.wait(interval if interval > 0 else None)
+            self.wake.clear()
+            stamp = self._stamp()
+            if signalled or stamp != last:
+                last = stamp
+                self.reload()
+
+    @staticmethod
+    def _stamp():
+        try:
+            stat = os.stat(config.SETTINGS_FILE)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+
+settings_reloader = SettingsReloader()
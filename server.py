@@ -1,17 +1,411 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import selectors
+import signal
 import socket
 import threading
-from config import PROXY_HOST, PROXY_PORT
-from handler import handle_client
+import time
+from config import (PROXY_HOST, PROXY_PORT, SERVER_MODE, WORKER_POOL_SIZE, WORKER_QUEUE_SIZE, CLIENT_IDLE_TIMEOUT,
+                    RETRY_AFTER, POOL_STATS_INTERVAL, WORKER_PROCESSES, SETTINGS_RELOAD_INTERVAL, ADMIN_HOST, ADMIN_PORT)
+from handler import handle_client, cache, misses, refresher, key_normalizer
+from tunnel import tunnel_relays
+from async_server import start_async_proxy
 from logger import logger
+from reloader import settings_reloader
+from metrics import metrics, CONNECTIONS, REQUEST_SECONDS
+from admin import AdminServer
+from telemetry import telemetry_publisher
 
-def start_proxy():
-    logger.info(f"[*] Starting multi-threaded proxy on {PROXY_HOST}:{PROXY_PORT}...")
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def service_unavailable(retry_after):
+    return (
+        f"HTTP/1.1 503 Service Unavailable\r\n"
+        f"Retry-After: {retry_after}\r\n"
+        f"Content-Length: 19\r\n"
+        f"Connection: close\r\n\r\n"
+        f"Proxy is overloaded"
+    ).encode()
+
+
+SERVICE_UNAVAILABLE = service_unavailable(RETRY_AFTER)
+
+
+def apply_settings(settings):
+    global SERVICE_UNAVAILABLE, CLIENT_IDLE_TIMEOUT
+    SERVICE_UNAVAILABLE = service_unavailable(settings.RETRY_AFTER)
+    CLIENT_IDLE_TIMEOUT = settings.CLIENT_IDLE_TIMEOUT
+
+
+settings_reloader.subscribe(("retry_after", "client_idle_timeout"), apply_settings)
+settings_reloader.subscribe(("log_level",), lambda settings: logger.setLevel(settings.LOG_LEVEL))
+
+
+class WorkerPool:
+    """
+    Fixed set of worker threads fed from a bounded queue of accepted
+    connections. Keep-alive connections waiting for their next request are
+    parked with IdleConnections rather than holding a worker.
+    """
+
+    def __init__(self, size, queue_size, handler):
+        self.size = size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.handler = handler
+        self.idle = IdleConnections(self)
+        self.active = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        for i in range(size):
+            threading.Thread(target=self._worker, name=f"proxy-worker-{i}", daemon=True).start()
+
+    def submit(self, client_socket, client_addr, *state):
+        """
+        Queue a connection for the workers, new or resumed with the handler
+        state it was parked with. Returns False if the pool is saturated.
+        """
+        try:
+            self.queue.put_nowait((client_socket, client_addr, *state))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        if not state:
+            with self.lock:
+                self.accepted += 1
+        return True
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                self.active += 1
+            try:
+                self.handler(*job, park=self.idle.park)
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.size,
+                "active_workers": self.active,
+                "queue_depth": self.queue.qsize(),
+                "queue_size": self.queue.maxsize,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "idle_connections": len(self.idle),
+            }
+
+
+class IdleConnections:
+    """
+    Keep-alive client connections between requests, watched by one selector
+    thread instead of each holding a pool worker in recv(). A connection goes
+    back to the pool once it is readable (a 503 if the pool is saturated by
+    then), and is closed after sitting idle for client_idle_timeout.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.selector = selectors.DefaultSelector()
+        self.parked = {}  # socket -> deadline, in parking order, which is deadline order too
+        self.incoming = queue.SimpleQueue()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.idle_closed = 0
+        threading.Thread(target=self._run, name="idle-connections", daemon=True).start()
+
+    def __len__(self):
+        return len(self.parked)
+
+    def park(self, client_socket, client_addr, parser, served):
+        """ Hand a connection to the selector thread until the client sends its next request. """
+        self.incoming.put((client_socket, client_addr, parser, served))
+        self.wake_w.send(b'\0')
+
+    def _run(self):
+        while True:
+            for key, _ in self.selector.select(1):
+                if key.fileobj is self.wake_r:
+                    self._accept_incoming()
+                    continue
+                client_socket = key.fileobj
+                self.selector.unregister(client_socket)
+                del self.parked[client_socket]
+                try:
+                    hung_up = not client_socket.recv(1, socket.MSG_PEEK)
+                except OSError:
+                    hung_up = True
+                if hung_up:
+                    # Most idle connections end with the client closing, no need to wake a worker for that
+                    client_socket.close()
+                    continue
+                if not self.pool.submit(client_socket, *key.data):
+                    reject_client(client_socket, key.data[0])
+            self._expire()
+
+    def _accept_incoming(self):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                client_socket, client_addr, parser, served = self.incoming.get_nowait()
+            except queue.Empty:
+                return
+            self.parked[client_socket] = time.monotonic() + CLIENT_IDLE_TIMEOUT
+            self.selector.register(client_socket, selectors.EVENT_READ, (client_addr, parser, served))
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.parked:
+            client_socket, deadline = next(iter(self.parked.items()))
+            if deadline > now:
+                break  # The rest were parked later, so are due later (a shortened timeout catches up on them)
+            client_addr = self.selector.unregister(client_socket).data[0]
+            del self.parked[client_socket]
+            logger.debug("[-] Closing idle connection from %s", client_addr)
+            self.idle_closed += 1
+            client_socket.close()
+
+
+worker_pool = None
+
+
+def tier_stats(field):
+    """ A cache stats field for the memory and disk tiers, as labelled gauge values. """
+    cached = cache.stats()
+    values = {("memory",): cached[field]}
+    if cached['disk']:
+        values[("disk",)] = cached['disk'][field]
+    return values
+
+
+def pool_stat(field):
+    return worker_pool.stats()[field] if worker_pool else 0
+
+
+metrics.gauge("proxy_threads", "Threads in this process", function=threading.active_count)
+metrics.gauge("proxy_workers_active", "Pool workers serving a connection",
+              function=lambda: pool_stat("active_workers"))
+metrics.gauge("proxy_worker_queue_depth", "Accepted connections waiting for a pool worker",
+              function=lambda: pool_stat("queue_depth"))
+metrics.gauge("proxy_connections_idle", "Keep-alive connections parked between requests, off the pool",
+              function=lambda: pool_stat("idle_connections"))
+metrics.gauge("proxy_cache_entries", "Responses stored, by tier", ("tier",), function=lambda: tier_stats("entries"))
+metrics.gauge("proxy_cache_bytes", "Bytes stored, by tier", ("tier",), function=lambda: tier_stats("bytes"))
+
+
+def reject_client(client_socket, client_addr):
+    """ Shed load by answering 503 straight from the accept loop. """
+    logger.warning(f"[!] Worker pool saturated, rejecting {client_addr}")
+    try:
+        client_socket.sendall(SERVICE_UNAVAILABLE)
+    except OSError:
+        pass
+    finally:
+        client_socket.close()
+
+
+def hit_ratio(stats):
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else 0.0
+
+
+def latency_summary():
+    """ p50/p95/p99 per latency path, in milliseconds, e.g. "hit=1/4/9 miss=35/120/480". """
+    parts = []
+    for path in ("hit", "miss", "pass", "tunnel_setup"):
+        quantiles = [REQUEST_SECONDS.quantile(q, path) for q in (0.5, 0.95, 0.99)]
+        if quantiles[0] is not None:
+            parts.append(f"{path}=" + "/".join(f"{q * 1000:.0f}" for q in quantiles))
+    return " ".join(parts)
+
+
+def report_pool_stats(pool):
+    last_pool = last_cache = last_latency = None
+    while True:
+        time.sleep(POOL_STATS_INTERVAL)
+        stats = pool.stats()
+        tunnels = tunnel_relays.stats()
+        if (stats, tunnels) != last_pool:
+            logger.info(f"[Pool] active={stats['active_workers']}/{stats['workers']} "
+                        f"queued={stats['queue_depth']}/{stats['queue_size']} "
+                        f"idle={stats['idle_connections']} accepted={stats['accepted']} rejected={stats['rejected']} "
+                        f"tunnels={tunnels['active']} idle_closed={tunnels['idle_closed']}")
+            last_pool = (stats, tunnels)
+
+        cached = cache.stats()
+        coalesced = misses.stats()
+        refreshes = refresher.stats()
+        keys = key_normalizer.stats()
+        if (cached, coalesced, refreshes, keys) != last_cache:
+            logger.info(f"[Cache] entries={cached['entries']} bytes={cached['bytes']}/{cached['max_bytes']} "
+                        f"hit_ratio={hit_ratio(cached):.2f} evictions={cached['evictions']} "
+                        f"rejected={cached['rejected']} not_admitted={cached['not_admitted']} "
+                        f"fetches={coalesced['fetches']} coalesced={coalesced['collapsed']} "
+                        f"refreshes={refreshes['queued']} refresh_dropped={refreshes['dropped']}")
+            # Lookups of rewritten keys that found a response are the hits normalization may have won
+            logger.info(f"[Cache] keys rewritten={keys['rewritten']}/{keys['requests']} "
+                        f"found_by_rewritten_key={keys['rewritten_hits']} "
+                        f"varying_urls={cached['varying_urls']}")
+            disk = cached['disk']
+            if disk:
+                logger.info(f"[Cache] disk entries={disk['entries']} bytes={disk['bytes']}/{disk['max_bytes']} "
+                            f"hit_ratio={hit_ratio(disk):.2f} promotions={disk['promotions']} "
+                            f"demotions={disk['demotions']} evictions={disk['evictions']}")
+            last_cache = (cached, coalesced, refreshes, keys)
+
+        latency = latency_summary()
+        if latency and latency != last_latency:
+            logger.info(f"[Latency] p50/p95/p99 ms {latency}")
+            last_latency = latency
+
+
+def create_listener(reuse_port=False):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Every worker process binds the same address, the kernel spreads connections across them
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server.bind((PROXY_HOST, PROXY_PORT))
     server.listen(100)
+    return server
+
+
+def serve_threaded(server):
+    global worker_pool
+
+    logger.info(f"[*] Starting multi-threaded proxy on {PROXY_HOST}:{PROXY_PORT}...")
+
+    if WORKER_POOL_SIZE > 0:
+        logger.info(f"[*] Using {WORKER_POOL_SIZE} workers with a queue of {WORKER_QUEUE_SIZE} connections")
+        worker_pool = WorkerPool(WORKER_POOL_SIZE, WORKER_QUEUE_SIZE, handle_client)
+        if POOL_STATS_INTERVAL > 0:
+            threading.Thread(target=report_pool_stats, args=(worker_pool,), daemon=True).start()
 
     while True:
-        client_socket, client_addr = server.accept()
-        logger.info(f"[+] New connection from {client_addr}")
-        threading.Thread(target=handle_client, args=(client_socket, client_addr), daemon=True).start()
+        try:
+            client_socket, client_addr = server.accept()
+        except OSError as e:
+            # Out of descriptors (EMFILE) until some connections close, the proxy itself must stay up
+            logger.error(f"[!] Could not accept a connection: {e}")
+            time.sleep(0.1)
+            continue
+        logger.info("[+] New connection from %s", client_addr)
+        CONNECTIONS.inc()
+        if worker_pool is None:
+            threading.Thread(target=handle_client, args=(client_socket, client_addr), daemon=True).start()
+        elif not worker_pool.submit(client_socket, client_addr):
+            reject_client(client_socket, client_addr)
+
+
+def raise_fd_limit():
+    """ Lift the soft open-file limit to the hard limit: every tunnel holds two sockets, and two pipes when spliced. """
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            logger.info(f"[*] Raised open file limit from {soft} to {hard}")
+    except (ValueError, OSError) as e:
+        logger.warning(f"[!] Could not raise open file limit: {e}")
+
+
+def run_server(reuse_port=False, slot=0):
+    raise_fd_limit()
+    listener = create_listener(reuse_port)
+    settings_reloader.start(SETTINGS_RELOAD_INTERVAL)
+    if ADMIN_PORT:
+        # Each worker process has metrics of its own, and an admin port of its own to scrape them from
+        AdminServer(ADMIN_HOST, ADMIN_PORT + slot, cache).start()
+    telemetry_publisher.start()
+    if SERVER_MODE == "asyncio":
+        start_async_proxy(listener)
+    else:
+        serve_threaded(listener)
+
+
+def run_worker_process(slot):
+    # Let the supervisor decide how to shut down, a Ctrl+C should not print a traceback per worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)  # Not the supervisor's forwarder, until the reloader takes it
+    # Every worker holds all of the cache it forked with and compacts into its own snapshot, merged at startup
+    cache.journal.use_worker_snapshot(slot)
+    run_server(reuse_port=True, slot=slot)
+
+
+def _stop_supervisor(signum, frame):
+    raise SystemExit(0)
+
+
+def _forward_signal(workers):
+    def forward(signum, frame):
+        for process, _ in workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+    return forward
+
+
+def start_prefork():
+    """ Supervise WORKER_PROCESSES workers that each bind the proxy port with SO_REUSEPORT. """
+    logger.info(f"[*] Starting {WORKER_PROCESSES} proxy worker processes on {PROXY_HOST}:{PROXY_PORT}...")
+    workers = {}
+
+    def spawn(slot):
+        process = multiprocessing.Process(target=run_worker_process, args=(slot,), name=f"proxy-process-{slot}")
+        process.start()
+        workers[slot] = (process, time.monotonic())
+        logger.info(f"[*] Worker process {slot} started with pid {process.pid}")
+
+    # Terminating the supervisor (e.g. from the dashboard) must take the workers down with it
+    signal.signal(signal.SIGTERM, _stop_supervisor)
+    # Each worker reloads the settings itself, a SIGHUP to the supervisor is passed on to all of them
+    signal.signal(signal.SIGHUP, _forward_signal(workers))
+    try:
+        for slot in range(WORKER_PROCESSES):
+            spawn(slot)
+
+        while True:
+            sentinels = [process.sentinel for process, _ in workers.values()]
+            multiprocessing.connection.wait(sentinels)
+            for slot, (process, started) in list(workers.items()):
+                if process.is_alive():
+                    continue
+                logger.warning(f"[!] Worker process {slot} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+                process.join()
+                # Back off a little when a worker dies right after starting, e.g. the port is unavailable
+                if time.monotonic() - started < 1:
+                    time.sleep(1)
+                spawn(slot)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process, _ in workers.values():
+            if process.is_alive():
+                process.terminate()
+        for process, _ in workers.values():
+            process.join()
+
+
+def start_proxy():
+    if WORKER_PROCESSES > 1:
+        if hasattr(socket, "SO_REUSEPORT"):
+            start_prefork()
+            return
+        logger.warning("[!] SO_REUSEPORT is not supported on this platform, running a single process")
+    run_server()
@@ -0,0 +1,124 @@
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+# How long a request waits for another request's fetch of the same URL before taking the fetch over
+COALESCE_TIMEOUT = 30
+
+# How long misses of a key whose response could not be shared skip coalescing, and how many such keys are remembered
+PASS_SECONDS = 10
+MAX_PASSES = 10_000
+
+# What a leader publishes instead of response bytes (None: nothing to share, followers fetch themselves)
+STORED = "stored"  # Cached, but not as bytes to hand over (on disk, or as another variant): look it up again
+FAILED = "failed"  # The origin timed out or could not be reached: answer with the same error instead of retrying
+
+
+class SingleFlight:
+    """
+    Collapses concurrent cache misses for the same key into one upstream
+    fetch. The first miss becomes the leader and fetches; later misses wait
+    on its future and are served what it publishes. A leader slower than
+    COALESCE_TIMEOUT is taken over by one of its followers, the others keep
+    waiting on the new leader. Keys whose responses can't be shared are
+    fetched without coalescing for a while, so nobody waits on them. Futures
+    work from threads (result()) and from the event loop (asyncio.wrap_future).
+    """
+
+    def __init__(self):
+        self.flights = {}  # key -> Future of what the leader publishes
+        self.passes = {}  # key -> until when its misses skip coalescing
+        self.lock = threading.Lock()
+        self.fetches = 0
+        self.collapsed = 0
+        self.failed = 0
+        self.fallbacks = 0
+        self.takeovers = 0
+
+    def join(self, key):
+        """
+        Return (flight, leader). The leader must call finish(), everyone else
+        waits on the flight. A key that is passed gets (None, True).
+        """
+        with self.lock:
+            if key in self.passes:
+                if self.passes[key] > time.monotonic():
+                    return None, True
+                del self.passes[key]
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self.flights[key] = Future()
+            self.fetches += 1
+            return flight, True
+
+    def finish(self, key, flight, response):
+        """
+        Publish the leader's complete response, STORED, FAILED, or None if
+        there is nothing to share (the key is then passed). Safe to call twice.
+        """
+        if flight is None:
+            return
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            if response is None:
+                if key not in self.passes and len(self.passes) >= MAX_PASSES:
+                    del self.passes[next(iter(self.passes))]
+                self.passes[key] = time.monotonic() + PASS_SECONDS
+        if not flight.done():
+            flight.set_result(response)
+
+    def take_over(self, key, flight):
+        """
+        A follower gave up waiting on flight. The first to do so leads a new
+        flight for the key, later ones follow it. Returns (flight, leader).
+        """
+        with self.lock:
+            if flight.done():
+                return flight, False
+            current = self.flights.get(key)
+            if current is not None and current is not flight:
+                return current, False
+            current = self.flights[key] = Future()
+            self.fetches += 1
+            self.takeovers += 1
+            return current, True
+
+    def wait(self, key, flight, timeout=COALESCE_TIMEOUT):
+        """
+        Block until the leader publishes, returning (what it published, None).
+        A follower that takes over gets (None, its new flight) and must fetch
+        and finish() it.
+        """
+        while True:
+            try:
+                response = flight.result(timeout)
+            except FutureTimeout:
+                flight, leader = self.take_over(key, flight)
+                if leader:
+                    return None, flight
+                continue
+            self.record(response)
+            return response, None
+
+    def record(self, response):
+        with self.lock:
+            if response is None:
+                self.fallbacks += 1
+            elif response is FAILED:
+                self.failed += 1
+            else:
+                self.collapsed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "in_flight": len(self.flights),
+                "fetches": self.fetches,
+                "collapsed": self.collapsed,
+                "failed": self.failed,
+                "fallbacks": self.fallbacks,
+                "takeovers": self.takeovers,
+                "passes": len(self.passes),
+            }
@@ -0,0 +1,82 @@
+import json
+import os
+import socket
+import threading
+import time
+from config import TELEMETRY_SOCKET, TELEMETRY_INTERVAL
+from logger import logger, dash_handler
+from metrics import CONNECTIONS, REQUESTS, BLOCKED, CACHE_RESULTS, HTTP_BYTES, TUNNEL_BYTES
+
+# What the dashboard charts, each one read from the metrics as a running total
+TELEMETRY_COUNTERS = {
+    "connections": CONNECTIONS.total,
+    "requests": REQUESTS.total,
+    "blocked": BLOCKED.total,
+    # Coalesced, revalidated and stale responses were all served without a full origin fetch
+    "cache_hits": lambda: CACHE_RESULTS.total() - CACHE_RESULTS.value("miss"),
+    "cache_misses": lambda: CACHE_RESULTS.value("miss"),
+    "bytes_sent": lambda: HTTP_BYTES.value("sent") + TUNNEL_BYTES.value("downstream"),
+}
+
+
+def telemetry_snapshot():
+    return {name: read() for name, read in TELEMETRY_COUNTERS.items()}
+
+
+class TelemetryPublisher:
+    """
+    Pushes what happened since the last message, counter increments and the
+    dashboard's log lines, as one small JSON datagram per interval to the
+    dashboard's Unix socket. Sending never blocks and nobody has to listen:
+    without a dashboard the message is dropped, and when the dashboard falls
+    behind the increments are carried over to the next message.
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.sent = {}
+        self.socket = None
+        self.publisher_pid = None
+
+    def start(self):
+        """ Start publishing from this process, once; every prefork worker publishes its own counts. """
+        if not self.path or self.interval <= 0 or not hasattr(socket, "AF_UNIX"):
+            return
+        if self.publisher_pid == os.getpid():
+            return
+        self.publisher_pid = os.getpid()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.sent = telemetry_snapshot()  # A worker forked from a busy process only reports its own counts
+        threading.Thread(target=self._run, name="telemetry", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f"[Telemetry] Could not publish: {e}")
+
+    def publish(self):
+        totals = telemetry_snapshot()
+        counts = {name: total - self.sent.get(name, 0) for name, total in totals.items()
+                  if total != self.sent.get(name, 0)}
+        logs = dash_handler.take()
+        if not counts and not logs:
+            return
+        message = json.dumps({"pid": os.getpid(), "time": time.time(), "counts": counts, "logs": logs},
+                             separators=(",", ":")).encode()
+        try:
+            self.socket.sendto(message, self.path)
+        except BlockingIOError:
+            # The dashboard's socket buffer is full, send these increments and lines with the next message
+            dash_handler.put_back(logs)
+            return
+        except OSError:
+            pass  # No dashboard listening
+        self.sent = totals
+
+
+telemetry_publisher = TelemetryPublisher(TELEMETRY_SOCKET, TELEMETRY_INTERVAL)
@@ -0,0 +1,478 @@
+import errno
+import os
+import queue
+import select
+import socket
+import threading
+import time
+from config import TUNNEL_RELAY, TUNNEL_RELAY_THREADS, TUNNEL_IDLE_TIMEOUT, TUNNEL_MAX_LIFETIME
+from logger import logger
+from metrics import TUNNELS, TUNNEL_BYTES
+from reloader import settings_reloader
+
+RELAY_CHUNK = 65536
+RELAY_TIMEOUT = 5
+
+# os.splice needs Linux and Python 3.10+
+SPLICE_AVAILABLE = hasattr(os, "splice")
+SPLICE_FLAGS = (os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK) if SPLICE_AVAILABLE else 0
+
+
+def wait_ready(sockets, timeout, writable=False):
+    """
+    The sockets that become readable (or writable) within timeout seconds.
+    Uses poll where there is one, select.select refuses descriptors >= 1024
+    and thousands of open tunnels get there.
+    """
+    if not hasattr(select, "poll"):
+        readable, ready, _ = select.select([] if writable else sockets, sockets if writable else [], [], timeout)
+        return ready if writable else readable
+    poller = select.poll()
+    for sock in sockets:
+        poller.register(sock, select.POLLOUT if writable else select.POLLIN)
+    ready = {fd for fd, _ in poller.poll(timeout * 1000)}
+    return [sock for sock in sockets if sock.fileno() in ready]
+
+
+def _timed_out(started, last_active, client_addr, dest_host):
+    """ Whether a tunnel relayed on its own thread sat idle or outlived its maximum lifetime. """
+    now = time.monotonic()
+    if now - last_active > TUNNEL_IDLE_TIMEOUT:
+        logger.info(f"[Tunnel] Closing idle tunnel {client_addr} <-> {dest_host}")
+        return True
+    if 0 < TUNNEL_MAX_LIFETIME <= now - started:
+        logger.info(f"[Tunnel] Closing tunnel {client_addr} <-> {dest_host} after {TUNNEL_MAX_LIFETIME}s")
+        return True
+    return False
+
+
+def relay_copy(client_socket, server_socket, client_addr, dest_host):
+    """ Relay by copying every chunk through Python. """
+    sockets = [client_socket, server_socket]
+    started = last_active = time.monotonic()
+    while True:
+        try:
+            readable = wait_ready(sockets, RELAY_TIMEOUT)
+            if readable:
+                last_active = time.monotonic()
+            if _timed_out(started, last_active, client_addr, dest_host):
+                return
+            for sock in readable:
+                other_sock = server_socket if sock is client_socket else client_socket
+                try:
+                    data = sock.recv(RELAY_CHUNK)
+                    if not data:
+                        return
+                    other_sock.sendall(data)
+                    TUNNEL_BYTES.inc("upstream" if sock is client_socket else "downstream", amount=len(data))
+                except socket.timeout:
+                    logger.warning(f"[!] Timeout relaying data between client and {dest_host}")
+                    return
+                except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
+                    logger.warning(f"[!] Connection error in HTTPS tunnel: {client_addr} <-> {dest_host} | {e}")
+                    return
+        except Exception as e:
+            logger.exception(f"[!] Unexpected error in HTTPS relay loop: {e}")
+            return
+
+
+def _drain_pipe(read_end, sock, pending):
+    """ Splice everything waiting in the pipe into sock, waiting for it to become writable if needed. """
+    while pending:
+        try:
+            pending -= os.splice(read_end, sock.fileno(), pending, flags=SPLICE_FLAGS)
+        except BlockingIOError:
+            if not wait_ready([sock], RELAY_TIMEOUT, writable=True):
+                raise socket.timeout("timed out writing to tunnel peer")
+
+
+def relay_splice(client_socket, server_socket, client_addr, dest_host):
+    """
+    Relay by moving bytes socket -> pipe -> socket inside the kernel, so
+    tunnel payloads never become Python objects. One pipe per direction.
+    """
+    pipes = {}
+    try:
+        for sock in (client_socket, server_socket):
+            pipes[sock] = os.pipe()
+    except OSError as e:
+        # Out of descriptors (EMFILE), copying through Python needs none
+        for read_end, write_end in pipes.values():
+            os.close(read_end)
+            os.close(write_end)
+        logger.warning(f"[Tunnel] No pipes for splicing {dest_host}, copying instead: {e}")
+        relay_copy(client_socket, server_socket, client_addr, dest_host)
+        return
+    sockets = [client_socket, server_socket]
+    started = last_active = time.monotonic()
+    try:
+        while True:
+            readable = wait_ready(sockets, RELAY_TIMEOUT)
+            if readable:
+                last_active = time.monotonic()
+            if _timed_out(started, last_active, client_addr, dest_host):
+                return
+            for sock in readable:
+                other_sock = server_socket if sock is client_socket else client_socket
+                read_end, write_end = pipes[sock]
+                try:
+                    moved = os.splice(sock.fileno(), write_end, RELAY_CHUNK, flags=SPLICE_FLAGS)
+                except BlockingIOError:
+                    continue
+                if not moved:
+                    return
+                _drain_pipe(read_end, other_sock, moved)
+                TUNNEL_BYTES.inc("upstream" if sock is client_socket else "downstream", amount=moved)
+    except socket.timeout:
+        logger.warning(f"[!] Timeout relaying data between client and {dest_host}")
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
+        logger.warning(f"[!] Connection error in HTTPS tunnel: {client_addr} <-> {dest_host} | {e}")
+    finally:
+        for read_end, write_end in pipes.values():
+            os.close(read_end)
+            os.close(write_end)
+
+
+def relay_tunnel(client_socket, server_socket, client_addr, dest_host):
+    """ Relay an established tunnel on the calling thread until either side closes, using splice where possible. """
+    TUNNELS.inc()
+    try:
+        if TUNNEL_RELAY == "copy" or not SPLICE_AVAILABLE:
+            relay_copy(client_socket, server_socket, client_addr, dest_host)
+            return
+        try:
+            relay_splice(client_socket, server_socket, client_addr, dest_host)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            # The kernel refused to splice these descriptors before moving anything
+            logger.debug(f"[Tunnel] splice unsupported for {dest_host}, copying instead")
+            relay_copy(client_socket, server_socket, client_addr, dest_host)
+    finally:
+        TUNNELS.dec()
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: scheduling is O(1) and each tick only looks at one
+    slot, so thousands of tunnel deadlines cost almost nothing to track.
+    Deadlines further out than one revolution stay in their slot until due.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)
+
+    def schedule(self, deadline, item):
+        tick_no = max(int(deadline / self.tick), self.current + 1)
+        self.slots[tick_no % len(self.slots)].append((tick_no, item))
+
+    def expire(self, now):
+        """ Return the items whose deadline passed since the last call. """
+        due = []
+        target = int(now / self.tick)
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            if not slot:
+                continue
+            pending = []
+            for entry in slot:
+                (due if entry[0] <= self.current else pending).append(entry)
+            slot[:] = pending
+        return [item for _, item in due]
+
+
+class _Direction:
+    """ One direction of a tunnel. Bytes that the destination can't take yet wait in a pipe or buffer. """
+
+    __slots__ = ('src', 'dst', 'direction', 'pipe', 'buffer', 'pending', 'eof')
+
+    def __init__(self, src, dst, direction, use_splice):
+        self.src = src
+        self.dst = dst
+        self.direction = direction  # upstream or downstream, as the metrics count it
+        self.pipe = None
+        if use_splice:
+            try:
+                self.pipe = os.pipe()
+            except OSError as e:
+                # Out of descriptors (EMFILE), copying through Python needs none
+                logger.warning(f"[Tunnel] No pipe for splicing, copying instead: {e}")
+        self.buffer = None
+        self.pending = 0
+        self.eof = False
+
+    def pull(self):
+        """ Read what src has into the pipe/buffer, then push as much as dst accepts. """
+        if self.pipe:
+            try:
+                moved = os.splice(self.src.fileno(), self.pipe[1], RELAY_CHUNK, flags=SPLICE_FLAGS)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno != errno.EINVAL or self.pending:
+                    raise
+                # The kernel refused to splice these descriptors, copy instead
+                self.close()
+                self.pipe = None
+                return self.pull()
+        else:
+            try:
+                data = self.src.recv(RELAY_CHUNK)
+            except BlockingIOError:
+                return
+            moved = len(data)
+            self.buffer = memoryview(data)
+        if not moved:
+            self.eof = True
+            return
+        self.pending = moved
+        self.push()
+
+    def push(self):
+        """ Write pending bytes to dst until it would block. """
+        pending = self.pending
+        try:
+            while self.pending:
+                if self.pipe:
+                    sent = os.splice(self.pipe[0], self.dst.fileno(), self.pending, flags=SPLICE_FLAGS)
+                else:
+                    sent = self.dst.send(self.buffer)
+                    self.buffer = self.buffer[sent:]
+                self.pending -= sent
+        except BlockingIOError:
+            pass
+        finally:
+            if pending != self.pending:
+                TUNNEL_BYTES.inc(self.direction, amount=pending - self.pending)
+        if not self.pending:
+            self.buffer = None
+
+    def close(self):
+        if self.pipe:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+
+
+class _Tunnel:
+    __slots__ = ('client', 'server', 'client_addr', 'dest_host', 'up', 'down', 'started', 'last_active',
+                 'masks', 'closed')
+
+    def __init__(self, client, server, client_addr, dest_host, use_splice):
+        self.client = client
+        self.server = server
+        self.client_addr = client_addr
+        self.dest_host = dest_host
+        self.up = _Direction(client, server, "upstream", use_splice)
+        self.down = _Direction(server, client, "downstream", use_splice)
+        self.started = self.last_active = time.monotonic()
+        self.masks = {}
+        self.closed = False
+
+    @property
+    def finished(self):
+        # Same as the threaded relay: once either side is done, the whole tunnel is
+        return (self.up.eof and not self.up.pending) or (self.down.eof and not self.down.pending)
+
+    def deadline(self):
+        deadline = self.last_active + TUNNEL_IDLE_TIMEOUT
+        if TUNNEL_MAX_LIFETIME > 0:
+            deadline = min(deadline, self.started + TUNNEL_MAX_LIFETIME)
+        return deadline
+
+    def interest(self, sock):
+        """ Read from a side only while its outbound bytes are flushed, wait for writable while inbound ones aren't. """
+        outbound, inbound = (self.up, self.down) if sock is self.client else (self.down, self.up)
+        mask = 0
+        if not outbound.pending and not outbound.eof:
+            mask |= select.EPOLLIN
+        if inbound.pending:
+            mask |= select.EPOLLOUT
+        return mask
+
+
+class TunnelMultiplexer:
+    """ One epoll loop relaying many established tunnels, with idle/lifetime deadlines on a timer wheel. """
+
+    def __init__(self, name):
+        self.name = name
+        self.epoll = select.epoll()
+        self.wheel = TimerWheel()
+        self.tunnels = {}  # fd -> tunnel
+        self.incoming = queue.SimpleQueue()
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        self.epoll.register(self.wake_r, select.EPOLLIN)
+        self.active = 0
+        self.idle_closed = 0
+        self.expired_closed = 0
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def add(self, client, server, client_addr, dest_host):
+        """ Hand a tunnel to the loop thread; called from whichever thread set it up. """
+        self.incoming.put((client, server, client_addr, dest_host))
+        os.write(self.wake_w, b'\0')
+
+    def _run(self):
+        while True:
+            try:
+                self._poll()
+            except Exception as e:
+                # Every tunnel on this thread would freeze with it, keep the loop alive whatever went wrong
+                logger.exception(f"[!] Unexpected error in HTTPS relay loop: {e}")
+
+    def _poll(self):
+        events = self.epoll.poll(self.wheel.tick)
+        for fd, mask in events:
+            if fd == self.wake_r:
+                self._accept_incoming()
+                continue
+            tunnel = self.tunnels.get(fd)
+            if tunnel is None:
+                continue
+            try:
+                self._on_event(tunnel, fd, mask)
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
+                logger.warning(f"[!] Connection error in HTTPS tunnel: {tunnel.client_addr} <-> {tunnel.dest_host} | {e}")
+                self._close(tunnel)
+            except Exception as e:
+                logger.exception(f"[!] Unexpected error in HTTPS relay loop: {e}")
+                self._close(tunnel)
+        self._expire()
+
+    def _accept_incoming(self):
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                client, server, client_addr, dest_host = self.incoming.get_nowait()
+            except queue.Empty:
+                return
+            use_splice = TUNNEL_RELAY != "copy" and SPLICE_AVAILABLE
+            tunnel = _Tunnel(client, server, client_addr, dest_host, use_splice)
+            self.active += 1
+            TUNNELS.inc()
+            try:
+                for sock in (client, server):
+                    sock.setblocking(False)
+                    self.tunnels[sock.fileno()] = tunnel
+                    tunnel.masks[sock] = select.EPOLLIN
+                    self.epoll.register(sock.fileno(), select.EPOLLIN)
+            except OSError as e:
+                # One tunnel that can't be set up must not take the others on this thread down with it
+                logger.error(f"[!] Could not relay tunnel {client_addr} <-> {dest_host}: {e}")
+                self._close(tunnel)
+                continue
+            self.wheel.schedule(tunnel.deadline(), tunnel)
+
+    def _on_event(self, tunnel, fd, mask):
+        tunnel.last_active = time.monotonic()
+        sock = tunnel.client if fd == tunnel.client.fileno() else tunnel.server
+        outbound, inbound = (tunnel.up, tunnel.down) if sock is tunnel.client else (tunnel.down, tunnel.up)
+        if mask & select.EPOLLOUT:
+            inbound.push()
+        if mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+            if not outbound.pending:
+                outbound.pull()
+            elif mask & (select.EPOLLHUP | select.EPOLLERR):
+                # Can't read the rest while the other side is backed up, and the socket would keep waking us
+                self._close(tunnel)
+                return
+
+        if tunnel.finished:
+            self._close(tunnel)
+            return
+        for side in (tunnel.client, tunnel.server):
+            wanted = tunnel.interest(side)
+            if wanted != tunnel.masks[side]:
+                self.epoll.modify(side.fileno(), wanted)
+                tunnel.masks[side] = wanted
+
+    def _expire(self):
+        now = time.monotonic()
+        for tunnel in self.wheel.expire(now):
+            if tunnel.closed:
+                continue
+            if now - tunnel.last_active >= TUNNEL_IDLE_TIMEOUT:
+                logger.info(f"[Tunnel] Closing idle tunnel {tunnel.client_addr} <-> {tunnel.dest_host}")
+                self.idle_closed += 1
+                self._close(tunnel)
+            elif TUNNEL_MAX_LIFETIME > 0 and now - tunnel.started >= TUNNEL_MAX_LIFETIME:
+                logger.info(f"[Tunnel] Closing tunnel {tunnel.client_addr} <-> {tunnel.dest_host} after {TUNNEL_MAX_LIFETIME}s")
+                self.expired_closed += 1
+                self._close(tunnel)
+            else:
+                # There was traffic since this deadline was set, push it back
+                self.wheel.schedule(tunnel.deadline(), tunnel)
+
+    def _close(self, tunnel):
+        if tunnel.closed:
+            return
+        tunnel.closed = True
+        self.active -= 1
+        TUNNELS.dec()
+        for sock in (tunnel.client, tunnel.server):
+            fd = sock.fileno()
+            if fd != -1:
+                self.tunnels.pop(fd, None)
+                try:
+                    self.epoll.unregister(fd)
+                except OSError:
+                    pass
+            sock.close()
+        tunnel.up.close()
+        tunnel.down.close()
+
+    def stats(self):
+        return {"active": self.active, "idle_closed": self.idle_closed, "expired_closed": self.expired_closed}
+
+
+class TunnelRelays:
+    """ A few multiplexer threads per process; tunnels are spread across them round-robin. """
+
+    def __init__(self, threads=TUNNEL_RELAY_THREADS):
+        self.threads = threads if hasattr(select, "epoll") else 0
+        self.multiplexers = []
+        self.next = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.threads > 0
+
+    def add(self, client_socket, server_socket, client_addr, dest_host):
+        """ Take ownership of both sockets; the caller's socket objects are left detached. """
+        client = socket.socket(fileno=client_socket.detach())
+        server = socket.socket(fileno=server_socket.detach())
+        with self.lock:
+            if not self.multiplexers:
+                # Started lazily so forked worker processes each get their own threads
+                self.multiplexers = [TunnelMultiplexer(f"tunnel-relay-{i}") for i in range(self.threads)]
+            multiplexer = self.multiplexers[self.next % len(self.multiplexers)]
+            self.next += 1
+        multiplexer.add(client, server, client_addr, dest_host)
+
+    def stats(self):
+        totals = {"active": 0, "idle_closed": 0, "expired_closed": 0}
+        for multiplexer in self.multiplexers:
+            for name, value in multiplexer.stats().items():
+                totals[name] += value
+        return totals
+
+
+tunnel_relays = TunnelRelays()
+
+
+def apply_settings(settings):
+    """ Open tunnels are held to the reloaded limits from their next deadline check. """
+    global TUNNEL_IDLE_TIMEOUT, TUNNEL_MAX_LIFETIME
+    TUNNEL_IDLE_TIMEOUT = settings.TUNNEL_IDLE_TIMEOUT
+    TUNNEL_MAX_LIFETIME = settings.TUNNEL_MAX_LIFETIME
+
+
+settings_reloader.subscribe(("tunnel_idle_timeout", "tunnel_max_lifetime"), apply_settings)
@@ -0,0 +1,136 @@
+import select
+import socket
+import threading
+import time
+from collections import deque
+from config import UPSTREAM_POOL_SIZE, UPSTREAM_IDLE_TIMEOUT
+from logger import logger
+from reloader import settings_reloader
+
+UPSTREAM_TIMEOUT = 5
+
+
+def split_host_port(host, default_port=80):
+    """ Split a Host header value into (host, port). """
+    if host.startswith('['):  # IPv6 literal, e.g. [::1]:8080
+        end = host.find(']')
+        port = host[end + 2:] if host[end + 1:end + 2] == ':' else ''
+        return host[1:end], int(port) if port.isdigit() else default_port
+    name, _, port = host.partition(':')
+    return name, int(port) if port.isdigit() else default_port
+
+
+class UpstreamPool:
+    """ Idle persistent upstream connections, kept per (host, port). """
+
+    def __init__(self, max_per_host=UPSTREAM_POOL_SIZE, idle_timeout=UPSTREAM_IDLE_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.idle = {}  # (host, port) -> deque of (socket, released_at)
+        self.lock = threading.Lock()
+        self.reaper_started = False
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, host, port):
+        """ Return (socket, reused) for host:port, preferring the most recently released connection. """
+        sock = self.checkout(host, port)
+        if sock is not None:
+            return sock, True
+        return self.connect(host, port), False
+
+    def checkout(self, host, port):
+        """ The most recently released idle connection to host:port that is still usable, or None. Never blocks. """
+        key = (host, port)
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                conns = self.idle.get(key)
+                if not conns:
+                    return None
+                sock, released_at = conns.pop()
+            if now - released_at < self.idle_timeout and self._is_usable(sock):
+                with self.lock:
+                    self.reused += 1
+                return sock
+            sock.close()
+
+    def connect(self, host, port):
+        """ A new connection to host:port; blocks while resolving and connecting. """
+        sock = socket.create_connection((host, port), timeout=UPSTREAM_TIMEOUT)
+        sock.settimeout(UPSTREAM_TIMEOUT)
+        with self.lock:
+            self.created += 1
+        return sock
+
+    def release(self, host, port, sock):
+        """ Return a connection whose last response was fully read. """
+        if self.max_per_host <= 0:
+            sock.close()
+            return
+        with self.lock:
+            conns = self.idle.setdefault((host, port), deque())
+            conns.append((sock, time.monotonic()))
+            evicted = conns.popleft()[0] if len(conns) > self.max_per_host else None
+            if not self.reaper_started:
+                # Started lazily so forked worker processes each get their own reaper
+                self.reaper_started = True
+                threading.Thread(target=self._reap, daemon=True).start()
+        if evicted:
+            evicted.close()
+
+    def evict_idle(self):
+        """ Close connections that sat idle longer than idle_timeout. """
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = []
+        with self.lock:
+            for key in list(self.idle):
+                conns = self.idle[key]
+                while conns and conns[0][1] < cutoff:
+                    expired.append(conns.popleft()[0])
+                if not conns:
+                    del self.idle[key]
+        for sock in expired:
+            sock.close()
+        return len(expired)
+
+    def _reap(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 2, 1))
+            evicted = self.evict_idle()
+            if evicted:
+                logger.debug(f"[Upstream] Closed {evicted} idle connections")
+
+    @staticmethod
+    def _is_usable(sock):
+        # An idle connection should have nothing to read; readable means the origin closed it.
+        # poll where there is one, select.select refuses descriptors >= 1024.
+        try:
+            if hasattr(select, "poll"):
+                poller = select.poll()
+                poller.register(sock, select.POLLIN)
+                return not poller.poll(0)
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def stats(self):
+        with self.lock:
+            return {
+                "idle": sum(len(conns) for conns in self.idle.values()),
+                "hosts": len(self.idle),
+                "created": self.created,
+                "reused": self.reused,
+            }
+
+
+upstream_pool = UpstreamPool()
+
+
+def apply_settings(settings):
+    upstream_pool.max_per_host = settings.UPSTREAM_POOL_SIZE
+    upstream_pool.idle_timeout = settings.UPSTREAM_IDLE_TIMEOUT
+
+
+settings_reloader.subscribe(("upstream_pool_size", "upstream_idle_timeout"), apply_settings)